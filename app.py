@@ -1,10 +1,15 @@
 # D:\tesismma\app.py
 import os
 import sys
+import json
 import logging
 import traceback
+import time
 import datetime
-from flask import Flask, render_template_string, send_file, url_for, redirect, flash, request
+import shutil
+import tempfile
+import threading
+from flask import Flask, render_template_string, send_file, url_for, redirect, flash, request, jsonify, abort, Response, stream_with_context
 from werkzeug.utils import secure_filename
 
 # --- Configuración de Rutas para Importar Módulos del Proyecto ---
@@ -16,6 +21,10 @@ if PROJECT_ROOT not in sys.path:
 try:
     from scripts.main import run_analysis
     from scripts import config
+    from scripts import document_utils
+    from scripts import metricas
+    from scripts import colecciones_kb
+    from scripts.gestor_trabajos import GestorTrabajos, ColaLlenaError, ESTADO_COMPLETADO
 except ImportError as e:
     logging.basicConfig(level=logging.ERROR)
     logging.error(f"Error crítico al importar módulos necesarios (main, config): {e}")
@@ -32,6 +41,42 @@ MAX_KB_FILES = 4
 MAX_KB_TOTAL_SIZE_MB = 8 * 1024 * 1024
 MAX_PROJECT_FILE_SIZE_MB = 2 * 1024 * 1024
 
+# --- Cola de Análisis en Segundo Plano ---
+# POST /analyze solo valida y guarda los archivos; el análisis corre en un hilo del gestor y se consulta en /jobs/<id>.
+gestor_trabajos = GestorTrabajos(config.MAX_TRABAJOS_CONCURRENTES, config.MAX_TRABAJOS_EN_COLA,
+                                 config.TTL_TRABAJOS_SEGUNDOS) if config else None
+# Cada análisis tiene su espacio de trabajo en datos/Trabajos/<carpeta>/ (PDF del proyecto y resultados), así que
+# los análisis corren en paralelo. Las bases de conocimiento subidas no reemplazan la predeterminada: cada una es una
+# colección propia (datos/ColeccionesKB/<id>) que se elige por id y se reutiliza sin re-indexar.
+gestor_colecciones = colecciones_kb.obtener_gestor_colecciones() if config else None
+# Protege datos/ProyectoAnalizar, donde se conserva el último PDF subido para "Utilizar documento previamente cargado".
+_lock_proyecto_previo = threading.Lock()
+
+def _ultima_modificacion(ruta):
+    ultima = os.path.getmtime(ruta)
+    for raiz, directorios, archivos in os.walk(ruta):
+        for nombre in directorios + archivos:
+            try:
+                ultima = max(ultima, os.path.getmtime(os.path.join(raiz, nombre)))
+            except OSError:
+                pass
+    return ultima
+
+def _borrar_espacios_huerfanos(directorio_trabajos, antiguedad_segundos):
+    # Solo los espacios sin cambios desde hace más que el TTL de los trabajos: con varios workers de gunicorn, o durante
+    # un reinicio escalonado, los más recientes pueden pertenecer a trabajos vivos de otro proceso.
+    limite = time.time() - antiguedad_segundos
+    for nombre in os.listdir(directorio_trabajos):
+        ruta = os.path.join(directorio_trabajos, nombre)
+        try:
+            if os.path.isdir(ruta) and _ultima_modificacion(ruta) < limite:
+                shutil.rmtree(ruta, ignore_errors=True)
+        except OSError:
+            pass # Borrado por otro proceso mientras se recorría
+
+if config and os.path.isdir(config.DIRECTORIO_TRABAJOS):
+    _borrar_espacios_huerfanos(config.DIRECTORIO_TRABAJOS, config.TTL_TRABAJOS_SEGUNDOS)
+
 # --- Configuración del Logging de Flask ---
 if not app.debug:
     gunicorn_logger = logging.getLogger('gunicorn.error')
@@ -273,6 +318,15 @@ HOME_PAGE_HTML = """
                     </div>
                     <label for="kb_files_input" style="margin-top:10px;">Subir PDFs para nueva Base de Conocimiento (hasta """+str(MAX_KB_FILES)+""" archivos, total max. """+str(MAX_KB_TOTAL_SIZE_MB // (1024*1024))+"""MB):</label>
                     <input type="file" id="kb_files_input" name="kb_files" multiple accept=".pdf">
+                    {% if colecciones_kb %}
+                    <label for="kb_id_input" style="margin-top:10px;">O reutilizar una Base de Conocimiento subida anteriormente (sin re-indexar):</label>
+                    <select id="kb_id_input" name="kb_id">
+                        <option value="">-- Ninguna --</option>
+                        {% for coleccion in colecciones_kb %}
+                        <option value="{{ coleccion.id }}">{{ coleccion.nombre }}</option>
+                        {% endfor %}
+                    </select>
+                    {% endif %}
                 </div>
 
                 <div class="form-section">
@@ -289,6 +343,10 @@ HOME_PAGE_HTML = """
             <div class="checkbox-container" style="text-align: center; margin-bottom: 20px; margin-top: 15px;">
                 <input type="checkbox" id="generate_pdf_input" name="generate_pdf" value="yes">
                 <label for="generate_pdf_input" class="checkbox-label" style="font-size: 0.95em;">Generar también reporte en PDF</label>
+                <div style="margin-top: 8px;">
+                    <input type="checkbox" id="force_refresh_input" name="force_refresh" value="yes">
+                    <label for="force_refresh_input" class="checkbox-label" style="font-size: 0.95em;">Forzar nuevo análisis (ignorar resultados guardados)</label>
+                </div>
             </div>
             
             <div class="button-container">
@@ -305,6 +363,7 @@ HOME_PAGE_HTML = """
     <script>
         const useDefaultKbCheckbox = document.getElementById('use_default_kb_input');
         const kbFilesInput = document.getElementById('kb_files_input');
+        const kbIdInput = document.getElementById('kb_id_input');
         const useExistingProjectCheckbox = document.getElementById('use_existing_project_file_input'); 
         const projectFileInput = document.getElementById('project_file_input'); 
 
@@ -315,6 +374,9 @@ HOME_PAGE_HTML = """
             } else {
                 kbFilesInput.disabled = false;
             }
+            if (kbIdInput) {
+                kbIdInput.disabled = useDefaultKbCheckbox.checked;
+            }
         }
 
         function toggleProjectFileInput() { 
@@ -382,6 +444,163 @@ HOME_PAGE_HTML = """
 </html>
 """
 
+JOB_PAGE_HTML = """
+<!DOCTYPE html>
+<html lang="es">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Análisis en curso - Tesis Adriel Cuesta</title>
+    <style>
+        body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; margin: 0; padding: 20px; background-color: #f0f2f5; color: #333; display: flex; flex-direction: column; align-items: center; min-height: 95vh; }
+        .main-container { background-color: #ffffff; padding: 30px 40px; border-radius: 12px; box-shadow: 0 6px 20px rgba(0,0,0,0.1); width: 100%; max-width: 1000px; text-align: left; margin-bottom: auto; }
+        h2 { color: #0056b3; margin-top: 0; }
+        .progress-bar { width: 100%; background-color: #e9ecef; border-radius: 6px; height: 22px; overflow: hidden; margin: 15px 0; }
+        .progress-bar-fill { height: 100%; width: 0%; background-color: #007bff; transition: width 0.5s ease; }
+        .stage { font-size: 1.05em; font-weight: 500; }
+        .flash-messages { list-style-type: none; padding: 0; margin: 20px 0; }
+        .flash-messages li { padding: 12px 15px; margin-bottom: 10px; border-radius: 5px; font-size: 0.95em;}
+        .flash-messages .error { background-color: #f8d7da; color: #721c24; border: 1px solid #f5c6cb; }
+        .flash-messages .info { background-color: #d1ecf1; color: #0c5460; border: 1px solid #bee5eb; }
+        .flash-messages .success { background-color: #d4edda; color: #155724; border: 1px solid #c3e6cb; }
+        .button-container { text-align: center; margin-top: 20px; }
+        .button { display: inline-block; background-color: #007bff; color: white; padding: 14px 35px; border: none; border-radius: 5px; cursor: pointer; font-size: 1.1em; text-decoration: none; font-weight: 500; margin: 5px; }
+        .button:hover { background-color: #0056b3; }
+        .hidden { display: none; }
+        .streaming-output { background-color: #f8f9fa; border: 1px solid #dee2e6; border-radius: 5px; padding: 10px; max-height: 220px; overflow-y: auto; font-size: 0.85em; white-space: pre-wrap; }
+        .risk-list { list-style-type: none; padding: 0; }
+        .risk-list li { padding: 10px 12px; margin-bottom: 8px; border-radius: 5px; border-left: 6px solid #6c757d; background-color: #f8f9fa; }
+        .risk-list li.Rojo { border-left-color: #dc3545; }
+        .risk-list li.Ámbar { border-left-color: #ffc107; }
+        .risk-list li.Verde { border-left-color: #28a745; }
+        .footer { width: 100%; text-align: center; padding: 25px 0; font-size: 0.9em; color: #6c757d; margin-top:40px; border-top: 1px solid #dee2e6; }
+        .footer p { margin: 5px 0; }
+        .footer img.logo-itba-footer { max-height: 45px; margin-bottom: 10px; opacity: 0.9; }
+        .footer a { color: #007bff; text-decoration: none; }
+    </style>
+</head>
+<body>
+    <div class="main-container">
+        <h2>Análisis de Riesgos: {{ trabajo.descripcion }}</h2>
+
+        {% with messages = get_flashed_messages(with_categories=true) %}
+            {% if messages %}
+                <ul class="flash-messages">
+                {% for category, message in messages %}
+                    <li class="{{ category }}">{{ message }}</li>
+                {% endfor %}
+                </ul>
+            {% endif %}
+        {% endwith %}
+
+        <p class="stage" id="etapa">{{ trabajo.etapa }}</p>
+        <div class="progress-bar"><div class="progress-bar-fill" id="barra" style="width: {{ trabajo.progreso }}%;"></div></div>
+        <p id="progreso">{{ trabajo.progreso }}%</p>
+        <ul class="flash-messages" id="mensajes"></ul>
+
+        <div id="seccionRiesgos" class="hidden">
+            <h3>Riesgos identificados (en vivo)</h3>
+            <ul class="risk-list" id="riesgos"></ul>
+        </div>
+        <div id="seccionRespuesta" class="hidden">
+            <h3>Respuesta del modelo</h3>
+            <div class="streaming-output" id="respuestaLlm"></div>
+        </div>
+
+        <div class="button-container">
+            <a id="verDashboard" class="button hidden" href="{{ url_for('job_dashboard', job_id=trabajo.id) }}">Ver Dashboard</a>
+            <a id="descargarPdf" class="button hidden" href="{{ url_for('job_pdf', job_id=trabajo.id) }}">Descargar PDF</a>
+            <a class="button" href="{{ url_for('home') }}">Nuevo Análisis</a>
+        </div>
+    </div>
+    <div class="footer"> <img src="{{ url_for('static', filename='images/itba.png') }}" alt="Logo ITBA" class="logo-itba-footer">
+        <p>{{ footer_info.institucion_line1 }} - {{ footer_info.institucion_line2 }}</p>
+        <p><a href="{{ footer_info.github_repo_url }}" target="_blank">Ver Repositorio en GitHub</a></p>
+        <p>&copy; {{ CURRENT_YEAR }} Adriel J. Cuesta. Todos los derechos reservados.</p>
+    </div>
+
+    <script>
+        const urlEstado = "{{ url_for('job_status', job_id=trabajo.id) }}";
+
+        function mostrarMensajes(mensajes, error) {
+            const lista = document.getElementById('mensajes');
+            lista.innerHTML = '';
+            mensajes.forEach(function(texto) {
+                const li = document.createElement('li');
+                li.className = 'info';
+                li.textContent = texto;
+                lista.appendChild(li);
+            });
+            if (error) {
+                const li = document.createElement('li');
+                li.className = 'error';
+                li.textContent = error;
+                lista.appendChild(li);
+            }
+        }
+
+        function consultarEstado() {
+            fetch(urlEstado).then(function(respuesta) { return respuesta.json(); }).then(function(estado) {
+                document.getElementById('etapa').textContent = estado.etapa;
+                document.getElementById('barra').style.width = estado.progreso + '%';
+                document.getElementById('progreso').textContent = estado.progreso + '%';
+                mostrarMensajes(estado.mensajes, estado.error);
+                if (estado.estado === 'completado') {
+                    document.getElementById('verDashboard').classList.remove('hidden');
+                    if (estado.pdf_url) { document.getElementById('descargarPdf').classList.remove('hidden'); }
+                } else if (estado.estado !== 'error') {
+                    setTimeout(consultarEstado, 2000);
+                }
+            }).catch(function() { setTimeout(consultarEstado, 5000); });
+        }
+        function agregarRiesgo(riesgo) {
+            document.getElementById('seccionRiesgos').classList.remove('hidden');
+            const li = document.createElement('li');
+            li.className = riesgo.estado_RAG_sugerido || '';
+            const titulo = document.createElement('strong');
+            titulo.textContent = riesgo.descripcion_riesgo;
+            const detalle = document.createElement('div');
+            detalle.textContent = 'Impacto: ' + riesgo.impacto_estimado_llm + ' | Probabilidad: ' + riesgo.probabilidad_estimada_llm;
+            li.appendChild(titulo);
+            li.appendChild(detalle);
+            document.getElementById('riesgos').appendChild(li);
+        }
+
+        if (window.EventSource) {
+            // Eventos en vivo: progreso, tokens del LLM y riesgos a medida que se completan. Al terminar se consulta el estado final.
+            const eventos = new EventSource("{{ url_for('job_events', job_id=trabajo.id) }}");
+            eventos.addEventListener('progreso', function(e) {
+                const datos = JSON.parse(e.data);
+                document.getElementById('etapa').textContent = datos.etapa;
+                document.getElementById('barra').style.width = datos.progreso + '%';
+                document.getElementById('progreso').textContent = datos.progreso + '%';
+            });
+            eventos.addEventListener('token', function(e) {
+                const salida = document.getElementById('respuestaLlm');
+                document.getElementById('seccionRespuesta').classList.remove('hidden');
+                salida.textContent += JSON.parse(e.data).texto;
+                salida.scrollTop = salida.scrollHeight;
+            });
+            // Cliente rezagado cuyos tokens ya no están en el historial del servidor: todo el texto emitido hasta ahora
+            eventos.addEventListener('respuesta_completa', function(e) {
+                const salida = document.getElementById('respuestaLlm');
+                document.getElementById('seccionRespuesta').classList.remove('hidden');
+                salida.textContent = JSON.parse(e.data).texto;
+                salida.scrollTop = salida.scrollHeight;
+            });
+            eventos.addEventListener('riesgo', function(e) { agregarRiesgo(JSON.parse(e.data)); });
+            eventos.addEventListener('fin', function() {
+                eventos.close();
+                consultarEstado();
+            });
+        } else {
+            consultarEstado();
+        }
+    </script>
+</body>
+</html>
+"""
+
 @app.route('/')
 def home():
     app.logger.info("Acceso a la ruta de inicio ('/').")
@@ -392,42 +611,129 @@ def home():
                                   MAX_KB_FILES=MAX_KB_FILES, 
                                   MAX_KB_TOTAL_SIZE_MB=MAX_KB_TOTAL_SIZE_MB, 
                                   MAX_PROJECT_FILE_SIZE_MB=MAX_PROJECT_FILE_SIZE_MB,
+                                  colecciones_kb=[c for c in gestor_colecciones.listar() if not c["predeterminada"]] if gestor_colecciones else [],
                                   CURRENT_YEAR=CURRENT_YEAR)
 
+def _quiere_json():
+    return request.args.get('formato') == 'json' or request.accept_mimetypes.best == 'application/json'
+
+def _formatear_evento_sse(evento):
+    return f"id: {evento['id']}\nevent: {evento['tipo']}\ndata: {json.dumps(evento['datos'], ensure_ascii=False)}\n\n"
+
+def _ejecutar_trabajo_analisis(trabajo, espacio_trabajo, id_coleccion_kb, recrear_db, generar_pdf, forzar_reanalisis):
+    directorio_resultados = os.path.join(espacio_trabajo, "resultados")
+    ruta_pdf_proyecto = document_utils.obtener_ruta_pdf_proyecto(os.path.join(espacio_trabajo, "proyecto"))
+    if not ruta_pdf_proyecto:
+        return {"error": "No se encontró el PDF del proyecto en el espacio de trabajo del análisis."}
+
+    if id_coleccion_kb is None:
+        # PDFs subidos: si ya hay una colección con el mismo contenido se usa su base vectorial; si no, se indexa solo esta.
+        coleccion, nueva = gestor_colecciones.registrar_subida(os.path.join(espacio_trabajo, "kb"))
+        id_coleccion_kb = coleccion.id
+        trabajo.actualizar_progreso("Preparando base de conocimiento",
+                                    mensaje=f"Base de conocimiento {'nueva' if nueva else 'ya indexada'}: {id_coleccion_kb}")
+    try:
+        # Mientras el análisis la usa, la colección no se desaloja; la versión nueva de ChromaDB (si se sincroniza) se
+        # construye aparte y se publica al terminar, mientras los demás análisis siguen con la actual.
+        with gestor_colecciones.usar(id_coleccion_kb) as coleccion:
+            app.logger.info(f"[{trabajo.id}] Llamando a scripts.main.run_analysis() con colección '{coleccion.id}' y force_recreate_db={recrear_db}...")
+            dashboard_relative_path = run_analysis(force_recreate_db=recrear_db, callback_progreso=trabajo.actualizar_progreso,
+                                                   ruta_pdf_proyecto=ruta_pdf_proyecto, directorio_resultados=directorio_resultados,
+                                                   forzar_reanalisis=forzar_reanalisis, callback_evento=trabajo.publicar_evento,
+                                                   directorio_base_conocimiento=coleccion.directorio_documentos,
+                                                   chroma_db_path=coleccion.chroma_db_path, id_coleccion_kb=coleccion.id)
+            app.logger.info(f"[{trabajo.id}] run_analysis() completado. Ruta dashboard HTML: {dashboard_relative_path}")
+    except KeyError as e_coleccion: # Desalojada entre el envío del trabajo y su ejecución
+        return {"error": str(e_coleccion.args[0])}
+
+    if not dashboard_relative_path:
+        return {"error": "El proceso de análisis no generó un dashboard HTML. Revisa los logs del servidor para más detalles."}
+    dashboard_absolute_path = os.path.join(PROJECT_ROOT, dashboard_relative_path)
+    if not os.path.exists(dashboard_absolute_path):
+        app.logger.error(f"Dashboard HTML no encontrado en ruta absoluta: '{dashboard_absolute_path}'.")
+        return {"error": "Análisis completado, pero no se encontró el dashboard HTML."}
+
+    resultado = {"ruta_dashboard": dashboard_absolute_path, "id_coleccion_kb": id_coleccion_kb}
+    if generar_pdf:
+        trabajo.actualizar_progreso("Generando reporte PDF", 95)
+        try:
+            from scripts.pdf_utils import generate_pdf_from_html_file
+
+            pdf_filename = os.path.basename(dashboard_absolute_path).replace('.html', '.pdf')
+            pdf_absolute_path = os.path.join(os.path.dirname(dashboard_absolute_path), pdf_filename)
+            if generate_pdf_from_html_file(dashboard_absolute_path, pdf_absolute_path):
+                resultado["ruta_pdf"] = pdf_absolute_path
+            else:
+                trabajo.actualizar_progreso("Generando reporte PDF", mensaje="Se solicitó PDF, pero ocurrió un error durante su generación. Revise los logs del servidor.")
+        except ImportError:
+            app.logger.error("No se pudo importar WeasyPrint desde scripts.pdf_utils. ¿Está instalado WeasyPrint y el archivo pdf_utils.py existe?")
+            trabajo.actualizar_progreso("Generando reporte PDF", mensaje="Error: No se pudo generar el PDF. Falta la biblioteca WeasyPrint o sus dependencias, o el módulo pdf_utils.")
+        except Exception as e_pdf:
+            app.logger.error(f"Error en el proceso de generación de PDF: {e_pdf}")
+            app.logger.error(traceback.format_exc())
+            trabajo.actualizar_progreso("Generando reporte PDF", mensaje="Error al intentar generar el reporte PDF.")
+    return resultado
+
 @app.route('/analyze', methods=['POST'])
 def analyze_route():
     app.logger.info("Solicitud POST a /analyze recibida.")
 
-    if run_analysis is None or config is None:
+    if run_analysis is None or config is None or gestor_trabajos is None:
         app.logger.error("Intento de análisis, pero run_analysis/config no están disponibles.")
         flash("Error del servidor: La función de análisis o configuración no está cargada.", "error")
         return redirect(url_for('home'))
 
+    config.inicializar_directorios_datos()
+    # Los archivos subidos se guardan en el espacio de trabajo propio del análisis; los PDFs de KB pasan a su colección al ejecutarlo.
+    espacio_trabajo = tempfile.mkdtemp(prefix="analisis_", dir=config.DIRECTORIO_TRABAJOS)
+    try:
+        respuesta = _preparar_y_encolar_analisis(espacio_trabajo)
+    except Exception as e:
+        app.logger.error(f"Excepción inesperada en la ruta /analyze al preparar el análisis: {e}")
+        app.logger.error(traceback.format_exc())
+        flash(f"Ocurrió un error interno inesperado en el servidor: {str(e)}", "error")
+        respuesta = None
+    if respuesta is None:
+        shutil.rmtree(espacio_trabajo, ignore_errors=True)
+        return redirect(url_for('home'))
+    return respuesta
+
+def _preparar_y_encolar_analisis(espacio_trabajo):
+    """Valida el formulario y guarda los archivos. Devuelve la respuesta HTTP, o None para volver a la página de inicio."""
     # --- Lógica para Base de Conocimiento ---
     recreate_db_for_this_run = False 
+    id_coleccion_kb = colecciones_kb.ID_COLECCION_PREDETERMINADA # None = PDFs subidos, se resuelve al ejecutar el trabajo
     use_default_kb_checkbox = request.form.get('use_default_kb') == 'yes'
     kb_files_uploaded = request.files.getlist('kb_files')
-
-    if not use_default_kb_checkbox:
+    kb_id_solicitado = (request.form.get('kb_id') or '').strip()
+
+    if kb_id_solicitado and not use_default_kb_checkbox:
+        if gestor_colecciones.obtener(kb_id_solicitado) is None:
+            app.logger.warning(f"Colección de KB solicitada inexistente: '{kb_id_solicitado}'.")
+            flash(f"La base de conocimiento '{kb_id_solicitado}' ya no está disponible. Elija otra o vuelva a subir los PDFs.", "error")
+            return None
+        app.logger.info(f"Se usará la colección de KB '{kb_id_solicitado}' (ya indexada; los PDFs de KB subidos, si los hay, se ignoran).")
+        id_coleccion_kb = kb_id_solicitado
+    elif not use_default_kb_checkbox:
         actual_kb_files_to_save = [f for f in kb_files_uploaded if f and f.filename != '' and allowed_file(f.filename)]
         if actual_kb_files_to_save: 
             app.logger.info("Nuevos archivos de KB subidos y 'Usar por defecto' NO está marcado. Se procesarán estos archivos.")
             if len(actual_kb_files_to_save) > MAX_KB_FILES:
                 flash(f"Puede subir un máximo de {MAX_KB_FILES} archivos para la base de conocimiento.", "error")
-                return redirect(url_for('home'))
+                return None
             total_kb_size = sum(f.content_length for f in actual_kb_files_to_save)
             if total_kb_size > MAX_KB_TOTAL_SIZE_MB:
                 flash(f"El tamaño total de los archivos de la base de conocimiento no debe exceder {MAX_KB_TOTAL_SIZE_MB // (1024*1024)}MB.", "error")
-                return redirect(url_for('home'))
+                return None
 
-            clear_directory(config.DIRECTORIO_BASE_CONOCIMIENTO)
+            os.makedirs(os.path.join(espacio_trabajo, "kb"), exist_ok=True)
             for file in actual_kb_files_to_save:
                 filename = secure_filename(file.filename)
-                file.save(os.path.join(config.DIRECTORIO_BASE_CONOCIMIENTO, filename))
-            recreate_db_for_this_run = True
-            flash(f"{len(actual_kb_files_to_save)} archivo(s) de base de conocimiento guardado(s). La base de datos se recreará.", "success")
+                file.save(os.path.join(espacio_trabajo, "kb", filename))
+            id_coleccion_kb = None
+            flash(f"{len(actual_kb_files_to_save)} archivo(s) de base de conocimiento guardado(s). Si ya se usaron antes se reutilizará su base vectorial; si no, se indexarán en una colección nueva (la base por defecto no se modifica).", "success")
         else: 
-            app.logger.info("No se subieron nuevos archivos de KB, y 'Usar por defecto' NO está marcado para KB. Se intentará recrear la DB con el contenido actual de la carpeta BaseConocimiento.")
+            app.logger.info("No se subieron nuevos archivos de KB, y 'Usar por defecto' NO está marcado para KB. Se sincronizará la DB con el contenido actual de la carpeta BaseConocimiento (re-indexando solo los PDFs que cambiaron).")
             recreate_db_for_this_run = True 
     else: 
         app.logger.info("'Usar por defecto' ESTÁ marcado para KB. Se usará la DB existente. Los archivos de KB subidos (si los hay) serán ignorados.")
@@ -439,6 +745,7 @@ def analyze_route():
     project_file_uploaded = request.files.get('project_file')
     use_existing_project_file_checkbox = request.form.get('use_existing_project_file') == 'yes'
     can_proceed_with_project_file = False # Flag para saber si tenemos un archivo de proyecto válido
+    descripcion_proyecto = None
 
     if use_existing_project_file_checkbox:
         app.logger.info("'Utilizar documento previamente cargado' para Proyecto está marcado.")
@@ -446,96 +753,170 @@ def analyze_route():
             flash("Se seleccionó un archivo de proyecto, pero como 'Utilizar documento previamente cargado' está marcado, se ignorará y se usará el existente (si hay uno).", "info")
         
         try:
-            project_pdfs_in_dir = [f for f in os.listdir(config.DIRECTORIO_PROYECTO_ANALIZAR) if f.lower().endswith(".pdf")]
-            if not project_pdfs_in_dir:
-                flash("Seleccionó 'Utilizar documento previamente cargado', pero no se encontró ningún archivo de proyecto en el servidor. Por favor, suba uno o desmarque la casilla.", "error")
-                return redirect(url_for('home'))
-            if len(project_pdfs_in_dir) > 1:
-                 flash(f"Hay múltiples archivos ({len(project_pdfs_in_dir)}) en el directorio del proyecto y seleccionó 'Utilizar existente'. Solo debe haber uno. Por favor, corrija.", "error")
-                 return redirect(url_for('home'))
+            with _lock_proyecto_previo:
+                project_pdfs_in_dir = [f for f in os.listdir(config.DIRECTORIO_PROYECTO_ANALIZAR) if f.lower().endswith(".pdf")]
+                if not project_pdfs_in_dir:
+                    flash("Seleccionó 'Utilizar documento previamente cargado', pero no se encontró ningún archivo de proyecto en el servidor. Por favor, suba uno o desmarque la casilla.", "error")
+                    return None
+                if len(project_pdfs_in_dir) > 1:
+                     flash(f"Hay múltiples archivos ({len(project_pdfs_in_dir)}) en el directorio del proyecto y seleccionó 'Utilizar existente'. Solo debe haber uno. Por favor, corrija.", "error")
+                     return None
+                # Se copia al espacio de trabajo para que una subida posterior no cambie el PDF de este análisis.
+                os.makedirs(os.path.join(espacio_trabajo, "proyecto"), exist_ok=True)
+                shutil.copy2(os.path.join(config.DIRECTORIO_PROYECTO_ANALIZAR, project_pdfs_in_dir[0]),
+                             os.path.join(espacio_trabajo, "proyecto", project_pdfs_in_dir[0]))
             app.logger.info(f"Se usará el archivo de proyecto existente: {project_pdfs_in_dir[0]}")
+            descripcion_proyecto = project_pdfs_in_dir[0]
             can_proceed_with_project_file = True
         except FileNotFoundError: # Esto no debería pasar si config.inicializar_directorios_datos() funcionó
             app.logger.error(f"Directorio de proyecto no encontrado: {config.DIRECTORIO_PROYECTO_ANALIZAR}")
             flash("El directorio para el proyecto a analizar no existe. Error de configuración.", "error")
-            return redirect(url_for('home'))
+            return None
         except Exception as e_check: # Captura genérica para otros errores de OS al listar
             app.logger.error(f"Error al verificar archivo de proyecto existente en '{config.DIRECTORIO_PROYECTO_ANALIZAR}': {e_check}")
             flash("Error al verificar el archivo de proyecto en el servidor.", "error")
-            return redirect(url_for('home'))
+            return None
     else: # Casilla "Utilizar existente" NO está marcada para Proyecto
         app.logger.info("'Utilizar documento previamente cargado' para Proyecto NO está marcado. Se espera una nueva subida.")
         if project_file_uploaded and project_file_uploaded.filename != '':
             if allowed_file(project_file_uploaded.filename):
                 if project_file_uploaded.content_length > MAX_PROJECT_FILE_SIZE_MB:
                     flash(f"El archivo del proyecto no debe exceder {MAX_PROJECT_FILE_SIZE_MB // (1024*1024)}MB.", "error")
-                    return redirect(url_for('home'))
+                    return None
                 
-                clear_directory(config.DIRECTORIO_PROYECTO_ANALIZAR)
                 filename = secure_filename(project_file_uploaded.filename)
-                project_file_uploaded.save(os.path.join(config.DIRECTORIO_PROYECTO_ANALIZAR, filename))
+                os.makedirs(os.path.join(espacio_trabajo, "proyecto"), exist_ok=True)
+                ruta_proyecto_subido = os.path.join(espacio_trabajo, "proyecto", filename)
+                project_file_uploaded.save(ruta_proyecto_subido)
+                with _lock_proyecto_previo: # Queda disponible como "documento previamente cargado" para próximos análisis
+                    clear_directory(config.DIRECTORIO_PROYECTO_ANALIZAR)
+                    shutil.copy2(ruta_proyecto_subido, os.path.join(config.DIRECTORIO_PROYECTO_ANALIZAR, filename))
                 app.logger.info(f"Nuevo archivo de proyecto '{filename}' guardado.")
+                descripcion_proyecto = filename
                 flash(f"Nuevo archivo de proyecto '{filename}' guardado.", "success")
                 can_proceed_with_project_file = True
             else:
                 flash("Tipo de archivo no permitido para el proyecto. Solo PDF.", "error")
-                return redirect(url_for('home'))
+                return None
         else: 
             flash("No se subió un archivo para el proyecto a analizar. Por favor, suba un PDF o marque la casilla para usar uno existente.", "error")
-            return redirect(url_for('home'))
+            return None
 
     if not can_proceed_with_project_file:
         app.logger.error("Fallo en la lógica de determinar el archivo de proyecto. Redirigiendo a home.")
         # El mensaje flash específico ya se debería haber establecido arriba.
-        return redirect(url_for('home'))
+        return None
     # --- Fin Lógica Proyecto a Analizar ---
 
-    # --- Inicio del bloque try para el análisis y generación de PDF ---
-    try: # CORRECCIÓN DE INDENTACIÓN: Este try debe englobar la lógica de análisis
-        app.logger.info(f"Llamando a scripts.main.run_analysis() con force_recreate_db={recreate_db_for_this_run}...")
-        dashboard_relative_path = run_analysis(force_recreate_db=recreate_db_for_this_run)
-        app.logger.info(f"run_analysis() completado. Ruta dashboard HTML: {dashboard_relative_path}")
+    try:
+        trabajo = gestor_trabajos.enviar(
+            _ejecutar_trabajo_analisis,
+            descripcion=descripcion_proyecto,
+            limpieza=lambda: shutil.rmtree(espacio_trabajo, ignore_errors=True),
+            espacio_trabajo=espacio_trabajo,
+            id_coleccion_kb=id_coleccion_kb,
+            recrear_db=recreate_db_for_this_run,
+            generar_pdf=request.form.get('generate_pdf') == 'yes',
+            forzar_reanalisis=request.form.get('force_refresh') == 'yes'
+        )
+    except ColaLlenaError as e_cola:
+        app.logger.warning(f"Análisis rechazado: {e_cola}")
+        if _quiere_json():
+            return jsonify({"error": str(e_cola)}), 503
+        flash(f"El servidor está ocupado. {e_cola}", "error")
+        return None
+
+    if _quiere_json():
+        respuesta = jsonify({
+            "id": trabajo.id,
+            "estado_url": url_for('job_status', job_id=trabajo.id),
+            "eventos_url": url_for('job_events', job_id=trabajo.id),
+            "dashboard_url": url_for('job_dashboard', job_id=trabajo.id),
+            "pdf_url": url_for('job_pdf', job_id=trabajo.id)
+        })
+        return respuesta, 202, {"Location": url_for('job_status', job_id=trabajo.id)}
+    return redirect(url_for('job_page', job_id=trabajo.id))
+
+def _obtener_trabajo_o_404(job_id):
+    trabajo = gestor_trabajos.obtener(job_id) if gestor_trabajos else None
+    if trabajo is None:
+        abort(404)
+    return trabajo
+
+@app.route('/jobs/<job_id>')
+def job_page(job_id):
+    trabajo = _obtener_trabajo_o_404(job_id)
+    return render_template_string(JOB_PAGE_HTML,
+                                  trabajo=trabajo.a_dict(),
+                                  footer_info=FOOTER_INFO,
+                                  CURRENT_YEAR=CURRENT_YEAR)
 
-        if dashboard_relative_path:
-            dashboard_absolute_path = os.path.join(PROJECT_ROOT, dashboard_relative_path)
-            if os.path.exists(dashboard_absolute_path):
-                
-                generate_pdf_requested = request.form.get('generate_pdf') == 'yes'
-                if generate_pdf_requested:
-                    app.logger.info("Solicitud para generar PDF recibida.")
-                    try:
-                        from scripts.pdf_utils import generate_pdf_from_html_file 
-                        
-                        pdf_filename = os.path.basename(dashboard_absolute_path).replace('.html', '.pdf')
-                        pdf_absolute_path = os.path.join(os.path.dirname(dashboard_absolute_path), pdf_filename)
-                        
-                        if generate_pdf_from_html_file(dashboard_absolute_path, pdf_absolute_path):
-                            pdf_relative_path = os.path.join(os.path.dirname(dashboard_relative_path), pdf_filename)
-                            flash(f"Reporte PDF también generado: {pdf_relative_path}", "success")
-                        else:
-                            flash("Se solicitó PDF, pero ocurrió un error durante su generación. Revise los logs del servidor.", "error")
-                    except ImportError:
-                        app.logger.error("No se pudo importar WeasyPrint desde scripts.pdf_utils. ¿Está instalado WeasyPrint y el archivo pdf_utils.py existe?")
-                        flash("Error: No se pudo generar el PDF. Falta la biblioteca WeasyPrint o sus dependencias, o el módulo pdf_utils.", "error")
-                    except Exception as e_pdf:
-                        app.logger.error(f"Error en el proceso de generación de PDF: {e_pdf}")
-                        app.logger.error(traceback.format_exc())
-                        flash("Error al intentar generar el reporte PDF.", "error")
-                
-                return send_file(dashboard_absolute_path)
-            else:
-                app.logger.error(f"Dashboard HTML no encontrado en ruta absoluta: '{dashboard_absolute_path}'.")
-                flash(f"Error: Análisis completado, pero no se encontró el dashboard HTML.", "error")
-        else:
-            flash("El proceso de análisis no generó un dashboard HTML. Revisa los logs del servidor para más detalles.", "info")
-    
-    except Exception as e: # CORRECCIÓN DE INDENTACIÓN: Este except debe estar alineado con su try
-        app.logger.error(f"Excepción inesperada en la ruta /analyze durante el análisis o generación de PDF: {e}")
-        app.logger.error(traceback.format_exc())
-        flash(f"Ocurrió un error interno inesperado en el servidor: {str(e)}", "error")
-    # --- Fin del bloque try ---
-    
-    return redirect(url_for('home'))
+@app.route('/jobs/<job_id>/status')
+def job_status(job_id):
+    trabajo = _obtener_trabajo_o_404(job_id)
+    estado = trabajo.a_dict()
+    if trabajo.estado == ESTADO_COMPLETADO:
+        estado["dashboard_url"] = url_for('job_dashboard', job_id=job_id)
+        estado["kb_id"] = trabajo.resultado.get("id_coleccion_kb")
+        if trabajo.resultado.get("ruta_pdf"):
+            estado["pdf_url"] = url_for('job_pdf', job_id=job_id)
+    return jsonify(estado)
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-Sent Events del trabajo: progreso, tokens del LLM, riesgos completos, "respuesta_completa" para
+    clientes rezagados (ver Trabajo.esperar_eventos) y un evento final "fin"."""
+    trabajo = _obtener_trabajo_o_404(job_id)
+    try:
+        ultimo_id = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        ultimo_id = 0
+
+    def generar():
+        desde_id = ultimo_id
+        while True:
+            eventos = trabajo.esperar_eventos(desde_id, timeout=15)
+            if not eventos:
+                yield ": keep-alive\n\n" # Mantiene la conexión abierta a través de proxies mientras el LLM responde
+                continue
+            for evento in eventos:
+                yield _formatear_evento_sse(evento)
+            desde_id = eventos[-1]["id"]
+            if eventos[-1]["tipo"] == "fin":
+                return
+
+    return Response(stream_with_context(generar()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>/dashboard')
+def job_dashboard(job_id):
+    trabajo = _obtener_trabajo_o_404(job_id)
+    ruta = trabajo.resultado.get("ruta_dashboard")
+    if trabajo.estado != ESTADO_COMPLETADO or not ruta or not os.path.exists(ruta):
+        return jsonify({"error": "El dashboard de este análisis todavía no está disponible.", "estado": trabajo.estado}), 409
+    return send_file(ruta)
+
+@app.route('/jobs/<job_id>/pdf')
+def job_pdf(job_id):
+    trabajo = _obtener_trabajo_o_404(job_id)
+    ruta = trabajo.resultado.get("ruta_pdf")
+    if trabajo.estado != ESTADO_COMPLETADO or not ruta or not os.path.exists(ruta):
+        return jsonify({"error": "El reporte PDF de este análisis no está disponible.", "estado": trabajo.estado}), 409
+    return send_file(ruta, as_attachment=True)
+
+@app.route('/kb')
+def kb_collections():
+    """Colecciones de base de conocimiento disponibles; su `id` se envía como `kb_id` en POST /analyze."""
+    if gestor_colecciones is None:
+        abort(503)
+    return jsonify({"colecciones": gestor_colecciones.listar()})
+
+@app.route('/metrics')
+def metrics():
+    """Métricas de los análisis de este proceso en formato de texto de Prometheus (duración por etapa, tokens, caches)."""
+    if config is None:
+        abort(503)
+    return Response(metricas.obtener_agregador().exportar_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 if __name__ == '__main__':
     app.logger.info("Iniciando servidor Flask de desarrollo...")
@@ -0,0 +1,92 @@
+# scripts/ajustar_lotes_embeddings.py
+# Mide el throughput de embeddings (fragmentos/seg) del backend configurado para varios tamaños de lote, con y sin
+# agrupar los fragmentos por longitud en tokens, sobre fragmentos reales de la base de conocimiento. El mejor tamaño
+# de lote depende de la CPU/GPU de cada máquina: el resultado se fija con EMBEDDING_BATCH_SIZE.
+# Uso: python -m scripts.ajustar_lotes_embeddings [--tamanos-lote 8,16,32,64,128] [--max-fragmentos 2000] [--salida resultados.json]
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+
+from . import config
+from . import document_utils
+from .embeddings_por_lotes import EmbeddingsPorLongitud, obtener_tokenizador
+
+logger = logging.getLogger(__name__)
+
+def _crear_backend(batch_size):
+    if config.EMBEDDING_BACKEND == "onnx":
+        from .onnx_embeddings import OnnxSentenceEmbeddings
+        return OnnxSentenceEmbeddings(config.EMBEDDING_MODEL_NAME_OR_PATH, config.EMBEDDING_ONNX_PATH,
+                                      cache_folder=config.CACHE_DIR_HF, cuantizado=config.EMBEDDING_ONNX_CUANTIZADO,
+                                      batch_size=batch_size)
+    from langchain_community.embeddings import SentenceTransformerEmbeddings
+    return SentenceTransformerEmbeddings(model_name=config.EMBEDDING_MODEL_NAME_OR_PATH, model_kwargs={'device': 'cpu'},
+                                         cache_folder=config.CACHE_DIR_HF, encode_kwargs={'batch_size': batch_size})
+
+def _medir(embeddings, textos, repeticiones):
+    mejor = None
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        embeddings.embed_documents(textos)
+        duracion = time.perf_counter() - inicio
+        mejor = duracion if mejor is None else min(mejor, duracion)
+    return len(textos) / mejor
+
+def ajustar_lotes(tamanos_lote=(8, 16, 32, 64, 128), max_fragmentos=2000, repeticiones=2):
+    fragmentos = document_utils.cargar_y_procesar_pdfs_de_carpeta(
+        config.DIRECTORIO_BASE_CONOCIMIENTO, config.CHUNK_SIZE, config.CHUNK_OVERLAP)
+    textos = [f.page_content for f in fragmentos][:max_fragmentos]
+    if not textos:
+        logger.error("No hay fragmentos en la base de conocimiento para medir los tamaños de lote.")
+        return None
+    logger.info(f"Midiendo embeddings ({config.EMBEDDING_BACKEND}) con {len(textos)} fragmentos de "
+                f"'{config.DIRECTORIO_BASE_CONOCIMIENTO}'.")
+
+    resultados = {
+        "modelo": str(config.EMBEDDING_MODEL_NAME_OR_PATH),
+        "backend": config.EMBEDDING_BACKEND,
+        "num_fragmentos": len(textos),
+        "tamanos_lote": {}
+    }
+    for batch_size in tamanos_lote:
+        base = _crear_backend(batch_size)
+        tokenizer, max_seq_length = obtener_tokenizador(base)
+        base.embed_documents(textos[:8]) # Calentamiento
+        medidas = {}
+        for agrupar in (False, True):
+            envoltorio = EmbeddingsPorLongitud(base, tokenizer, max_seq_length, batch_size, agrupar)
+            throughput = _medir(envoltorio, textos, repeticiones)
+            medidas["agrupado" if agrupar else "sin_agrupar"] = {
+                "fragmentos_por_segundo": round(throughput, 2),
+                "fraccion_tokens_utiles": envoltorio.estadisticas()["fraccion_tokens_utiles"]
+            }
+        resultados["tamanos_lote"][str(batch_size)] = medidas
+        logger.info(f"batch_size={batch_size:4d} {medidas}")
+
+    mejor = max(resultados["tamanos_lote"].items(), key=lambda par: par[1]["agrupado"]["fragmentos_por_segundo"])
+    resultados["batch_size_recomendado"] = int(mejor[0])
+    return resultados
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Busca el tamaño de lote de embeddings más rápido en esta máquina.")
+    parser.add_argument("--tamanos-lote", default="8,16,32,64,128",
+                        help="Tamaños de lote a medir, separados por comas.")
+    parser.add_argument("--max-fragmentos", type=int, default=2000)
+    parser.add_argument("--repeticiones", type=int, default=2)
+    parser.add_argument("--salida", default=None, help="Ruta opcional para guardar los resultados en JSON.")
+    args = parser.parse_args()
+
+    tamanos = [int(t) for t in args.tamanos_lote.split(",") if t.strip()]
+    resultados = ajustar_lotes(tamanos, args.max_fragmentos, args.repeticiones)
+    if not resultados:
+        sys.exit(1)
+    logger.info(f"Tamaño de lote recomendado: EMBEDDING_BATCH_SIZE={resultados['batch_size_recomendado']}")
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
+        logger.info(f"Resultados guardados en: {os.path.abspath(args.salida)}")
@@ -0,0 +1,88 @@
+# scripts/benchmark_fragmentador.py
+# Micro-benchmark del fragmentador: RecursiveCharacterTextSplitter de LangChain frente a FragmentadorRecursivo sobre las
+# páginas de los PDFs de una carpeta (por defecto, la base de conocimiento), con los parámetros de la ingesta
+# (CHUNK_SIZE, CHUNK_OVERLAP, add_start_index). Comprueba además que ambos dan los mismos fragmentos y metadatos.
+# Uso: python -m scripts.benchmark_fragmentador [--carpeta datos/BaseConocimiento] [--repeticiones 3] [--salida resultados.json]
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from . import config
+from . import cache_texto_pdf
+from .fragmentador import FragmentadorRecursivo
+
+logger = logging.getLogger(__name__)
+
+def _medir(fragmentador, paginas, repeticiones):
+    mejor = None
+    fragmentos = None
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        fragmentos = [f for pagina in paginas for f in fragmentador.split_documents([pagina])] # Página a página, como la ingesta
+        duracion = time.perf_counter() - inicio
+        mejor = duracion if mejor is None else min(mejor, duracion)
+    return fragmentos, mejor
+
+def comparar_fragmentadores(carpeta, chunk_size, chunk_overlap, repeticiones=3):
+    paginas = []
+    for nombre in sorted(os.listdir(carpeta)) if os.path.isdir(carpeta) else []:
+        if nombre.lower().endswith(".pdf"):
+            paginas.extend(cache_texto_pdf.cargar_paginas_pdf(os.path.join(carpeta, nombre)))
+    if not paginas:
+        logger.error(f"No hay páginas con las que medir en '{carpeta}'.")
+        return None
+    caracteres = sum(len(p.page_content) for p in paginas)
+    logger.info(f"Fragmentando {len(paginas)} páginas ({caracteres} caracteres) de '{carpeta}' "
+                f"(chunk_size={chunk_size}, chunk_overlap={chunk_overlap}).")
+
+    langchain = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                               length_function=len, add_start_index=True)
+    nativo = FragmentadorRecursivo(chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True)
+    fragmentos_langchain, segundos_langchain = _medir(langchain, paginas, repeticiones)
+    fragmentos_nativo, segundos_nativo = _medir(nativo, paginas, repeticiones)
+    identicos = [(f.page_content, f.metadata) for f in fragmentos_langchain] == \
+                [(f.page_content, f.metadata) for f in fragmentos_nativo]
+    return {
+        "carpeta": os.path.abspath(carpeta),
+        "num_paginas": len(paginas),
+        "num_caracteres": caracteres,
+        "num_fragmentos": len(fragmentos_nativo),
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "fragmentadores": {
+            "langchain": {"segundos": round(segundos_langchain, 4),
+                          "paginas_por_segundo": round(len(paginas) / segundos_langchain, 2)},
+            "nativo": {"segundos": round(segundos_nativo, 4),
+                       "paginas_por_segundo": round(len(paginas) / segundos_nativo, 2)}
+        },
+        "aceleracion": round(segundos_langchain / segundos_nativo, 2),
+        "fragmentos_identicos": identicos
+    }
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Compara RecursiveCharacterTextSplitter con el fragmentador nativo.")
+    parser.add_argument("--carpeta", default=config.DIRECTORIO_BASE_CONOCIMIENTO)
+    parser.add_argument("--chunk-size", type=int, default=config.CHUNK_SIZE)
+    parser.add_argument("--chunk-overlap", type=int, default=config.CHUNK_OVERLAP)
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--salida", default=None, help="Ruta opcional para guardar los resultados en JSON.")
+    args = parser.parse_args()
+
+    resultados = comparar_fragmentadores(args.carpeta, args.chunk_size, args.chunk_overlap, args.repeticiones)
+    if not resultados:
+        sys.exit(1)
+    for nombre, medidas in resultados["fragmentadores"].items():
+        logger.info(f"{nombre:10s} {medidas}")
+    logger.info(f"Aceleración: x{resultados['aceleracion']}; fragmentos idénticos: {resultados['fragmentos_identicos']}")
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
+        logger.info(f"Resultados guardados en: {os.path.abspath(args.salida)}")
+    if not resultados["fragmentos_identicos"]:
+        sys.exit(1)
@@ -0,0 +1,259 @@
+# scripts/benchmark_pipeline.py
+# Benchmark de extremo a extremo del pipeline con PDFs sintéticos (base de conocimiento y proyecto de tamaño configurable):
+# mide por separado cada etapa de run_analysis (indexación de la base de conocimiento con vector_db_manager, con la
+# lectura y fragmentación, los embeddings, la inserción en ChromaDB y el índice BM25 tomados del registro de métricas;
+# recuperación, cadena RAG con el LLM simulado, parseo del JSON, dashboard y PDF) con su throughput y el pico de memoria.
+# Todo se genera en una carpeta temporal; los datos de datos/ no se tocan.
+# Uso: python -m scripts.benchmark_pipeline [--paginas-kb 100] [--paginas-proyecto 10] [--salida resultados.json]
+#                                          [--baseline baseline.json] [--guardar-baseline baseline.json]
+# Con --baseline termina con código 1 si alguna etapa pierde más de --tolerancia de throughput o sube el pico de memoria.
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import logging
+import fitz # PyMuPDF
+
+from . import config
+from . import document_utils
+from . import vector_db_manager
+from . import rag_components
+from . import report_utils
+from . import dashboard_generator
+from . import metricas
+from . import bm25_index
+from .llm_simulado import ChatSimulado
+from .metricas import pico_memoria_mb
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_VERSION = 2 # 2: la indexación se mide con vector_db_manager y el registro de métricas
+TOLERANCIA_POR_DEFECTO = 0.2
+
+_TERMINOS = [
+    "instalación", "maquinaria", "torno", "fresadora", "cimentación", "anclaje", "nivelación", "alimentación eléctrica",
+    "cuadro de control", "puesta en marcha", "proveedor", "cronograma", "presupuesto", "riesgo", "mitigación",
+    "interesados", "alcance", "calidad", "seguridad", "izaje", "grúa", "vibraciones", "tolerancias", "mantenimiento",
+    "formación del personal", "documentación técnica", "aceptación", "pruebas FAT", "pruebas SAT", "marcado CE",
+    "ISO-9001", "cláusula 4.2.1", "TRF-B114", "PMBOK", "lecciones aprendidas", "contingencia", "subcontratista"
+]
+_PLANTILLAS_FRASE = [
+    "El plan de {0} debe considerar la {1} antes de iniciar la {2}.",
+    "Según el registro de {0}, la {1} afectó a la {2} en proyectos anteriores.",
+    "Se recomienda revisar {0} y {1} con el {2} durante la fase de ejecución.",
+    "La falta de {0} puede provocar retrasos en {1} y sobrecostes de {2}.",
+    "El equipo verificó {0}, {1} y {2} conforme a la norma aplicable."
+]
+
+def _texto_pagina(generador, caracteres_por_pagina):
+    frases = []
+    longitud = 0
+    while longitud < caracteres_por_pagina:
+        frase = generador.choice(_PLANTILLAS_FRASE).format(*generador.sample(_TERMINOS, 3))
+        frases.append(frase)
+        longitud += len(frase) + 1
+    return " ".join(frases)
+
+def generar_pdf_sintetico(ruta_pdf, num_paginas, semilla=0, caracteres_por_pagina=2500):
+    """PDF con texto determinista del dominio (instalación de maquinaria, PMBOK) de `num_paginas` páginas."""
+    generador = random.Random(semilla)
+    documento = fitz.open()
+    for _ in range(num_paginas):
+        pagina = documento.new_page()
+        pagina.insert_textbox(fitz.Rect(40, 40, pagina.rect.width - 40, pagina.rect.height - 40),
+                              _texto_pagina(generador, caracteres_por_pagina), fontsize=8)
+    documento.save(ruta_pdf)
+    documento.close()
+
+class _Cronometro:
+    def __init__(self):
+        self.etapas = {}
+
+    def medir(self, nombre, funcion, cantidad=None, unidad=None):
+        inicio = time.perf_counter()
+        resultado = funcion()
+        segundos = time.perf_counter() - inicio
+        etapa = {"segundos": round(segundos, 4), "pico_memoria_mb": pico_memoria_mb()}
+        if cantidad is not None:
+            cantidad = cantidad(resultado) if callable(cantidad) else cantidad
+            etapa.update(cantidad=cantidad, unidad=unidad, throughput=round(cantidad / segundos, 3) if segundos > 0 else None)
+        self.etapas[nombre] = etapa
+        logger.info(f"  {nombre:24s} {segundos:9.3f} s" + (f"  {etapa['throughput']} {unidad}/s" if cantidad is not None else ""))
+        return resultado
+
+    def registrar(self, nombre, segundos, cantidad, unidad):
+        # Etapas medidas dentro de vector_db_manager (registro de métricas), que aquí no se pueden cronometrar por separado
+        if not segundos:
+            return
+        self.etapas[nombre] = {"segundos": round(segundos, 4), "pico_memoria_mb": pico_memoria_mb(), "cantidad": cantidad,
+                               "unidad": unidad, "throughput": round(cantidad / segundos, 3)}
+        logger.info(f"  {nombre:24s} {segundos:9.3f} s  {self.etapas[nombre]['throughput']} {unidad}/s")
+
+def ejecutar_benchmark(paginas_kb=100, num_pdfs_kb=4, paginas_proyecto=10, consultas=10, directorio_trabajo=None,
+                       generar_pdf=True, conservar=False):
+    directorio = directorio_trabajo or tempfile.mkdtemp(prefix="benchmark_pipeline_")
+    dir_kb = os.path.join(directorio, "BaseConocimiento")
+    dir_chroma = os.path.join(directorio, "ChromaDB")
+    dir_resultados = os.path.join(directorio, "Resultados")
+    for ruta in (dir_kb, dir_chroma, dir_resultados):
+        os.makedirs(ruta, exist_ok=True)
+    cronometro = _Cronometro()
+    registro = metricas.RegistroAnalisis(benchmark=True)
+    vector_db = None
+    try:
+        logger.info(f"Generando corpus sintético en '{directorio}'...")
+        paginas_por_pdf = [paginas_kb // num_pdfs_kb + (1 if i < paginas_kb % num_pdfs_kb else 0) for i in range(num_pdfs_kb)]
+        rutas_kb = []
+        for i, num_paginas in enumerate(p for p in paginas_por_pdf if p > 0):
+            rutas_kb.append(os.path.join(dir_kb, f"kb_sintetico_{i + 1}.pdf"))
+            generar_pdf_sintetico(rutas_kb[-1], num_paginas, semilla=i + 1)
+        ruta_proyecto = os.path.join(directorio, "proyecto_sintetico.pdf")
+        generar_pdf_sintetico(ruta_proyecto, paginas_proyecto, semilla=1000)
+
+        # Las caches de embeddings y de texto de PDFs harían que las ejecuciones repetidas no midan el modelo ni el parser
+        config.EMBEDDING_CACHE_HABILITADA = False
+        config.CACHE_TEXTO_PDF_HABILITADA = False
+        embedding_function = vector_db_manager.get_embedding_function(config.EMBEDDING_MODEL_NAME_OR_PATH)
+        if embedding_function is None:
+            logger.error("No se pudo inicializar el modelo de embeddings para el benchmark.")
+            return None
+        embedding_function.embed_documents(["calentamiento"])
+
+        logger.info("Etapas:")
+        with metricas.registro_activo(registro):
+            # El mismo camino que run_analysis: document_utils lee y fragmenta, vector_db_manager embebe, inserta y
+            # guarda el índice BM25 en la versión nueva antes de publicarla
+            vector_db = cronometro.medir("indexacion_kb", lambda: vector_db_manager.crear_o_cargar_chroma_db(
+                dir_chroma, dir_kb, embedding_function, config.CHUNK_SIZE, config.CHUNK_OVERLAP, True,
+                num_procesos_ingesta=config.NUM_PROCESOS_INGESTA), cantidad=paginas_kb, unidad="paginas")
+        if vector_db is None:
+            logger.error("No se pudo indexar la base de conocimiento sintética.")
+            return None
+        num_fragmentos = vector_db._collection.count()
+        contadores = registro.finalizar(metricas.ESTADO_COMPLETADO)["contadores"]
+        cronometro.registrar("carga_y_fragmentacion", contadores.get("segundos_lectura_pdfs"),
+                             contadores.get("paginas_leidas", 0), "paginas")
+        cronometro.registrar("embeddings", contadores.get("segundos_embeddings"),
+                             contadores.get("fragmentos_embebidos", 0), "fragmentos")
+        cronometro.registrar("embeddings_e_insercion", contadores.get("segundos_indexacion"),
+                             contadores.get("fragmentos_indexados", 0), "fragmentos")
+        cronometro.registrar("indice_bm25", registro.etapas.get("indice_bm25"), num_fragmentos, "fragmentos")
+
+        indice_bm25 = None
+        if config.RECUPERACION_HIBRIDA:
+            indice_bm25 = cronometro.medir("carga_indice_bm25", lambda: bm25_index.cargar_o_construir_indice_bm25(
+                vector_db, vector_db._persist_directory, vector_db_manager.obtener_huella_kb(dir_chroma)),
+                cantidad=num_fragmentos, unidad="fragmentos")
+
+        descripcion = cronometro.medir("procesamiento_proyecto", lambda: document_utils.procesar_pdf_proyecto_para_analisis(
+            ruta_proyecto, config.CHUNK_SIZE, config.CHUNK_OVERLAP, config.MAX_CHARS_PROYECTO), cantidad=paginas_proyecto, unidad="paginas")
+        llm = ChatSimulado(latencia_segundos=0, segundos_por_fragmento=0)
+        qa_chain = rag_components.crear_cadena_rag(
+            llm, vector_db, config.K_RETRIEVED_DOCS, indice_bm25=indice_bm25, k_candidatos=config.K_CANDIDATOS_HIBRIDOS,
+            presupuesto_tokens_prompt=config.PRESUPUESTO_TOKENS_PROMPT if config.EMPAQUETADO_CONTEXTO else None,
+            k_candidatos_contexto=config.K_CANDIDATOS_CONTEXTO, min_tokens_contexto=config.MIN_TOKENS_CONTEXTO)
+        if qa_chain is None:
+            logger.error("No se pudo crear la cadena RAG para el benchmark.")
+            return None
+        generador = random.Random(0)
+        consultas_texto = [_texto_pagina(generador, 600) for _ in range(consultas)]
+        cronometro.medir("recuperacion", lambda: [qa_chain.retriever.invoke(c) for c in consultas_texto],
+                         cantidad=consultas, unidad="consultas")
+        respuesta = cronometro.medir("cadena_rag_llm_simulado", lambda: qa_chain.invoke({"query": descripcion}),
+                                     cantidad=1, unidad="analisis")
+
+        fuentes = [{"documento_fuente": d.metadata.get("source_document", "N/A"), "pagina": d.metadata.get("page_number", "N/A"),
+                    "contenido_fragmento": d.page_content[:250] + "..."} for d in respuesta.get("source_documents", [])]
+        ruta_json = cronometro.medir("parseo_json", lambda: report_utils.formatear_y_guardar_reporte(
+            respuesta.get("result", ""), fuentes, os.path.basename(ruta_proyecto), "llm-simulado", dir_resultados))
+        ruta_dashboard = os.path.join(dir_resultados, "dashboard.html")
+        cronometro.medir("dashboard", lambda: dashboard_generator.generar_dashboard_html(
+            ruta_json, ruta_dashboard, [os.path.basename(r) for r in rutas_kb]))
+        if generar_pdf:
+            try:
+                from .pdf_utils import generate_pdf_from_html_file
+                cronometro.medir("pdf", lambda: generate_pdf_from_html_file(ruta_dashboard, os.path.join(dir_resultados, "reporte.pdf")))
+            except ImportError as e:
+                logger.warning(f"Etapa PDF omitida: WeasyPrint no está disponible ({e}).")
+
+        return {
+            "version": BENCHMARK_VERSION,
+            "parametros": {"paginas_kb": paginas_kb, "num_pdfs_kb": num_pdfs_kb, "paginas_proyecto": paginas_proyecto,
+                           "consultas": consultas, "chunk_size": config.CHUNK_SIZE, "chunk_overlap": config.CHUNK_OVERLAP,
+                           "recuperacion_hibrida": config.RECUPERACION_HIBRIDA, "empaquetado_contexto": config.EMPAQUETADO_CONTEXTO},
+            "entorno": {"python": platform.python_version(), "plataforma": platform.platform(),
+                        "modelo_embeddings": str(config.EMBEDDING_MODEL_NAME_OR_PATH), "backend_embeddings": config.EMBEDDING_BACKEND},
+            "fragmentos": num_fragmentos,
+            "etapas": cronometro.etapas,
+            "contadores": contadores,
+            "pico_memoria_mb": pico_memoria_mb()
+        }
+    finally:
+        if vector_db is not None:
+            vector_db_manager.liberar_version(vector_db._persist_directory)
+        if not conservar and not directorio_trabajo:
+            vector_db_manager.cerrar_base_vectorial(dir_chroma)
+            shutil.rmtree(directorio, ignore_errors=True)
+
+def comparar_con_baseline(resultados, baseline, tolerancia=TOLERANCIA_POR_DEFECTO, tolerancia_memoria=TOLERANCIA_POR_DEFECTO):
+    """Devuelve la lista de regresiones: throughput (o tiempo, si la etapa no tiene throughput) y pico de memoria."""
+    if baseline.get("version") != resultados.get("version"):
+        logger.warning("El baseline es de otra versión del benchmark; solo se comparan las etapas que tienen en común.")
+    if baseline.get("parametros") != resultados.get("parametros"):
+        logger.warning("Los parámetros del baseline no coinciden con los de esta ejecución; la comparación es orientativa.")
+    regresiones = []
+    for nombre, referencia in baseline.get("etapas", {}).items():
+        actual = resultados["etapas"].get(nombre)
+        if actual is None:
+            continue
+        if referencia.get("throughput") and actual.get("throughput") is not None:
+            if actual["throughput"] < referencia["throughput"] * (1 - tolerancia):
+                regresiones.append(f"{nombre}: throughput {actual['throughput']} {actual['unidad']}/s "
+                                   f"< baseline {referencia['throughput']} (-{tolerancia:.0%} permitido)")
+        elif referencia.get("segundos") and actual["segundos"] > referencia["segundos"] * (1 + tolerancia):
+            regresiones.append(f"{nombre}: {actual['segundos']} s > baseline {referencia['segundos']} s (+{tolerancia:.0%} permitido)")
+    if baseline.get("pico_memoria_mb") and resultados.get("pico_memoria_mb") and \
+       resultados["pico_memoria_mb"] > baseline["pico_memoria_mb"] * (1 + tolerancia_memoria):
+        regresiones.append(f"pico de memoria: {resultados['pico_memoria_mb']} MB > baseline {baseline['pico_memoria_mb']} MB "
+                           f"(+{tolerancia_memoria:.0%} permitido)")
+    return regresiones
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Benchmark por etapas del pipeline RAG con PDFs sintéticos.")
+    parser.add_argument("--paginas-kb", type=int, default=100, help="Páginas totales de la base de conocimiento (10 a 10000).")
+    parser.add_argument("--num-pdfs-kb", type=int, default=4)
+    parser.add_argument("--paginas-proyecto", type=int, default=10)
+    parser.add_argument("--consultas", type=int, default=10, help="Consultas para medir la recuperación.")
+    parser.add_argument("--sin-pdf", action="store_true", help="Omite la etapa de generación del PDF (WeasyPrint).")
+    parser.add_argument("--directorio-trabajo", default=None, help="Carpeta para el corpus y la DB (por defecto, temporal).")
+    parser.add_argument("--salida", default=None, help="Ruta opcional para guardar los resultados en JSON.")
+    parser.add_argument("--baseline", default=None, help="JSON de una ejecución anterior con el que comparar.")
+    parser.add_argument("--guardar-baseline", default=None, help="Guarda esta ejecución como baseline en la ruta indicada.")
+    parser.add_argument("--tolerancia", type=float, default=TOLERANCIA_POR_DEFECTO, help="Pérdida de throughput permitida (0.2 = 20%%).")
+    parser.add_argument("--tolerancia-memoria", type=float, default=TOLERANCIA_POR_DEFECTO)
+    args = parser.parse_args()
+
+    resultados = ejecutar_benchmark(args.paginas_kb, args.num_pdfs_kb, args.paginas_proyecto, args.consultas,
+                                    args.directorio_trabajo, generar_pdf=not args.sin_pdf)
+    if not resultados:
+        sys.exit(1)
+    for ruta in (args.salida, args.guardar_baseline):
+        if ruta:
+            with open(ruta, 'w', encoding='utf-8') as f:
+                json.dump(resultados, f, ensure_ascii=False, indent=2)
+            logger.info(f"Resultados guardados en: {os.path.abspath(ruta)}")
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regresiones = comparar_con_baseline(resultados, json.load(f), args.tolerancia, args.tolerancia_memoria)
+        if regresiones:
+            for regresion in regresiones:
+                logger.error(f"REGRESIÓN {regresion}")
+            sys.exit(1)
+        logger.info("Sin regresiones respecto al baseline.")
@@ -0,0 +1,217 @@
+# scripts/bm25_index.py
+import os
+import re
+import json
+import time
+import unicodedata
+from collections import Counter
+import logging
+import traceback
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+logger = logging.getLogger(__name__)
+
+BM25_INDEX_FILENAME = "bm25_index.npz"
+BM25_INDEX_VERSION = 1
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60 # Constante habitual de reciprocal rank fusion
+
+# Palabras y códigos: "ISO-9001", "4.2.1" o "TRF-B114" se conservan completos y además se indexan sus partes,
+# así una consulta "ISO 9001" también los encuentra.
+_PATRON_TERMINO = re.compile(r"[a-z0-9]+(?:[.\-/_][a-z0-9]+)*")
+_PATRON_PARTES = re.compile(r"[a-z0-9]+")
+
+def tokenizar(texto):
+    sin_acentos = unicodedata.normalize("NFKD", texto.lower()).encode("ascii", "ignore").decode("ascii")
+    terminos = _PATRON_TERMINO.findall(sin_acentos)
+    compuestos = [t for t in terminos if not t.isalnum()]
+    for termino in compuestos:
+        terminos.extend(_PATRON_PARTES.findall(termino))
+    return terminos
+
+class ConstructorIndiceBM25:
+    """
+    Acumula las listas de apariciones lote a lote (p. ej. mientras se indexa la base vectorial) y al final calcula los
+    pesos BM25, que dependen de la colección entera (idf y longitud media). De cada lote solo se guardan arrays de numpy.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.vocabulario = {}
+        self._terminos = []
+        self._documentos = []
+        self._frecuencias = []
+        self._longitudes = []
+
+    def agregar(self, ids, textos):
+        filas_terminos, filas_documentos, frecuencias = [], [], []
+        longitudes = np.zeros(len(textos), dtype=np.float32)
+        for posicion, texto in enumerate(textos):
+            terminos = tokenizar(texto or "")
+            longitudes[posicion] = len(terminos)
+            conteo = Counter(terminos)
+            filas_terminos.extend(self.vocabulario.setdefault(termino, len(self.vocabulario)) for termino in conteo)
+            filas_documentos.extend([len(self.ids) + posicion] * len(conteo))
+            frecuencias.extend(conteo.values())
+        self.ids.extend(ids)
+        self._terminos.append(np.asarray(filas_terminos, dtype=np.int64))
+        self._documentos.append(np.asarray(filas_documentos, dtype=np.int32))
+        self._frecuencias.append(np.asarray(frecuencias, dtype=np.float32))
+        self._longitudes.append(longitudes)
+
+    def construir(self, huella_kb=None):
+        vacio = [np.zeros(0)]
+        filas_terminos = np.concatenate(self._terminos or vacio).astype(np.int64, copy=False)
+        filas_documentos = np.concatenate(self._documentos or vacio).astype(np.int32, copy=False)
+        frecuencias = np.concatenate(self._frecuencias or vacio).astype(np.float32, copy=False)
+        longitudes = np.concatenate(self._longitudes or vacio).astype(np.float32, copy=False)
+        orden = np.argsort(filas_terminos, kind="stable")
+        filas_terminos, filas_documentos, frecuencias = filas_terminos[orden], filas_documentos[orden], frecuencias[orden]
+
+        conteo_docs = np.bincount(filas_terminos, minlength=len(self.vocabulario))
+        indptr = np.zeros(len(self.vocabulario) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(conteo_docs)
+        docs_por_termino = conteo_docs.astype(np.float32)
+        num_docs = max(len(self.ids), 1)
+        idf = np.log(1.0 + (num_docs - docs_por_termino + 0.5) / (docs_por_termino + 0.5))
+        longitud_media = float(longitudes.mean()) if len(self.ids) else 1.0
+        normalizacion = BM25_K1 * (1 - BM25_B + BM25_B * longitudes[filas_documentos] / max(longitud_media, 1e-9))
+        pesos = (idf[filas_terminos] * frecuencias * (BM25_K1 + 1) / (frecuencias + normalizacion)).astype(np.float32)
+        return IndiceBM25(self.ids, self.vocabulario, indptr, filas_documentos, pesos, huella_kb)
+
+class IndiceBM25:
+    """
+    Índice invertido BM25 en memoria. Las listas de apariciones se guardan en formato CSR (indptr, documentos, pesos)
+    con el peso BM25 de cada (término, fragmento) ya calculado, así una consulta solo suma pesos con numpy.
+    `ids` son los ids de los fragmentos en la colección de ChromaDB.
+    """
+
+    def __init__(self, ids, vocabulario, indptr, documentos, pesos, huella_kb=None):
+        self.ids = list(ids)
+        self.vocabulario = vocabulario # término -> posición en indptr
+        self.indptr = indptr
+        self.documentos = documentos
+        self.pesos = pesos
+        self.huella_kb = huella_kb
+
+    @classmethod
+    def construir(cls, ids, textos, huella_kb=None):
+        constructor = ConstructorIndiceBM25()
+        constructor.agregar(ids, textos)
+        return constructor.construir(huella_kb)
+
+    def buscar(self, consulta, k):
+        """Devuelve [(id_fragmento, puntuación)] de los k fragmentos con mayor puntuación BM25 para la consulta."""
+        if not self.ids:
+            return []
+        puntuaciones = np.zeros(len(self.ids), dtype=np.float32)
+        for termino in set(tokenizar(consulta)):
+            posicion = self.vocabulario.get(termino)
+            if posicion is None:
+                continue
+            inicio, fin = self.indptr[posicion], self.indptr[posicion + 1]
+            puntuaciones[self.documentos[inicio:fin]] += self.pesos[inicio:fin] # Sin repetidos dentro de una lista
+        k = min(k, len(self.ids))
+        mejores = np.argpartition(-puntuaciones, k - 1)[:k]
+        mejores = mejores[np.argsort(-puntuaciones[mejores])]
+        return [(self.ids[i], float(puntuaciones[i])) for i in mejores if puntuaciones[i] > 0]
+
+    def guardar(self, ruta):
+        ruta_tmp = ruta + ".tmp.npz"
+        terminos = sorted(self.vocabulario, key=self.vocabulario.get)
+        np.savez(ruta_tmp, ids=np.asarray(self.ids, dtype=str), terminos=np.asarray(terminos, dtype=str),
+                 indptr=self.indptr, documentos=self.documentos, pesos=self.pesos,
+                 meta=np.asarray(json.dumps({"version": BM25_INDEX_VERSION, "huella_kb": self.huella_kb})))
+        os.replace(ruta_tmp, ruta)
+
+    @classmethod
+    def cargar(cls, ruta):
+        with np.load(ruta, allow_pickle=False) as datos:
+            meta = json.loads(str(datos["meta"]))
+            if meta.get("version") != BM25_INDEX_VERSION:
+                return None
+            terminos = datos["terminos"].tolist()
+            return cls(datos["ids"].tolist(), {t: i for i, t in enumerate(terminos)},
+                       datos["indptr"], datos["documentos"], datos["pesos"], meta.get("huella_kb"))
+
+def cargar_indice_bm25(chroma_db_path, huella_kb):
+    """Índice BM25 guardado en la carpeta de la base vectorial, si corresponde a la huella de su manifest; si no, None."""
+    ruta_indice = os.path.join(chroma_db_path, BM25_INDEX_FILENAME)
+    if not huella_kb or not os.path.exists(ruta_indice):
+        return None
+    try:
+        indice = IndiceBM25.cargar(ruta_indice)
+    except Exception as e:
+        logger.warning(f"No se pudo leer el índice BM25 '{ruta_indice}': {e}")
+        logger.debug(traceback.format_exc())
+        return None
+    if indice is None or indice.huella_kb != huella_kb:
+        return None
+    logger.info(f"Índice BM25 cargado desde '{ruta_indice}' ({len(indice.ids)} fragmentos, {len(indice.vocabulario)} términos).")
+    return indice
+
+def cargar_o_construir_indice_bm25(vector_db, chroma_db_path, huella_kb):
+    """
+    Carga el índice BM25 que vector_db_manager guarda en cada versión de la base vectorial al indexarla. Solo si no lo
+    hay (DB sin manifest, del formato anterior, o indexada con la recuperación híbrida desactivada) se construye aquí
+    leyendo todos los fragmentos de la colección; con manifest se guarda para las siguientes cargas. None si falla.
+    """
+    indice = cargar_indice_bm25(chroma_db_path, huella_kb)
+    if indice is not None:
+        return indice
+    ruta_indice = os.path.join(chroma_db_path, BM25_INDEX_FILENAME)
+    try:
+        logger.warning(f"La base vectorial '{chroma_db_path}' no tiene un índice BM25 vigente; se construirá a partir de la colección.")
+        inicio = time.time()
+        contenido = vector_db.get(include=["documents"])
+        indice = IndiceBM25.construir(contenido["ids"], contenido["documents"], huella_kb)
+        if huella_kb: # Sin manifest no se puede saber si el índice sigue vigente; se reconstruye en cada carga
+            indice.guardar(ruta_indice)
+        logger.info(f"Índice BM25 construido con {len(indice.ids)} fragmentos y {len(indice.vocabulario)} términos "
+                    f"en {time.time() - inicio:.2f} segundos.")
+        return indice
+    except Exception as e:
+        logger.error(f"Error al construir el índice BM25 en '{ruta_indice}': {e}")
+        logger.debug(traceback.format_exc())
+        return None
+
+class RetrieverHibrido(BaseRetriever):
+    """
+    Recuperación híbrida: búsqueda densa en ChromaDB y BM25 sobre los mismos fragmentos, combinadas con
+    reciprocal rank fusion (suma de 1 / (RRF_K + posición) en cada lista) usando el id del fragmento.
+    """
+
+    vector_db: object
+    indice_bm25: object
+    k: int = 3
+    k_candidatos: int = 20
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        coleccion = self.vector_db._collection
+        densos = coleccion.query(query_embeddings=[self.vector_db._embedding_function.embed_query(query)],
+                                 n_results=self.k_candidatos, include=["documents", "metadatas"])
+        documentos = {}
+        puntuaciones = {}
+        for posicion, (id_fragmento, texto, metadata) in enumerate(zip(densos["ids"][0], densos["documents"][0], densos["metadatas"][0])):
+            documentos[id_fragmento] = Document(page_content=texto, metadata=metadata or {}, id=id_fragmento)
+            puntuaciones[id_fragmento] = 1.0 / (RRF_K + posicion + 1)
+
+        resultados_bm25 = self.indice_bm25.buscar(query, self.k_candidatos)
+        for posicion, (id_fragmento, _) in enumerate(resultados_bm25):
+            puntuaciones[id_fragmento] = puntuaciones.get(id_fragmento, 0.0) + 1.0 / (RRF_K + posicion + 1)
+
+        seleccionados = sorted(puntuaciones, key=puntuaciones.get, reverse=True)[:self.k]
+        faltantes = [i for i in seleccionados if i not in documentos] # Solo encontrados por BM25
+        if faltantes:
+            contenido = coleccion.get(ids=faltantes, include=["documents", "metadatas"])
+            for id_fragmento, texto, metadata in zip(contenido["ids"], contenido["documents"], contenido["metadatas"]):
+                documentos[id_fragmento] = Document(page_content=texto, metadata=metadata or {}, id=id_fragmento)
+        return [documentos[i] for i in seleccionados if i in documentos]
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo bm25_index.py cargado.")
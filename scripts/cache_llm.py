@@ -0,0 +1,159 @@
+# scripts/cache_llm.py
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import contextvars
+from contextlib import contextmanager
+import logging
+import traceback
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration
+from langchain_core.prompt_values import StringPromptValue
+
+logger = logging.getLogger(__name__)
+
+CACHE_LLM_FILENAME = "respuestas_llm.sqlite3"
+
+# "Forzar nuevo análisis" debe volver a llamar al LLM: dentro de omitir_lectura() la cache no devuelve
+# respuestas guardadas pero sí guarda las nuevas. Es una ContextVar porque el LLM se comparte entre análisis concurrentes.
+_omitir_lectura = contextvars.ContextVar("omitir_lectura_cache_llm", default=False)
+
+@contextmanager
+def omitir_lectura(activo=True):
+    token = _omitir_lectura.set(bool(activo))
+    try:
+        yield
+    finally:
+        _omitir_lectura.reset(token)
+
+class CacheLLMSQLite(BaseCache):
+    """
+    Cache persistente de respuestas del LLM en SQLite, para el parámetro `cache` de los modelos de LangChain.
+    La clave es el hash del prompt ya renderizado (proyecto + contexto) junto con el llm_string de LangChain, que
+    incluye modelo, temperatura y demás parámetros. Las entradas caducan a los `ttl_segundos` y, si la cache supera
+    `max_bytes`, se eliminan las usadas hace más tiempo. Los contadores se consultan con `estadisticas()`.
+    """
+
+    def __init__(self, directorio_cache, ttl_segundos=7 * 24 * 3600, max_bytes=100 * 1024 * 1024):
+        os.makedirs(directorio_cache, exist_ok=True)
+        self.ruta_db = os.path.join(directorio_cache, CACHE_LLM_FILENAME)
+        self.ttl_segundos = ttl_segundos
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._contadores = {"aciertos": 0, "fallos": 0, "escrituras": 0, "caducadas": 0, "desalojadas": 0}
+        self._conexion = sqlite3.connect(self.ruta_db, timeout=30, check_same_thread=False)
+        with self._conexion:
+            self._conexion.execute("PRAGMA journal_mode=WAL")
+            self._conexion.execute(
+                "CREATE TABLE IF NOT EXISTS respuestas (clave TEXT PRIMARY KEY, respuesta TEXT NOT NULL, "
+                "creado REAL NOT NULL, ultimo_uso REAL NOT NULL, bytes INTEGER NOT NULL)")
+            self._conexion.execute("CREATE INDEX IF NOT EXISTS idx_respuestas_ultimo_uso ON respuestas (ultimo_uso)")
+
+    @staticmethod
+    def _clave(prompt, llm_string):
+        return hashlib.sha256(f"{llm_string}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt, llm_string):
+        clave = self._clave(prompt, llm_string)
+        ahora = time.time()
+        with self._lock:
+            if _omitir_lectura.get():
+                self._contadores["fallos"] += 1
+                return None
+            fila = self._conexion.execute("SELECT respuesta, creado FROM respuestas WHERE clave = ?", (clave,)).fetchone()
+            if fila is not None and self.ttl_segundos and ahora - fila[1] > self.ttl_segundos:
+                with self._conexion:
+                    self._conexion.execute("DELETE FROM respuestas WHERE clave = ?", (clave,))
+                self._contadores["caducadas"] += 1
+                fila = None
+            if fila is None:
+                self._contadores["fallos"] += 1
+                return None
+            with self._conexion:
+                self._conexion.execute("UPDATE respuestas SET ultimo_uso = ? WHERE clave = ?", (ahora, clave))
+            self._contadores["aciertos"] += 1
+        try:
+            return [ChatGeneration(message=AIMessage(content=texto)) for texto in json.loads(fila[0])]
+        except Exception as e:
+            logger.warning(f"Respuesta ilegible en la cache del LLM ({clave[:12]}...); se llamará al LLM: {e}")
+            return None
+
+    def update(self, prompt, llm_string, return_val):
+        clave = self._clave(prompt, llm_string)
+        respuesta = json.dumps([generacion.text for generacion in return_val], ensure_ascii=False) # Solo el texto de cada respuesta
+        ahora = time.time()
+        with self._lock:
+            with self._conexion:
+                self._conexion.execute(
+                    "INSERT OR REPLACE INTO respuestas (clave, respuesta, creado, ultimo_uso, bytes) VALUES (?, ?, ?, ?, ?)",
+                    (clave, respuesta, ahora, ahora, len(respuesta.encode("utf-8"))))
+            self._contadores["escrituras"] += 1
+            self._purgar(ahora)
+
+    def _purgar(self, ahora):
+        with self._conexion:
+            if self.ttl_segundos:
+                cursor = self._conexion.execute("DELETE FROM respuestas WHERE creado < ?", (ahora - self.ttl_segundos,))
+                self._contadores["caducadas"] += cursor.rowcount
+            total_bytes = self._conexion.execute("SELECT COALESCE(SUM(bytes), 0) FROM respuestas").fetchone()[0]
+            if total_bytes <= self.max_bytes:
+                return
+            a_eliminar = []
+            for clave, tamano in self._conexion.execute("SELECT clave, bytes FROM respuestas ORDER BY ultimo_uso"):
+                if total_bytes <= self.max_bytes:
+                    break
+                a_eliminar.append((clave,))
+                total_bytes -= tamano
+            self._conexion.executemany("DELETE FROM respuestas WHERE clave = ?", a_eliminar)
+            self._contadores["desalojadas"] += len(a_eliminar)
+
+    def clear(self, **kwargs):
+        with self._lock, self._conexion:
+            self._conexion.execute("DELETE FROM respuestas")
+
+    def estadisticas(self):
+        with self._lock:
+            return dict(self._contadores)
+
+def crear_cache_llm(directorio_cache, ttl_segundos, max_bytes):
+    try:
+        cache = CacheLLMSQLite(directorio_cache, ttl_segundos=ttl_segundos, max_bytes=max_bytes)
+        logger.info(f"Cache de respuestas del LLM abierta en '{cache.ruta_db}'.")
+        return cache
+    except Exception as e:
+        logger.error(f"No se pudo abrir la cache de respuestas del LLM en '{directorio_cache}': {e}")
+        logger.debug(traceback.format_exc())
+        return None
+
+# llm.stream() no consulta la cache de LangChain; estas funciones la usan con la misma clave que
+# invoke/generate (mensajes del prompt serializados + llm_string), así ambos caminos comparten entradas.
+def _clave_langchain(llm, prompt_texto):
+    return dumps(StringPromptValue(text=prompt_texto).to_messages()), llm._get_llm_string()
+
+def buscar_respuesta_llm(llm, prompt_texto):
+    if not isinstance(getattr(llm, "cache", None), BaseCache):
+        return None
+    generaciones = llm.cache.lookup(*_clave_langchain(llm, prompt_texto))
+    if not generaciones:
+        return None
+    return generaciones[0].text
+
+def guardar_respuesta_llm(llm, prompt_texto, texto):
+    if isinstance(getattr(llm, "cache", None), BaseCache):
+        llm.cache.update(*_clave_langchain(llm, prompt_texto), [ChatGeneration(message=AIMessage(content=texto))])
+
+def resumir_estadisticas(antes, despues):
+    """Texto con la diferencia de contadores entre dos llamadas a estadisticas(), para los logs de tiempos."""
+    diferencia = {k: despues.get(k, 0) - antes.get(k, 0) for k in despues}
+    return (f"cache LLM: {diferencia['aciertos']} aciertos, {diferencia['fallos']} fallos, "
+            f"{diferencia['escrituras']} escrituras, {diferencia['caducadas']} caducadas, {diferencia['desalojadas']} desalojadas")
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo cache_llm.py cargado.")
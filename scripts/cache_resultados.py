@@ -0,0 +1,109 @@
+# scripts/cache_resultados.py
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import logging
+import traceback
+
+logger = logging.getLogger(__name__)
+
+_META_FILENAME = "meta.json"
+_REPORTE_FILENAME = "reporte.json"
+_DASHBOARD_FILENAME = "dashboard.html"
+
+def calcular_hash_pdf(ruta_pdf, tamano_bloque=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(ruta_pdf, 'rb') as f:
+        for bloque in iter(lambda: f.read(tamano_bloque), b''):
+            sha.update(bloque)
+    return sha.hexdigest()
+
+def calcular_clave_resultado(hash_pdf, huella_kb, modelo_llm, version_prompt, parametros=None):
+    """
+    Clave direccionada por contenido: bytes del PDF del proyecto, versión de la base de conocimiento (manifest),
+    modelo LLM, versión del prompt y parámetros que cambian el resultado (K, truncado del proyecto, etc.).
+    """
+    componentes = {
+        "pdf": hash_pdf,
+        "kb": huella_kb,
+        "modelo_llm": modelo_llm,
+        "prompt": version_prompt,
+        "parametros": parametros or {}
+    }
+    return hashlib.sha256(json.dumps(componentes, sort_keys=True).encode('utf-8')).hexdigest()
+
+class CacheResultados:
+    """
+    Guarda en disco el reporte JSON y el dashboard HTML de cada análisis, uno por carpeta <clave>/.
+    Las entradas se escriben en una carpeta temporal y se publican con un rename atómico, así que un lector
+    nunca ve una entrada a medias. Al superar `max_entradas` se eliminan las menos usadas recientemente.
+    """
+
+    def __init__(self, directorio_cache, max_entradas=200):
+        self.directorio = directorio_cache
+        self.max_entradas = int(max_entradas)
+        os.makedirs(self.directorio, exist_ok=True)
+
+    def _ruta_entrada(self, clave):
+        return os.path.join(self.directorio, clave)
+
+    def buscar(self, clave):
+        """Devuelve el dict de metadatos de la entrada (con las rutas de sus archivos), o None si no existe."""
+        ruta_entrada = self._ruta_entrada(clave)
+        ruta_meta = os.path.join(ruta_entrada, _META_FILENAME)
+        if not os.path.isfile(ruta_meta):
+            return None
+        try:
+            with open(ruta_meta, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            os.utime(ruta_meta) # La fecha de modificación del meta marca el último uso (LRU)
+            meta["ruta_reporte"] = os.path.join(ruta_entrada, _REPORTE_FILENAME)
+            meta["ruta_dashboard"] = os.path.join(ruta_entrada, _DASHBOARD_FILENAME)
+            return meta
+        except Exception as e:
+            logger.warning(f"Entrada de cache de resultados ilegible en '{ruta_entrada}': {e}")
+            return None
+
+    def guardar(self, clave, ruta_reporte_json, ruta_dashboard_html, metadatos=None):
+        ruta_entrada = self._ruta_entrada(clave)
+        directorio_tmp = None
+        try:
+            directorio_tmp = tempfile.mkdtemp(prefix=".tmp_", dir=self.directorio)
+            shutil.copy2(ruta_reporte_json, os.path.join(directorio_tmp, _REPORTE_FILENAME))
+            shutil.copy2(ruta_dashboard_html, os.path.join(directorio_tmp, _DASHBOARD_FILENAME))
+            meta = dict(metadatos or {}, clave=clave, guardado=time.time())
+            with open(os.path.join(directorio_tmp, _META_FILENAME), 'w', encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False, indent=2)
+            if os.path.isdir(ruta_entrada): # Forzar reanálisis: la entrada nueva reemplaza a la anterior
+                shutil.rmtree(ruta_entrada, ignore_errors=True)
+            os.rename(directorio_tmp, ruta_entrada)
+            directorio_tmp = None
+            logger.info(f"Resultado del análisis guardado en la cache de resultados ({clave[:12]}...).")
+            self._purgar()
+            return True
+        except Exception as e:
+            logger.error(f"No se pudo guardar el resultado en la cache de resultados: {e}")
+            logger.debug(traceback.format_exc())
+            return False
+        finally:
+            if directorio_tmp:
+                shutil.rmtree(directorio_tmp, ignore_errors=True)
+
+    def _purgar(self):
+        entradas = []
+        for nombre in os.listdir(self.directorio):
+            ruta_meta = os.path.join(self.directorio, nombre, _META_FILENAME)
+            if not nombre.startswith(".tmp_") and os.path.isfile(ruta_meta):
+                entradas.append((os.path.getmtime(ruta_meta), nombre))
+        entradas.sort()
+        for _, nombre in entradas[:max(0, len(entradas) - self.max_entradas)]:
+            shutil.rmtree(self._ruta_entrada(nombre), ignore_errors=True)
+            logger.info(f"Entrada de cache de resultados eliminada por límite de tamaño: {nombre[:12]}...")
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo cache_resultados.py cargado.")
@@ -0,0 +1,155 @@
+# scripts/cache_texto_pdf.py
+# Cache persistente del texto extraído de los PDFs: las páginas (texto y metadatos de PyMuPDFLoader) de cada PDF se
+# guardan por hash del contenido del archivo y versión del extractor, así que reconstruir la base de conocimiento o
+# volver a analizar el mismo proyecto no vuelve a parsear PDFs ya vistos. Cada PDF es un JSONL comprimido con gzip
+# (una línea de cabecera y una por página) que se escribe página a página mientras se extrae.
+import os
+import gzip
+import json
+import uuid
+import hashlib
+import logging
+import traceback
+import pymupdf
+import langchain_community
+from langchain_community.document_loaders import PyMuPDFLoader
+from langchain_core.documents import Document
+
+from . import config
+from . import metricas
+
+logger = logging.getLogger(__name__)
+
+VERSION_FORMATO = 1
+# Otra versión de PyMuPDF o del loader puede extraer otro texto: forma parte de la clave de cada entrada.
+VERSION_EXTRACTOR = f"pymupdf-{pymupdf.__version__}+langchain_community-{langchain_community.__version__}+v{VERSION_FORMATO}"
+EXTENSION_CACHE = ".jsonl.gz"
+_CLAVES_RUTA = ("source", "file_path") # Metadatos con la ruta del PDF: se ajustan a la ruta desde la que se pide
+CONTADOR_ACIERTOS = "pdfs_cache_texto_aciertos"
+CONTADOR_FALLOS = "pdfs_cache_texto_fallos"
+
+def calcular_hash_archivo(ruta_archivo, tam_bloque=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(ruta_archivo, 'rb') as f:
+        for bloque in iter(lambda: f.read(tam_bloque), b''):
+            sha256.update(bloque)
+    return sha256.hexdigest()
+
+def _ruta_entrada(hash_archivo):
+    clave = hashlib.sha256(f"{hash_archivo}\x00{VERSION_EXTRACTOR}".encode("utf-8")).hexdigest()
+    return os.path.join(config.DIRECTORIO_CACHE_TEXTO_PDF, clave + EXTENSION_CACHE)
+
+def registrar_consulta(acierto):
+    """
+    Suma un acierto o un fallo de la cache al análisis en curso (metricas). Los workers del pool de ingesta no tienen
+    el registro del análisis: devuelven el resultado de abrir_paginas_pdf y quien los lanzó lo registra aquí.
+    """
+    if acierto is not None: # None: cache deshabilitada o no utilizable para ese PDF
+        metricas.sumar(CONTADOR_ACIERTOS if acierto else CONTADOR_FALLOS, 1)
+
+def _leer_entrada(ruta_entrada, ruta_pdf):
+    # Se lee entera antes de entregar nada: una entrada ilegible se trata como un fallo sin haber devuelto páginas a medias
+    try:
+        with gzip.open(ruta_entrada, "rt", encoding="utf-8") as f:
+            next(f) # Cabecera
+            paginas = [json.loads(linea) for linea in f]
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Entrada ilegible en la cache de texto de PDFs ({os.path.basename(ruta_entrada)}); se volverá a extraer: {e}")
+        _borrar(ruta_entrada)
+        return None
+    try:
+        os.utime(ruta_entrada) # Última vez usada, para el desalojo
+    except OSError:
+        pass
+    documentos = []
+    for pagina in paginas:
+        metadata = pagina["metadata"]
+        for clave in _CLAVES_RUTA:
+            if clave in metadata:
+                metadata[clave] = ruta_pdf
+        documentos.append(Document(page_content=pagina["page_content"], metadata=metadata))
+    return documentos
+
+def _extraer_y_guardar(ruta_pdf, ruta_entrada):
+    ruta_tmp = f"{ruta_entrada}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp" # Varios procesos de ingesta pueden escribir a la vez
+    completa = False
+    try:
+        with gzip.open(ruta_tmp, "wt", encoding="utf-8", compresslevel=6) as f:
+            f.write(json.dumps({"version_extractor": VERSION_EXTRACTOR, "archivo": os.path.basename(ruta_pdf)},
+                               ensure_ascii=False) + "\n")
+            for pagina in PyMuPDFLoader(ruta_pdf).lazy_load():
+                # Se escribe antes de entregarla: quien la recibe puede modificar sus metadatos
+                f.write(json.dumps({"page_content": pagina.page_content, "metadata": pagina.metadata},
+                                   ensure_ascii=False) + "\n")
+                yield pagina
+        os.replace(ruta_tmp, ruta_entrada)
+        completa = True
+    finally:
+        if not completa: # Error al extraer, o quien consumía las páginas abandonó antes de terminar
+            _borrar(ruta_tmp)
+    aplicar_cuota()
+
+def _borrar(ruta):
+    try:
+        os.remove(ruta)
+    except OSError:
+        pass
+
+def aplicar_cuota():
+    """Borra las entradas usadas hace más tiempo hasta que la cache ocupe como mucho CACHE_TEXTO_PDF_MAX_MB."""
+    max_bytes = config.CACHE_TEXTO_PDF_MAX_MB * 1024 * 1024
+    try:
+        entradas = []
+        with os.scandir(config.DIRECTORIO_CACHE_TEXTO_PDF) as it:
+            for entrada in it:
+                if entrada.name.endswith(EXTENSION_CACHE):
+                    estado = entrada.stat()
+                    entradas.append((estado.st_mtime, estado.st_size, entrada.path))
+    except OSError as e:
+        logger.warning(f"No se pudo revisar el tamaño de la cache de texto de PDFs: {e}")
+        return
+    total = sum(tamano for _, tamano, _ in entradas)
+    for _, tamano, ruta in sorted(entradas):
+        if total <= max_bytes:
+            break
+        _borrar(ruta)
+        total -= tamano
+
+def abrir_paginas_pdf(ruta_pdf):
+    """
+    Devuelve (acierto, paginas): `paginas` itera como PyMuPDFLoader(ruta_pdf).lazy_load(), un Document por página con
+    los mismos texto y metadatos. Si el PDF ya se extrajo antes (mismo contenido y misma versión del extractor), las
+    páginas salen de la cache sin abrir el PDF y `acierto` es True; False si hay que extraerlo y None si no se usa la
+    cache. No registra nada en metricas (ver registrar_consulta).
+    """
+    if not config.CACHE_TEXTO_PDF_HABILITADA:
+        return None, PyMuPDFLoader(ruta_pdf).lazy_load()
+    try:
+        os.makedirs(config.DIRECTORIO_CACHE_TEXTO_PDF, exist_ok=True)
+        ruta_entrada = _ruta_entrada(calcular_hash_archivo(ruta_pdf))
+    except OSError as e:
+        logger.warning(f"No se puede usar la cache de texto de PDFs para '{os.path.basename(ruta_pdf)}': {e}")
+        logger.debug(traceback.format_exc())
+        return None, PyMuPDFLoader(ruta_pdf).lazy_load()
+    paginas = _leer_entrada(ruta_entrada, ruta_pdf)
+    if paginas is not None:
+        logger.debug(f"Texto de '{os.path.basename(ruta_pdf)}' recuperado de la cache ({len(paginas)} páginas).")
+        return True, iter(paginas)
+    return False, _extraer_y_guardar(ruta_pdf, ruta_entrada)
+
+def iterar_paginas_pdf(ruta_pdf):
+    """Como abrir_paginas_pdf, registrando el acierto o fallo de la cache en el análisis en curso."""
+    acierto, paginas = abrir_paginas_pdf(ruta_pdf)
+    registrar_consulta(acierto)
+    yield from paginas
+
+def cargar_paginas_pdf(ruta_pdf):
+    """Como PyMuPDFLoader(ruta_pdf).load(), usando la cache de texto de PDFs."""
+    return list(iterar_paginas_pdf(ruta_pdf))
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo cache_texto_pdf.py cargado.")
@@ -0,0 +1,219 @@
+# scripts/colecciones_kb.py
+# Colecciones de base de conocimiento: la predeterminada (datos/BaseConocimiento + ChromaDB_V1) y una por cada
+# conjunto de PDFs subido, identificada por la huella de su contenido. Cada colección subida vive en
+# datos/ColeccionesKB/<id>/ con sus PDFs (BaseConocimiento/) y su base vectorial versionada (ChromaDB/), de modo que
+# volver a una colección ya indexada solo abre su ChromaDB. Las subidas que no se usan se borran por LRU según la cuota.
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import logging
+import traceback
+from contextlib import contextmanager
+
+from . import config
+from . import vector_db_manager
+
+logger = logging.getLogger(__name__)
+
+ID_COLECCION_PREDETERMINADA = "predeterminada"
+METADATOS_COLECCION_FILENAME = "coleccion.json"
+SUBDIRECTORIO_DOCUMENTOS = "BaseConocimiento"
+SUBDIRECTORIO_CHROMA = "ChromaDB"
+SUFIJO_TEMPORAL = ".tmp"
+
+class ColeccionKB:
+    def __init__(self, id_coleccion, directorio_documentos, chroma_db_path, archivos=None, creada=None, ultimo_uso=None):
+        self.id = id_coleccion
+        self.directorio_documentos = directorio_documentos
+        self.chroma_db_path = chroma_db_path
+        self.archivos = list(archivos or [])
+        self.creada = creada or time.time()
+        self.ultimo_uso = ultimo_uso or self.creada
+        self.en_uso = 0
+
+    @property
+    def predeterminada(self):
+        return self.id == ID_COLECCION_PREDETERMINADA
+
+    @property
+    def nombre(self):
+        if self.predeterminada:
+            return "Base de Conocimiento por defecto"
+        return ", ".join(self.archivos) or self.id
+
+    def a_dict(self):
+        return {
+            "id": self.id,
+            "nombre": self.nombre,
+            "archivos": self.archivos,
+            "predeterminada": self.predeterminada,
+            "indexada": vector_db_manager.ruta_version_actual(self.chroma_db_path) is not None,
+            "ultimo_uso": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.ultimo_uso)),
+            "en_uso": self.en_uso
+        }
+
+def _tamano_directorio(ruta):
+    total = 0
+    for raiz, _, archivos in os.walk(ruta):
+        for nombre in archivos:
+            try:
+                total += os.path.getsize(os.path.join(raiz, nombre))
+            except OSError:
+                pass # Archivo borrado mientras se recorría (p. ej. una versión recolectada)
+    return total
+
+def calcular_id_coleccion(directorio_pdfs):
+    """Huella del contenido de los PDFs (nombre y hash de cada uno): los mismos PDFs dan siempre la misma colección."""
+    hashes = vector_db_manager.calcular_hashes_kb(directorio_pdfs)
+    huella = hashlib.sha256(json.dumps(sorted(hashes.items())).encode('utf-8')).hexdigest()
+    return "kb_" + huella[:16]
+
+class GestorColeccionesKB:
+    """
+    Registro de colecciones del proceso. `usar()` marca una colección como en uso durante un análisis (no se puede
+    desalojar) y actualiza su último uso; al soltarla se aplica la cuota de disco y de número de colecciones.
+    """
+
+    def __init__(self, directorio_raiz, kb_predeterminada, chroma_predeterminada, max_bytes, max_colecciones):
+        self.directorio_raiz = directorio_raiz
+        self.max_bytes = max_bytes
+        self.max_colecciones = max_colecciones
+        self._lock = threading.Lock()
+        self._colecciones = {
+            ID_COLECCION_PREDETERMINADA: ColeccionKB(ID_COLECCION_PREDETERMINADA, kb_predeterminada, chroma_predeterminada)
+        }
+        os.makedirs(directorio_raiz, exist_ok=True)
+        self._cargar_colecciones()
+
+    def _cargar_colecciones(self):
+        for nombre in sorted(os.listdir(self.directorio_raiz)):
+            ruta = os.path.join(self.directorio_raiz, nombre)
+            if nombre.endswith(SUFIJO_TEMPORAL):
+                shutil.rmtree(ruta, ignore_errors=True) # Subida que un proceso anterior dejó a medias
+                continue
+            try:
+                with open(os.path.join(ruta, METADATOS_COLECCION_FILENAME), 'r', encoding='utf-8') as f:
+                    metadatos = json.load(f)
+            except Exception as e:
+                logger.warning(f"Colección de KB '{nombre}' sin metadatos válidos ({e}); se ignora.")
+                continue
+            self._colecciones[nombre] = ColeccionKB(nombre, os.path.join(ruta, SUBDIRECTORIO_DOCUMENTOS),
+                                                    os.path.join(ruta, SUBDIRECTORIO_CHROMA), metadatos.get("archivos"),
+                                                    metadatos.get("creada"), metadatos.get("ultimo_uso"))
+        logger.info(f"Colecciones de base de conocimiento disponibles: {len(self._colecciones)}")
+
+    def _guardar_metadatos(self, coleccion, directorio=None):
+        ruta = os.path.join(directorio or os.path.join(self.directorio_raiz, coleccion.id), METADATOS_COLECCION_FILENAME)
+        try:
+            with open(ruta + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump({"id": coleccion.id, "archivos": coleccion.archivos, "creada": coleccion.creada,
+                           "ultimo_uso": coleccion.ultimo_uso}, f, ensure_ascii=False, indent=2)
+            os.replace(ruta + ".tmp", ruta)
+        except Exception as e:
+            logger.error(f"No se pudieron guardar los metadatos de la colección de KB '{coleccion.id}': {e}")
+            logger.debug(traceback.format_exc())
+
+    def obtener(self, id_coleccion):
+        with self._lock:
+            return self._colecciones.get(id_coleccion)
+
+    def listar(self):
+        """Colecciones disponibles, la predeterminada primero y el resto de la más a la menos usada recientemente."""
+        with self._lock:
+            colecciones = sorted(self._colecciones.values(), key=lambda c: (not c.predeterminada, -c.ultimo_uso))
+            return [c.a_dict() for c in colecciones]
+
+    def registrar_subida(self, directorio_pdfs):
+        """
+        Convierte los PDFs subidos en una colección. Devuelve (coleccion, nueva): si ya existía una con el mismo
+        contenido se reutiliza (con su base vectorial ya indexada) y los PDFs subidos se descartan.
+        """
+        id_coleccion = calcular_id_coleccion(directorio_pdfs)
+        with self._lock:
+            coleccion = self._colecciones.get(id_coleccion)
+            if coleccion is not None:
+                logger.info(f"Los PDFs subidos coinciden con la colección de KB existente '{id_coleccion}'; se reutiliza.")
+                return coleccion, False
+            ruta = os.path.join(self.directorio_raiz, id_coleccion)
+            ruta_tmp = ruta + SUFIJO_TEMPORAL
+            shutil.rmtree(ruta_tmp, ignore_errors=True)
+            os.makedirs(ruta_tmp)
+            shutil.copytree(directorio_pdfs, os.path.join(ruta_tmp, SUBDIRECTORIO_DOCUMENTOS))
+            coleccion = ColeccionKB(id_coleccion, os.path.join(ruta, SUBDIRECTORIO_DOCUMENTOS),
+                                    os.path.join(ruta, SUBDIRECTORIO_CHROMA),
+                                    sorted(f for f in os.listdir(directorio_pdfs) if f.lower().endswith(".pdf")))
+            self._guardar_metadatos(coleccion, ruta_tmp)
+            os.replace(ruta_tmp, ruta) # Visible solo cuando está completa
+            self._colecciones[id_coleccion] = coleccion
+        logger.info(f"Nueva colección de KB registrada: '{id_coleccion}' ({len(coleccion.archivos)} PDF).")
+        return coleccion, True
+
+    @contextmanager
+    def usar(self, id_coleccion):
+        with self._lock:
+            coleccion = self._colecciones.get(id_coleccion)
+            if coleccion is None:
+                raise KeyError(f"No existe la colección de base de conocimiento '{id_coleccion}'.")
+            coleccion.en_uso += 1
+            coleccion.ultimo_uso = time.time()
+            if not coleccion.predeterminada:
+                self._guardar_metadatos(coleccion)
+        try:
+            yield coleccion
+        finally:
+            with self._lock:
+                coleccion.en_uso -= 1
+            self.aplicar_cuota()
+
+    def aplicar_cuota(self):
+        """Borra las colecciones subidas menos usadas recientemente hasta respetar el máximo de bytes y de colecciones."""
+        with self._lock:
+            candidatas = sorted((c for c in self._colecciones.values() if not c.predeterminada), key=lambda c: c.ultimo_uso)
+            tamanos = {c.id: _tamano_directorio(os.path.join(self.directorio_raiz, c.id)) for c in candidatas}
+            total = sum(tamanos.values())
+            restantes = len(candidatas)
+            a_borrar = []
+            for coleccion in candidatas:
+                if total <= self.max_bytes and restantes <= self.max_colecciones:
+                    break
+                if coleccion.en_uso or not self._descartar_de_pipeline(coleccion):
+                    continue
+                del self._colecciones[coleccion.id]
+                ruta = os.path.join(self.directorio_raiz, coleccion.id)
+                ruta_borrado = ruta + SUFIJO_TEMPORAL
+                os.replace(ruta, ruta_borrado) # Fuera del registro y del disco visible antes de soltar el lock
+                a_borrar.append((coleccion.id, ruta_borrado, tamanos[coleccion.id]))
+                total -= tamanos[coleccion.id]
+                restantes -= 1
+        for id_coleccion, ruta_borrado, tamano in a_borrar:
+            shutil.rmtree(ruta_borrado, ignore_errors=True)
+            logger.info(f"Colección de KB '{id_coleccion}' desalojada por la cuota ({tamano / (1024 * 1024):.1f} MB liberados).")
+
+    @staticmethod
+    def _descartar_de_pipeline(coleccion):
+        # La pipeline conserva abierta la base vectorial de las últimas colecciones usadas: se cierra antes de borrarla
+        from .pipeline_rag import obtener_pipeline
+        obtener_pipeline().descartar_coleccion(coleccion.chroma_db_path)
+        if vector_db_manager.base_vectorial_en_uso(coleccion.chroma_db_path):
+            return False
+        return vector_db_manager.cerrar_base_vectorial(coleccion.chroma_db_path)
+
+_gestor = None
+_lock_gestor = threading.Lock()
+
+def obtener_gestor_colecciones():
+    global _gestor
+    with _lock_gestor:
+        if _gestor is None:
+            _gestor = GestorColeccionesKB(config.DIRECTORIO_COLECCIONES_KB, config.DIRECTORIO_BASE_CONOCIMIENTO,
+                                          config.CHROMA_DB_PATH, config.COLECCIONES_KB_MAX_MB * 1024 * 1024,
+                                          config.COLECCIONES_KB_MAX)
+        return _gestor
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo colecciones_kb.py cargado.")
@@ -0,0 +1,97 @@
+# scripts/comparar_backends_embeddings.py
+# Compara el backend torch (SentenceTransformer) con ONNX fp32 e int8 sobre fragmentos reales de la base de conocimiento:
+# throughput (fragmentos/seg), similitud coseno con los vectores de torch y coincidencia de los vecinos más cercanos.
+# Uso: python -m scripts.comparar_backends_embeddings [--max-fragmentos 500] [--salida resultados.json]
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import numpy as np
+
+from . import config
+from . import document_utils
+from .onnx_embeddings import OnnxSentenceEmbeddings
+
+logger = logging.getLogger(__name__)
+
+COSENO_MINIMO_RECOMENDADO = 0.99
+COINCIDENCIA_TOP_K_RECOMENDADA = 0.9
+
+def _medir(embeddings, textos, repeticiones):
+    embeddings.embed_documents(textos[:8]) # Calentamiento
+    mejor = None
+    vectores = None
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        vectores = embeddings.embed_documents(textos)
+        duracion = time.perf_counter() - inicio
+        mejor = duracion if mejor is None else min(mejor, duracion)
+    return np.asarray(vectores, dtype=np.float32), len(textos) / mejor
+
+def _coincidencia_top_k(referencia, candidato, k):
+    # Fracción de vecinos top-k (usando cada fragmento como consulta) que coinciden entre ambos backends.
+    sim_ref = referencia @ referencia.T
+    sim_cand = candidato @ candidato.T
+    np.fill_diagonal(sim_ref, -np.inf)
+    np.fill_diagonal(sim_cand, -np.inf)
+    top_ref = np.argsort(-sim_ref, axis=1)[:, :k]
+    top_cand = np.argsort(-sim_cand, axis=1)[:, :k]
+    return float(np.mean([len(set(a) & set(b)) / k for a, b in zip(top_ref, top_cand)]))
+
+def comparar_backends(max_fragmentos=500, repeticiones=3, k=5):
+    from langchain_community.embeddings import SentenceTransformerEmbeddings
+
+    fragmentos = document_utils.cargar_y_procesar_pdfs_de_carpeta(
+        config.DIRECTORIO_BASE_CONOCIMIENTO, config.CHUNK_SIZE, config.CHUNK_OVERLAP)
+    textos = [f.page_content for f in fragmentos][:max_fragmentos]
+    if len(textos) <= k:
+        logger.error("No hay suficientes fragmentos en la base de conocimiento para comparar los backends.")
+        return None
+    logger.info(f"Comparando backends con {len(textos)} fragmentos de '{config.DIRECTORIO_BASE_CONOCIMIENTO}'.")
+
+    torch_emb = SentenceTransformerEmbeddings(model_name=config.EMBEDDING_MODEL_NAME_OR_PATH,
+                                              model_kwargs={'device': 'cpu'}, cache_folder=config.CACHE_DIR_HF)
+    vectores_torch, throughput_torch = _medir(torch_emb, textos, repeticiones)
+    resultados = {
+        "modelo": str(config.EMBEDDING_MODEL_NAME_OR_PATH),
+        "num_fragmentos": len(textos),
+        "backends": {"torch": {"fragmentos_por_segundo": round(throughput_torch, 2)}}
+    }
+
+    for nombre, cuantizado in (("onnx_fp32", False), ("onnx_int8", True)):
+        onnx_emb = OnnxSentenceEmbeddings(config.EMBEDDING_MODEL_NAME_OR_PATH, config.EMBEDDING_ONNX_PATH,
+                                          cache_folder=config.CACHE_DIR_HF, cuantizado=cuantizado)
+        vectores, throughput = _medir(onnx_emb, textos, repeticiones)
+        cosenos = np.sum(vectores_torch * vectores, axis=1) / (
+            np.linalg.norm(vectores_torch, axis=1) * np.linalg.norm(vectores, axis=1))
+        coincidencia = _coincidencia_top_k(vectores_torch, vectores, k)
+        resultados["backends"][nombre] = {
+            "fragmentos_por_segundo": round(throughput, 2),
+            "aceleracion_vs_torch": round(throughput / throughput_torch, 2),
+            "coseno_medio": round(float(np.mean(cosenos)), 5),
+            "coseno_minimo": round(float(np.min(cosenos)), 5),
+            f"coincidencia_top{k}": round(coincidencia, 4),
+            "recomendado": bool(np.min(cosenos) >= COSENO_MINIMO_RECOMENDADO and coincidencia >= COINCIDENCIA_TOP_K_RECOMENDADA)
+        }
+    return resultados
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Compara los backends de embeddings torch y ONNX.")
+    parser.add_argument("--max-fragmentos", type=int, default=500)
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--salida", default=None, help="Ruta opcional para guardar los resultados en JSON.")
+    args = parser.parse_args()
+
+    resultados = comparar_backends(args.max_fragmentos, args.repeticiones)
+    if not resultados:
+        sys.exit(1)
+    for nombre, metricas in resultados["backends"].items():
+        logger.info(f"{nombre:10s} {metricas}")
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
+        logger.info(f"Resultados guardados en: {os.path.abspath(args.salida)}")
@@ -20,6 +20,12 @@ load_dotenv(dotenv_path)
 if 'SSL_CERT_FILE' in os.environ:
     logger.info(f"Usando bundle de certificados de certifi en: {os.environ['SSL_CERT_FILE']}")
 
+def _env_bool(nombre, por_defecto):
+    valor = os.environ.get(nombre, '').strip().lower()
+    if not valor:
+        return por_defecto
+    return valor in ('1', 'true', 'si', 'sí', 'yes', 'on')
+
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 DATA_DIR = os.path.join(PROJECT_ROOT, "datos")
@@ -29,8 +35,17 @@ DIRECTORIO_BASE_CONOCIMIENTO = os.path.join(DATA_DIR, "BaseConocimiento")
 DIRECTORIO_PROYECTO_ANALIZAR = os.path.join(DATA_DIR, "ProyectoAnalizar")
 CHROMA_DB_PATH = os.path.join(DATA_DIR, "ChromaDB_V1")
 DIRECTORIO_RESULTADOS = os.path.join(DATA_DIR, "Resultados")
+DIRECTORIO_CACHE_RESULTADOS = os.path.join(DATA_DIR, "CacheResultados") # Reportes y dashboards por hash de PDF + KB + modelo
+DIRECTORIO_CACHE_LLM = os.path.join(DATA_DIR, "CacheLLM") # Respuestas del LLM por hash de prompt renderizado + parámetros del modelo
+DIRECTORIO_TRABAJOS = os.path.join(DATA_DIR, "Trabajos") # Un espacio de trabajo aislado por análisis (proyecto y resultados)
+DIRECTORIO_METRICAS = os.path.join(DATA_DIR, "Metricas") # Un registro JSON por análisis (duración de etapas, tokens, caches)
+RUTA_METRICAS_JSONL = os.path.join(DIRECTORIO_METRICAS, "analisis.jsonl")
+DIRECTORIO_CACHE_TEXTO_PDF = os.path.join(DATA_DIR, "CacheTextoPDF") # Páginas extraídas de cada PDF por hash de archivo + versión del extractor
+DIRECTORIO_COLECCIONES_KB = os.path.join(DATA_DIR, "ColeccionesKB") # Una carpeta (PDFs + ChromaDB) por base de conocimiento subida
 MODELOS_LOCALES_PATH = os.path.join(PROJECT_ROOT, "modelos_locales")
 CACHE_DIR_HF = os.path.join(PROJECT_ROOT, ".cache", "huggingface_cache")
+EMBEDDING_CACHE_DIR = os.path.join(DATA_DIR, "CacheEmbeddings")
+EMBEDDING_ONNX_PATH = os.path.join(MODELOS_LOCALES_PATH, "onnx")
 
 DEFAULT_EMBEDDING_MODEL_HF_REPO_ID = 'sentence-transformers/all-MiniLM-L6-v2'
 EMBEDDING_MODEL_NAME_OR_PATH = DEFAULT_EMBEDDING_MODEL_HF_REPO_ID
@@ -52,14 +67,112 @@ if env_model_path_str:
 else:
     logger.info(f"EMBEDDING_MODEL_PATH no definido en .env o vacío. Usando por defecto: {EMBEDDING_MODEL_NAME_OR_PATH}")
 
+# Backend de inferencia de embeddings: 'torch' (SentenceTransformer) u 'onnx' (onnxruntime, opcionalmente int8).
+# Ver scripts/comparar_backends_embeddings.py antes de activarlo en producción.
+EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'torch').strip().lower() or 'torch'
+if EMBEDDING_BACKEND not in ('torch', 'onnx'):
+    logger.warning(f"EMBEDDING_BACKEND='{EMBEDDING_BACKEND}' no reconocido. Se usará 'torch'.")
+    EMBEDDING_BACKEND = 'torch'
+EMBEDDING_ONNX_CUANTIZADO = _env_bool('EMBEDDING_ONNX_CUANTIZADO', True)
+# Textos por lote al calcular embeddings; con EMBEDDING_AGRUPAR_POR_LONGITUD los lotes se forman con textos de longitud
+# (en tokens) parecida para reducir el relleno. scripts/ajustar_lotes_embeddings.py mide el mejor valor en cada máquina.
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', '32') or 32)
+EMBEDDING_AGRUPAR_POR_LONGITUD = _env_bool('EMBEDDING_AGRUPAR_POR_LONGITUD', True)
+# Procesos que calculan embeddings al (re)construir la base vectorial, cada uno con su copia del modelo (1 = en el
+# proceso principal, como antes) y hilos de torch/onnxruntime por proceso (0 = núcleos / EMBEDDING_PROCESOS).
+EMBEDDING_PROCESOS = int(os.environ.get('EMBEDDING_PROCESOS', '1') or 1)
+EMBEDDING_HILOS_POR_PROCESO = int(os.environ.get('EMBEDDING_HILOS_POR_PROCESO', '0') or 0)
+
 CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 150
 GEMINI_MODEL_NAME = 'gemini-1.5-flash-latest' # Usado por main.py
+# Proveedor del LLM: "gemini" o "simulado" (scripts/llm_simulado.py: respuestas deterministas sin API key, para
+# pruebas de carga y medir las etapas que no son el LLM). Con LLM_SIMULADO_URL se usa el servidor HTTP simulado.
+LLM_PROVEEDOR = os.environ.get('LLM_PROVEEDOR', 'gemini').strip().lower() or 'gemini'
+if LLM_PROVEEDOR not in ('gemini', 'simulado'):
+    logger.warning(f"LLM_PROVEEDOR='{LLM_PROVEEDOR}' no reconocido. Se usará 'gemini'.")
+    LLM_PROVEEDOR = 'gemini'
+LLM_SIMULADO_URL = os.environ.get('LLM_SIMULADO_URL', '').strip() or None
+LLM_SIMULADO_LATENCIA_SEGUNDOS = float(os.environ.get('LLM_SIMULADO_LATENCIA_SEGUNDOS', '1') or 0)
+LLM_SIMULADO_SEGUNDOS_POR_FRAGMENTO = float(os.environ.get('LLM_SIMULADO_SEGUNDOS_POR_FRAGMENTO', '0.02') or 0)
+LLM_SIMULADO_TASA_ERRORES = float(os.environ.get('LLM_SIMULADO_TASA_ERRORES', '0') or 0)
+LLM_SIMULADO_SEMILLA = int(os.environ.get('LLM_SIMULADO_SEMILLA', '0') or 0)
+# Llamadas al LLM: reintentos con backoff exponencial (con jitter) ante 429/5xx, plazo total por llamada (incluye esperas),
+# limitador de tasa compartido por todos los hilos (0 = sin límite) e interruptor que corta las llamadas si Gemini no responde.
+LLM_MAX_REINTENTOS = int(os.environ.get('LLM_MAX_REINTENTOS', '4') or 4)
+LLM_BACKOFF_BASE_SEGUNDOS = float(os.environ.get('LLM_BACKOFF_BASE_SEGUNDOS', '1') or 1)
+LLM_BACKOFF_MAX_SEGUNDOS = float(os.environ.get('LLM_BACKOFF_MAX_SEGUNDOS', '30') or 30)
+LLM_PLAZO_SEGUNDOS = float(os.environ.get('LLM_PLAZO_SEGUNDOS', '300') or 300)
+LLM_TIMEOUT_SEGUNDOS = float(os.environ.get('LLM_TIMEOUT_SEGUNDOS', '120') or 120) # Por intento
+LLM_PETICIONES_POR_MINUTO = float(os.environ.get('LLM_PETICIONES_POR_MINUTO', '60') or 0)
+LLM_RAFAGA_MAX = int(os.environ.get('LLM_RAFAGA_MAX', '4') or 4)
+LLM_CIRCUITO_UMBRAL_FALLOS = int(os.environ.get('LLM_CIRCUITO_UMBRAL_FALLOS', '5') or 5)
+LLM_CIRCUITO_SEGUNDOS_ABIERTO = float(os.environ.get('LLM_CIRCUITO_SEGUNDOS_ABIERTO', '60') or 60)
 K_RETRIEVED_DOCS = 3
+# Recuperación híbrida: búsqueda densa + BM25 (códigos de equipos, cláusulas ISO/PMBOK) fusionadas con RRF.
+RECUPERACION_HIBRIDA = _env_bool('RECUPERACION_HIBRIDA', True)
+K_CANDIDATOS_HIBRIDOS = int(os.environ.get('K_CANDIDATOS_HIBRIDOS', '20') or 20) # Candidatos de cada búsqueda antes de fusionar
+# Reranking con cross-encoder: se recuperan K_CANDIDATOS_RERANKING fragmentos y el cross-encoder elige los K_RETRIEVED_DOCS mejores.
+RERANKING_HABILITADO = _env_bool('RERANKING_HABILITADO', False)
+RERANKER_MODELO = os.environ.get('RERANKER_MODELO', '').strip() or 'cross-encoder/mmarco-mMiniLMv2-L12-H384-v1' # Multilingüe
+K_CANDIDATOS_RERANKING = int(os.environ.get('K_CANDIDATOS_RERANKING', '50') or 50)
+RERANKER_BATCH_SIZE = int(os.environ.get('RERANKER_BATCH_SIZE', '16') or 16)
 MAX_CHARS_PROYECTO = 32000
+# Empaquetado del contexto por presupuesto de tokens (en lugar de K_RETRIEVED_DOCS fragmentos completos): se recuperan
+# K_CANDIDATOS_CONTEXTO fragmentos y se incluyen, sin casi duplicados y recortados a sus frases relevantes, hasta llenar
+# PRESUPUESTO_TOKENS_PROMPT (plantilla + proyecto + contexto). El contexto nunca baja de MIN_TOKENS_CONTEXTO.
+EMPAQUETADO_CONTEXTO = _env_bool('EMPAQUETADO_CONTEXTO', True)
+PRESUPUESTO_TOKENS_PROMPT = int(os.environ.get('PRESUPUESTO_TOKENS_PROMPT', '12000') or 12000)
+MIN_TOKENS_CONTEXTO = int(os.environ.get('MIN_TOKENS_CONTEXTO', '1000') or 1000)
+K_CANDIDATOS_CONTEXTO = int(os.environ.get('K_CANDIDATOS_CONTEXTO', '15') or 15)
+
+# Modo de análisis del proyecto: "completo" (un único prompt con el texto truncado a MAX_CHARS_PROYECTO) o
+# "secciones" (map-reduce: cada sección se analiza en paralelo con su propio contexto recuperado y luego se combinan los riesgos).
+MODO_ANALISIS = os.environ.get('MODO_ANALISIS', 'completo').strip().lower() or 'completo'
+if MODO_ANALISIS not in ('completo', 'secciones'):
+    logger.warning(f"MODO_ANALISIS='{MODO_ANALISIS}' no reconocido. Se usará 'completo'.")
+    MODO_ANALISIS = 'completo'
+MAX_CHARS_SECCION = int(os.environ.get('MAX_CHARS_SECCION', '8000') or 8000)
+MAX_SECCIONES_PROYECTO = int(os.environ.get('MAX_SECCIONES_PROYECTO', '12') or 12)
+NUM_HILOS_SECCIONES = int(os.environ.get('NUM_HILOS_SECCIONES', '4') or 4) # Llamadas simultáneas al LLM por análisis
+
 RECREAR_DB = True
+# Procesos para la ingesta de PDFs de la base de conocimiento (1 = secuencial, como antes).
+NUM_PROCESOS_INGESTA = int(os.environ.get('NUM_PROCESOS_INGESTA', '1') or 1)
+# Si es True, recrear la DB solo re-indexa los PDFs añadidos/modificados/eliminados (según el manifest de hashes).
+INDEXACION_INCREMENTAL = _env_bool('INDEXACION_INCREMENTAL', True)
+# Ingesta en streaming: los fragmentos se embeben e insertan en ChromaDB por lotes mientras se siguen leyendo los PDFs.
+# Como mucho hay INGESTA_MAX_LOTES_EN_COLA lotes esperando, así que la memoria no depende del tamaño de la base de conocimiento.
+INGESTA_TAM_LOTE = int(os.environ.get('INGESTA_TAM_LOTE', '256') or 256)
+INGESTA_MAX_LOTES_EN_COLA = int(os.environ.get('INGESTA_MAX_LOTES_EN_COLA', '4') or 4)
+# Cache persistente de embeddings por hash de texto (evita recalcular vectores de fragmentos sin cambios).
+EMBEDDING_CACHE_HABILITADA = _env_bool('EMBEDDING_CACHE_HABILITADA', True)
+EMBEDDING_CACHE_MAX_ENTRADAS = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRADAS', '100000') or 100000) # ~150 MB con 384 dimensiones
+# Cache del texto extraído de los PDFs (base de conocimiento y proyecto): un PDF ya visto no se vuelve a parsear.
+CACHE_TEXTO_PDF_HABILITADA = _env_bool('CACHE_TEXTO_PDF_HABILITADA', True)
+CACHE_TEXTO_PDF_MAX_MB = int(os.environ.get('CACHE_TEXTO_PDF_MAX_MB', '500') or 500)
+# Cache de resultados: re-analizar el mismo PDF con la misma KB, modelo y prompt devuelve el dashboard guardado.
+CACHE_RESULTADOS_HABILITADA = _env_bool('CACHE_RESULTADOS_HABILITADA', True)
+CACHE_RESULTADOS_MAX_ENTRADAS = int(os.environ.get('CACHE_RESULTADOS_MAX_ENTRADAS', '200') or 200)
+# Cache de respuestas del LLM (SQLite): el mismo prompt renderizado con el mismo modelo y parámetros no se vuelve a enviar a Gemini.
+CACHE_LLM_HABILITADA = _env_bool('CACHE_LLM_HABILITADA', True)
+CACHE_LLM_TTL_SEGUNDOS = int(os.environ.get('CACHE_LLM_TTL_SEGUNDOS', str(7 * 24 * 3600)) or 7 * 24 * 3600)
+CACHE_LLM_MAX_MB = int(os.environ.get('CACHE_LLM_MAX_MB', '100') or 100)
+# Métricas por análisis: siempre se acumulan en memoria para GET /metrics (Prometheus); además se añaden a RUTA_METRICAS_JSONL.
+METRICAS_JSONL_HABILITADAS = _env_bool('METRICAS_JSONL_HABILITADAS', True)
+# Colecciones de base de conocimiento subidas desde la app (además de la predeterminada): al superar el espacio o el número
+# máximo se borran las menos usadas recientemente. La pipeline mantiene abiertas las bases vectoriales de las últimas usadas.
+COLECCIONES_KB_MAX_MB = int(os.environ.get('COLECCIONES_KB_MAX_MB', '2048') or 2048)
+COLECCIONES_KB_MAX = int(os.environ.get('COLECCIONES_KB_MAX', '20') or 20)
+COLECCIONES_KB_MAX_ABIERTAS = int(os.environ.get('COLECCIONES_KB_MAX_ABIERTAS', '4') or 4)
 DASHBOARD_HTML_SUFFIX = "_dashboard.html"
 
+# Cola de análisis en segundo plano (app.py): trabajos simultáneos, trabajos en espera y retención de resultados.
+# Cada análisis usa su propio espacio de trabajo, así que pueden correr varios a la vez (gunicorn usa 8 hilos).
+MAX_TRABAJOS_CONCURRENTES = int(os.environ.get('MAX_TRABAJOS_CONCURRENTES', '4') or 4)
+MAX_TRABAJOS_EN_COLA = int(os.environ.get('MAX_TRABAJOS_EN_COLA', '10') or 10)
+TTL_TRABAJOS_SEGUNDOS = int(os.environ.get('TTL_TRABAJOS_SEGUNDOS', '3600') or 3600)
+
 # En scripts/config.py
 INFO_TESIS = {
     "titulo_tesis_h1": "TESIS FIN DE MAESTRÍA",
@@ -96,7 +209,9 @@ def inicializar_directorios_datos():
     if _dirs_initialized_flag: return True
     directorios_a_crear = [
         DIRECTORIO_BASE_CONOCIMIENTO, DIRECTORIO_PROYECTO_ANALIZAR,
-        CHROMA_DB_PATH, DIRECTORIO_RESULTADOS, MODELOS_LOCALES_PATH, CACHE_DIR_HF
+        CHROMA_DB_PATH, DIRECTORIO_RESULTADOS, MODELOS_LOCALES_PATH, CACHE_DIR_HF,
+        DIRECTORIO_TRABAJOS, DIRECTORIO_CACHE_RESULTADOS, DIRECTORIO_CACHE_LLM, DIRECTORIO_METRICAS,
+        DIRECTORIO_COLECCIONES_KB, DIRECTORIO_CACHE_TEXTO_PDF
     ]
     try:
         for dir_path in directorios_a_crear:
@@ -1,10 +1,18 @@
 # scripts/document_utils.py
 import os
-from langchain_community.document_loaders import PyMuPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import time
+import itertools
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from langchain_core.documents import Document
 import logging
 import traceback
 
+from . import cache_texto_pdf
+from . import metricas
+from .fragmentador import FragmentadorRecursivo
+
 logger = logging.getLogger(__name__)
 
 def obtener_ruta_pdf_proyecto(directorio_proyecto_analizar):
@@ -39,51 +47,115 @@ def listar_documentos_kb(directorio_base_conocimiento):
         logger.debug(traceback.format_exc())
     return lista_pdfs
 
-def cargar_y_procesar_pdfs_de_carpeta(carpeta_path, chunk_size, chunk_overlap): # Nombre de tu función original
-    documentos_cargados = []
+def _crear_text_splitter(chunk_size, chunk_overlap):
+    # Mismos fragmentos, start_index y metadatos que RecursiveCharacterTextSplitter(length_function=len), más rápido
+    return FragmentadorRecursivo(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        add_start_index=True
+    )
+
+def _cargar_y_fragmentar_pdf(file_path, chunk_size, chunk_overlap):
+    """
+    Carga y fragmenta un único PDF de la base de conocimiento, página a página (cada página se fragmenta al leerla y
+    solo se conservan sus fragmentos). Se ejecuta tanto en el proceso principal como en los workers del pool de ingesta,
+    por lo que devuelve tuplas (texto, metadata) en lugar de objetos Document para que el resultado sea compacto al
+    serializarse. Retorna (num_paginas, fragmentos, mensaje_error, acierto_cache_texto): los workers no tienen el
+    registro de métricas del análisis, así que el acierto o fallo de la cache de texto lo registra quien recibe el resultado.
+    """
+    filename = os.path.basename(file_path)
+    acierto_cache = None
+    try:
+        text_splitter = _crear_text_splitter(chunk_size, chunk_overlap)
+        num_paginas = 0
+        fragmentos = []
+        acierto_cache, paginas = cache_texto_pdf.abrir_paginas_pdf(file_path)
+        for doc_page in paginas:
+            num_paginas += 1
+            doc_page.metadata["source_document"] = filename
+            doc_page.metadata["page_number"] = doc_page.metadata.get('page', -1) + 1
+            fragmentos.extend((f.page_content, f.metadata) for f in text_splitter.split_documents([doc_page]))
+        return num_paginas, fragmentos, None, acierto_cache
+    except Exception as e:
+        return 0, [], f"{e}\n{traceback.format_exc()}", acierto_cache
+
+def _resultados_en_orden_acotado(rutas_pdf, chunk_size, chunk_overlap, num_procesos):
+    # Como executor.map, pero sin enviar todos los PDFs a la vez: como mucho 2 × num_procesos resultados en memoria.
+    # 'spawn' evita heredar los hilos del servidor (gunicorn) mediante fork.
+    with ProcessPoolExecutor(max_workers=num_procesos, mp_context=multiprocessing.get_context("spawn")) as executor:
+        rutas = iter(rutas_pdf)
+        pendientes = collections.deque(executor.submit(_cargar_y_fragmentar_pdf, ruta, chunk_size, chunk_overlap)
+                                       for ruta in itertools.islice(rutas, 2 * num_procesos))
+        while pendientes:
+            resultado = pendientes.popleft().result()
+            siguiente = next(rutas, None)
+            if siguiente is not None:
+                pendientes.append(executor.submit(_cargar_y_fragmentar_pdf, siguiente, chunk_size, chunk_overlap))
+            yield resultado
+
+def iterar_pdfs_fragmentados(carpeta_path, chunk_size, chunk_overlap, num_procesos=1, solo_archivos=None):
+    """
+    Genera (nombre_pdf, num_paginas, fragmentos) PDF a PDF, en el orden de os.listdir, sin acumular la carpeta entera:
+    la memoria depende del PDF más grande, no del tamaño de la base de conocimiento. Los PDFs que no se pueden cargar
+    se registran en el log y se omiten. Un PDF se entrega completo para no retener el lock global del parser de
+    PyMuPDF mientras quien consume los fragmentos calcula sus embeddings.
+    """
     if not os.path.isdir(carpeta_path):
         logger.error(f"Error: La carpeta de base de conocimiento especificada no existe: {carpeta_path}")
-        return []
+        return
 
     logger.info(f"Procesando PDFs desde la carpeta de base de conocimiento: {carpeta_path}")
-    pdf_files_found = False
-    for filename in os.listdir(carpeta_path):
-        if filename.lower().endswith(".pdf"):
-            pdf_files_found = True
-            file_path = os.path.join(carpeta_path, filename)
-            try:
-                loader = PyMuPDFLoader(file_path)
-                docs_del_pdf = loader.load()
-                for doc_page in docs_del_pdf:
-                    doc_page.metadata["source_document"] = filename
-                    doc_page.metadata["page_number"] = doc_page.metadata.get('page', -1) + 1
-                documentos_cargados.extend(docs_del_pdf)
-                logger.info(f"  Cargado y procesado preliminarmente: {filename} ({len(docs_del_pdf)} páginas)")
-            except Exception as e:
-                logger.error(f"  Error al cargar o procesar {filename}: {e}")
-                logger.debug(traceback.format_exc())
-    
-    if not pdf_files_found:
+    # Se conserva el orden de os.listdir para que los fragmentos salgan en el mismo orden en ambos modos.
+    nombres_pdf = [f for f in os.listdir(carpeta_path) if f.lower().endswith(".pdf")]
+    if solo_archivos is not None: # Indexación incremental: procesar solo los archivos indicados
+        nombres_pdf = [f for f in nombres_pdf if f in solo_archivos]
+    if not nombres_pdf:
         logger.warning(f"No se encontraron archivos PDF en la carpeta: {carpeta_path}")
-        return []
-    if not documentos_cargados:
+        return
+
+    rutas_pdf = [os.path.join(carpeta_path, f) for f in nombres_pdf]
+    num_procesos = max(1, min(int(num_procesos or 1), len(rutas_pdf)))
+    if num_procesos > 1:
+        logger.info(f"Ingesta en paralelo con {num_procesos} procesos para {len(rutas_pdf)} PDFs.")
+        resultados = _resultados_en_orden_acotado(rutas_pdf, chunk_size, chunk_overlap, num_procesos)
+    else:
+        resultados = (_cargar_y_fragmentar_pdf(ruta, chunk_size, chunk_overlap) for ruta in rutas_pdf)
+
+    archivos_cargados = 0
+    inicio = time.time()
+    for filename, (num_paginas, fragmentos_pdf, error, acierto_cache) in zip(nombres_pdf, resultados):
+        # Con el pool de ingesta es el tiempo esperando a los workers, la parte de la lectura que no se solapa
+        metricas.sumar("segundos_lectura_pdfs", time.time() - inicio)
+        cache_texto_pdf.registrar_consulta(acierto_cache)
+        if error:
+            logger.error(f"  Error al cargar o procesar {filename}: {error.splitlines()[0]}")
+            logger.debug(error)
+            continue
+        archivos_cargados += 1
+        metricas.sumar("paginas_leidas", num_paginas)
+        logger.info(f"  Cargado y procesado preliminarmente: {filename} ({num_paginas} páginas, {len(fragmentos_pdf)} fragmentos)")
+        yield filename, num_paginas, [Document(page_content=texto, metadata=metadata) for texto, metadata in fragmentos_pdf]
+        inicio = time.time()
+
+    if not archivos_cargados:
         logger.error(f"No se pudieron cargar documentos PDF válidos de: {carpeta_path}")
-        return []
 
+def cargar_y_procesar_pdfs_de_carpeta(carpeta_path, chunk_size, chunk_overlap, num_procesos=1, solo_archivos=None): # Nombre de tu función original
+    """Todos los fragmentos de la carpeta en una lista. Para indexar bases grandes, usar iterar_pdfs_fragmentados."""
+    fragmentos = []
     try:
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            length_function=len,
-            add_start_index=True
-        )
-        fragmentos = text_splitter.split_documents(documentos_cargados)
-        logger.info(f"Total de fragmentos generados de la carpeta '{os.path.basename(carpeta_path)}': {len(fragmentos)}")
-        return fragmentos
+        for _, _, fragmentos_pdf in iterar_pdfs_fragmentados(carpeta_path, chunk_size, chunk_overlap,
+                                                             num_procesos=num_procesos, solo_archivos=solo_archivos):
+            fragmentos.extend(fragmentos_pdf)
     except Exception as e:
-        logger.error(f"Error durante la división de texto: {e}")
+        logger.error(f"Error durante la ingesta de PDFs de '{carpeta_path}': {e}")
         logger.debug(traceback.format_exc())
         return []
+    if not fragmentos:
+        return []
+
+    logger.info(f"Total de fragmentos generados de la carpeta '{os.path.basename(carpeta_path)}': {len(fragmentos)}")
+    return fragmentos
 
 def procesar_pdf_proyecto_para_analisis(ruta_pdf_proyecto, chunk_size, chunk_overlap, max_chars_proyecto): # Nombre de tu función original
     if not os.path.exists(ruta_pdf_proyecto):
@@ -92,8 +164,7 @@ def procesar_pdf_proyecto_para_analisis(ruta_pdf_proyecto, chunk_size, chunk_ove
 
     logger.info(f"Procesando el documento para análisis: {os.path.basename(ruta_pdf_proyecto)}")
     try:
-        loader_proyecto = PyMuPDFLoader(ruta_pdf_proyecto)
-        doc_proyecto_raw = loader_proyecto.load()
+        doc_proyecto_raw = cache_texto_pdf.cargar_paginas_pdf(ruta_pdf_proyecto)
 
         if not doc_proyecto_raw:
             logger.warning(f"No se pudo cargar contenido de {os.path.basename(ruta_pdf_proyecto)}.")
@@ -105,11 +176,10 @@ def procesar_pdf_proyecto_para_analisis(ruta_pdf_proyecto, chunk_size, chunk_ove
         
         # Si el texto es para una consulta directa al LLM, a veces es mejor no fragmentarlo tanto,
         # o usar un chunk_size grande. Aquí se concatenará.
-        text_splitter_proyecto = RecursiveCharacterTextSplitter(
+        text_splitter_proyecto = FragmentadorRecursivo(
             # Usar parámetros más grandes o simplemente concatenar si la fragmentación no es deseada aquí
             chunk_size=chunk_size * 5, # Ejemplo: chunks más grandes para el texto del proyecto
             chunk_overlap=chunk_overlap * 2,
-            length_function=len,
             add_start_index=True
         )
         fragmentos_proyecto = text_splitter_proyecto.split_documents(doc_proyecto_raw)
@@ -137,6 +207,38 @@ def procesar_pdf_proyecto_para_analisis(ruta_pdf_proyecto, chunk_size, chunk_ove
         logger.debug(traceback.format_exc())
         return None
 
+def dividir_pdf_proyecto_en_secciones(ruta_pdf_proyecto, max_chars_seccion, chunk_overlap, max_secciones):
+    """
+    Divide el texto completo del PDF del proyecto en secciones de hasta `max_chars_seccion` caracteres, sin truncar.
+    Si salen más de `max_secciones`, se agranda el tamaño de sección para que todo el documento quepa en ese número.
+    Devuelve la lista de secciones (strings), o None si falla.
+    """
+    if not os.path.exists(ruta_pdf_proyecto):
+        logger.error(f"Error: El archivo PDF del proyecto a analizar no existe: {ruta_pdf_proyecto}")
+        return None
+    try:
+        paginas = cache_texto_pdf.cargar_paginas_pdf(ruta_pdf_proyecto)
+        texto_completo = "\n\n".join(p.page_content for p in paginas if p.page_content.strip())
+        if not texto_completo.strip():
+            logger.error(f"El documento del proyecto '{os.path.basename(ruta_pdf_proyecto)}' no contiene texto extraíble.")
+            return None
+
+        tamano_seccion = max_chars_seccion
+        while True:
+            splitter = FragmentadorRecursivo(chunk_size=tamano_seccion, chunk_overlap=chunk_overlap)
+            secciones = [s for s in splitter.split_text(texto_completo) if s.strip()]
+            if len(secciones) <= max_secciones:
+                break
+            # Las secciones salen algo más cortas que el máximo (se corta en párrafos); se agrandan en proporción.
+            tamano_seccion = int(tamano_seccion * len(secciones) / max_secciones) + 1
+            logger.info(f"Más de {max_secciones} secciones: se reintenta con secciones de hasta {tamano_seccion} caracteres.")
+        logger.info(f"Proyecto '{os.path.basename(ruta_pdf_proyecto)}' dividido en {len(secciones)} secciones ({len(texto_completo)} caracteres en total).")
+        return secciones
+    except Exception as e:
+        logger.error(f"Error al dividir en secciones el PDF del proyecto '{os.path.basename(ruta_pdf_proyecto)}': {e}")
+        logger.debug(traceback.format_exc())
+        return None
+
 if __name__ == '__main__':
     if not logging.getLogger().handlers:
         logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
@@ -0,0 +1,214 @@
+# scripts/embedding_cache.py
+import os
+import sqlite3
+import hashlib
+import threading
+import time
+import unicodedata
+import logging
+import traceback
+from contextlib import contextmanager
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+_INDICE_FILENAME = "indice.sqlite3"
+_VECTORES_FILENAME = "vectores.f32"
+_MAX_PARAMETROS_SQL = 500 # Límite de claves por consulta IN (...)
+_ESPERA_BLOQUEO_SEGUNDOS = 30 # Espera máxima por el bloqueo de escritura de otro proceso
+
+def normalizar_texto(texto):
+    # Unicode NFC y espacios colapsados: variaciones de espaciado no cambian la tokenización del modelo.
+    return " ".join(unicodedata.normalize("NFC", texto).split())
+
+def clave_embedding(modelo_id, texto):
+    return hashlib.sha256(f"{modelo_id}\x00{normalizar_texto(texto)}".encode("utf-8")).hexdigest()
+
+class CacheEmbeddings(Embeddings):
+    """
+    Envuelve una función de embeddings y guarda en disco los vectores ya calculados.
+    Los vectores viven en un archivo memory-mapped (numpy.memmap) de capacidad fija y un índice SQLite
+    asocia cada clave (modelo + hash del texto normalizado) con su posición. Al llenarse, se reutilizan
+    las posiciones menos usadas recientemente (LRU). El directorio puede compartirse entre procesos (CLI y servidor):
+    las lecturas y escrituras del índice y de los vectores se hacen en transacciones BEGIN IMMEDIATE.
+    """
+
+    def __init__(self, embeddings_base, modelo_id, directorio_cache, max_entradas):
+        self.embeddings_base = embeddings_base
+        self.modelo_id = str(modelo_id)
+        self.max_entradas = int(max_entradas)
+        self.aciertos = 0
+        self.fallos = 0
+        self._lock = threading.Lock()
+        self._vectores = None
+        self._dimension = None
+
+        subdirectorio = hashlib.sha1(self.modelo_id.encode("utf-8")).hexdigest()[:16]
+        self.directorio = os.path.join(directorio_cache, subdirectorio)
+        os.makedirs(self.directorio, exist_ok=True)
+        # isolation_level=None: las transacciones se abren explícitamente con _transaccion()
+        self._conexion = sqlite3.connect(os.path.join(self.directorio, _INDICE_FILENAME), timeout=_ESPERA_BLOQUEO_SEGUNDOS,
+                                         check_same_thread=False, isolation_level=None)
+        with self._transaccion():
+            self._conexion.execute("CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT)")
+            self._conexion.execute("CREATE TABLE IF NOT EXISTS entradas (clave TEXT PRIMARY KEY, slot INTEGER NOT NULL, ultimo_acceso REAL NOT NULL)")
+            self._conexion.execute("CREATE INDEX IF NOT EXISTS idx_entradas_acceso ON entradas (ultimo_acceso)")
+            meta = dict(self._conexion.execute("SELECT clave, valor FROM meta").fetchall())
+            if meta.get("modelo_id", self.modelo_id) != self.modelo_id or \
+               int(meta.get("capacidad", self.max_entradas)) != self.max_entradas:
+                logger.warning(f"La cache de embeddings en '{self.directorio}' tiene otra capacidad o modelo. Se vaciará.")
+                self._vaciar()
+            elif "dimension" in meta:
+                self._abrir_vectores(int(meta["dimension"]))
+
+    @property
+    def model_name(self):
+        # Mantiene el identificador del modelo base (lo usa el manifest de la base de conocimiento).
+        return getattr(self.embeddings_base, "model_name", self.modelo_id)
+
+    @contextmanager
+    def _transaccion(self):
+        # BEGIN IMMEDIATE toma el bloqueo de escritura de SQLite al empezar: otro proceso que use el mismo directorio
+        # espera aquí, así que no puede reservar los mismos slots del memmap ni reutilizar uno mientras se lee.
+        self._conexion.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conexion.rollback()
+            raise
+        self._conexion.commit()
+
+    def _vaciar(self):
+        # Requiere una transacción abierta
+        self._conexion.execute("DELETE FROM entradas")
+        self._conexion.execute("DELETE FROM meta")
+        ruta_vectores = os.path.join(self.directorio, _VECTORES_FILENAME)
+        if os.path.exists(ruta_vectores):
+            os.remove(ruta_vectores)
+        self._vectores = None
+        self._dimension = None
+
+    def _abrir_vectores(self, dimension):
+        # Requiere una transacción abierta
+        ruta_vectores = os.path.join(self.directorio, _VECTORES_FILENAME)
+        modo = "r+" if os.path.exists(ruta_vectores) else "w+"
+        self._vectores = np.memmap(ruta_vectores, dtype=np.float32, mode=modo, shape=(self.max_entradas, dimension))
+        self._dimension = dimension
+        self._conexion.executemany("INSERT OR REPLACE INTO meta (clave, valor) VALUES (?, ?)", [
+            ("modelo_id", self.modelo_id), ("capacidad", str(self.max_entradas)), ("dimension", str(dimension))
+        ])
+
+    def _buscar(self, claves):
+        encontrados = {}
+        claves_unicas = list(dict.fromkeys(claves))
+        for i in range(0, len(claves_unicas), _MAX_PARAMETROS_SQL):
+            lote = claves_unicas[i:i + _MAX_PARAMETROS_SQL]
+            marcadores = ",".join("?" * len(lote))
+            for clave, slot in self._conexion.execute(f"SELECT clave, slot FROM entradas WHERE clave IN ({marcadores})", lote):
+                encontrados[clave] = slot
+        return encontrados
+
+    def _reservar_slots(self, cantidad):
+        # Requiere la transacción de _guardar. Los slots solo se liberan al expulsar (y se reutilizan en la misma
+        # transacción, que ningún otro proceso puede intercalar), así que los ocupados son 0..ocupados-1.
+        ocupados = self._conexion.execute("SELECT COUNT(*) FROM entradas").fetchone()[0]
+        libres = list(range(ocupados, min(self.max_entradas, ocupados + cantidad)))
+        faltan = cantidad - len(libres)
+        if faltan > 0: # Expulsar las entradas menos usadas recientemente
+            expulsadas = self._conexion.execute(
+                "SELECT clave, slot FROM entradas ORDER BY ultimo_acceso LIMIT ?", (faltan,)).fetchall()
+            self._conexion.executemany("DELETE FROM entradas WHERE clave = ?", [(c,) for c, _ in expulsadas])
+            libres.extend(slot for _, slot in expulsadas)
+        return libres
+
+    def _guardar(self, claves, vectores):
+        with self._transaccion():
+            if self._vectores is None:
+                self._abrir_vectores(len(vectores[0]))
+            # Otro hilo u otro proceso pudo haber guardado ya alguna clave: se omiten para no dejar slots huérfanos.
+            ya_guardadas = self._buscar(claves)
+            pares = [(c, v) for c, v in dict(zip(claves, vectores)).items() if c not in ya_guardadas][:self.max_entradas]
+            if not pares:
+                return
+            slots = self._reservar_slots(len(pares))
+            ahora = time.time()
+            for (clave, vector), slot in zip(pares, slots):
+                self._vectores[slot] = vector
+            self._vectores.flush() # Primero los vectores y después el índice que los referencia
+            self._conexion.executemany("INSERT OR REPLACE INTO entradas (clave, slot, ultimo_acceso) VALUES (?, ?, ?)",
+                                       [(clave, slot, ahora) for (clave, _), slot in zip(pares, slots)])
+
+    def _embeber_con_cache(self, textos, funcion_base):
+        claves = [clave_embedding(self.modelo_id, t) for t in textos]
+        resultados = [None] * len(textos)
+        encontrados = {}
+        with self._lock:
+            with self._transaccion(): # Ningún proceso puede reutilizar un slot mientras se copia su vector
+                if self._vectores is None: # Otro proceso pudo haber creado los vectores después de abrir la cache
+                    dimension = self._conexion.execute("SELECT valor FROM meta WHERE clave = 'dimension'").fetchone()
+                    if dimension:
+                        self._abrir_vectores(int(dimension[0]))
+                if self._vectores is not None:
+                    encontrados = self._buscar(claves)
+                    for i, clave in enumerate(claves):
+                        if clave in encontrados:
+                            resultados[i] = self._vectores[encontrados[clave]].tolist()
+                    if encontrados:
+                        ahora = time.time()
+                        self._conexion.executemany("UPDATE entradas SET ultimo_acceso = ? WHERE clave = ?",
+                                                   [(ahora, c) for c in encontrados])
+
+        pendientes = {} # clave -> texto, deduplicado
+        for i, clave in enumerate(claves):
+            if resultados[i] is None:
+                pendientes.setdefault(clave, textos[i])
+        aciertos = len(textos) - sum(1 for r in resultados if r is None)
+
+        if pendientes:
+            vectores_nuevos = funcion_base(list(pendientes.values()))
+            calculados = dict(zip(pendientes.keys(), vectores_nuevos))
+            for i, clave in enumerate(claves):
+                if resultados[i] is None:
+                    resultados[i] = list(calculados[clave])
+            with self._lock:
+                try:
+                    self._guardar(list(calculados.keys()), list(calculados.values()))
+                except Exception as e_guardar: # La transacción ya se deshizo
+                    logger.warning(f"No se pudieron guardar embeddings en la cache: {e_guardar}")
+                    logger.debug(traceback.format_exc())
+
+        with self._lock:
+            self.aciertos += aciertos
+            self.fallos += len(textos) - aciertos
+        return resultados
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        return self._embeber_con_cache(texts, self.embeddings_base.embed_documents)
+
+    def embed_query(self, text):
+        return self._embeber_con_cache([text], lambda t: [self.embeddings_base.embed_query(t[0])])[0]
+
+    def estadisticas(self):
+        with self._lock:
+            entradas = self._conexion.execute("SELECT COUNT(*) FROM entradas").fetchone()[0]
+            total = self.aciertos + self.fallos
+            return {
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "tasa_aciertos": (self.aciertos / total) if total else 0.0,
+                "entradas": entradas,
+                "capacidad": self.max_entradas
+            }
+
+    def registrar_estadisticas(self):
+        e = self.estadisticas()
+        logger.info(f"Cache de embeddings: {e['aciertos']} aciertos, {e['fallos']} fallos "
+                    f"(tasa de aciertos {e['tasa_aciertos']:.1%}), {e['entradas']}/{e['capacidad']} entradas.")
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo embedding_cache.py cargado.")
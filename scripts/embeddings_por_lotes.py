@@ -0,0 +1,108 @@
+# scripts/embeddings_por_lotes.py
+import time
+import threading
+import logging
+from langchain_core.embeddings import Embeddings
+
+from . import metricas
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingsPorLongitud(Embeddings):
+    """
+    Envuelve una función de embeddings y la llama en lotes de `batch_size` textos de longitud (en tokens) parecida:
+    cada lote se rellena hasta su texto más largo, así que agrupar las colas de página cortas con otras cortas ahorra
+    buena parte del cómputo. Los vectores se devuelven en el orden original. Lleva la cuenta de fragmentos/s y de la
+    fracción de tokens útiles (sin relleno) para ajustar el tamaño de lote en cada máquina. Con un pool de procesos
+    (pool_embeddings) los lotes se calculan en paralelo.
+    """
+
+    def __init__(self, embeddings_base, tokenizer, max_seq_length, batch_size=32, agrupar=True):
+        self.embeddings_base = embeddings_base
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.batch_size = max(1, int(batch_size))
+        self.agrupar = agrupar
+        self.pool = None # PoolEmbeddings mientras se reconstruye la base vectorial con varios procesos
+        self._lock = threading.Lock()
+        self.fragmentos = 0
+        self.segundos = 0.0
+        self.tokens_utiles = 0
+        self.tokens_con_relleno = 0
+
+    @property
+    def model_name(self):
+        # El manifest de la base de conocimiento y la cache de embeddings identifican el modelo base
+        return getattr(self.embeddings_base, "model_name", type(self.embeddings_base).__name__)
+
+    def longitudes_en_tokens(self, textos):
+        codificados = self.tokenizer([t.replace("\n", " ") for t in textos], truncation=True,
+                                     max_length=self.max_seq_length, add_special_tokens=True)
+        return [len(ids) for ids in codificados["input_ids"]]
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        inicio = time.perf_counter()
+        longitudes = self.longitudes_en_tokens(texts)
+        orden = sorted(range(len(texts)), key=lambda i: longitudes[i]) if self.agrupar else list(range(len(texts)))
+        lotes = [orden[desde:desde + self.batch_size] for desde in range(0, len(orden), self.batch_size)]
+        textos_lotes = [[texts[i] for i in lote] for lote in lotes]
+        if self.pool is not None:
+            vectores_lotes = self.pool.embeber_lotes(textos_lotes)
+        else:
+            vectores_lotes = [self.embeddings_base.embed_documents(textos) for textos in textos_lotes]
+        resultados = [None] * len(texts)
+        for lote, vectores in zip(lotes, vectores_lotes):
+            for i, vector in zip(lote, vectores):
+                resultados[i] = vector
+        tokens_con_relleno = sum(max(longitudes[i] for i in lote) * len(lote) for lote in lotes)
+        segundos = time.perf_counter() - inicio
+        with self._lock:
+            self.fragmentos += len(texts)
+            self.segundos += segundos
+            self.tokens_utiles += sum(longitudes)
+            self.tokens_con_relleno += tokens_con_relleno
+        metricas.sumar("fragmentos_embebidos", len(texts))
+        metricas.sumar("segundos_embeddings", segundos)
+        return resultados
+
+    def embed_query(self, text):
+        return self.embeddings_base.embed_query(text)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "fragmentos": self.fragmentos,
+                "segundos": round(self.segundos, 4),
+                "fragmentos_por_segundo": round(self.fragmentos / self.segundos, 2) if self.segundos else None,
+                "fraccion_tokens_utiles": round(self.tokens_utiles / self.tokens_con_relleno, 4) if self.tokens_con_relleno else None,
+                "batch_size": self.batch_size
+            }
+
+def obtener_tokenizador(embedding_function):
+    """(tokenizer, max_seq_length) del backend torch (SentenceTransformer) u ONNX, o (None, None) si no se reconoce."""
+    cliente = getattr(embedding_function, "client", None) # SentenceTransformerEmbeddings
+    if cliente is not None and hasattr(cliente, "tokenizer"):
+        return cliente.tokenizer, cliente.max_seq_length
+    if hasattr(embedding_function, "tokenizer"): # OnnxSentenceEmbeddings
+        return embedding_function.tokenizer, embedding_function.max_seq_length
+    return None, None
+
+def crear_embeddings_por_longitud(embedding_function, batch_size, agrupar=True):
+    tokenizer, max_seq_length = obtener_tokenizador(embedding_function)
+    if tokenizer is None:
+        logger.warning(f"No se encontró el tokenizador de {type(embedding_function).__name__}; los embeddings no se agruparán por longitud.")
+        return embedding_function
+    return EmbeddingsPorLongitud(embedding_function, tokenizer, max_seq_length, batch_size, agrupar)
+
+def buscar_embeddings_por_longitud(embedding_function):
+    """El EmbeddingsPorLongitud dentro de la cadena de envoltorios (p. ej. bajo CacheEmbeddings), o None."""
+    while embedding_function is not None and not isinstance(embedding_function, EmbeddingsPorLongitud):
+        embedding_function = getattr(embedding_function, "embeddings_base", None)
+    return embedding_function
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo embeddings_por_lotes.py cargado.")
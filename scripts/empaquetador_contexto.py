@@ -0,0 +1,131 @@
+# scripts/empaquetador_contexto.py
+import re
+import time
+import math
+import logging
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from .bm25_index import tokenizar
+from . import metricas # Como módulo: metricas también importa este
+
+logger = logging.getLogger(__name__)
+
+CHARS_POR_TOKEN = 4 # Estimación para texto en español con el tokenizador de Gemini; no requiere llamar a la API
+TOKENS_SEPARADOR = 1 # "\n\n" entre fragmentos en la cadena "stuff"
+MIN_TOKENS_FRAGMENTO = 40 # Un fragmento recortado por debajo de esto ya no aporta contexto útil
+
+_PATRON_FRASES = re.compile(r"(?<=[.!?;:])\s+|\n{2,}")
+_PALABRAS_VACIAS = {
+    "para", "como", "esta", "este", "estos", "estas", "esto", "entre", "sobre", "desde", "hasta", "cuando", "donde",
+    "tambien", "pero", "porque", "segun", "debe", "deben", "puede", "pueden", "cada", "todo", "todos", "otros", "otras",
+    "mismo", "misma", "sera", "sido", "tiene", "tienen", "with", "from", "that", "this", "have", "which"
+}
+
+def estimar_tokens(texto):
+    return math.ceil(len(texto or "") / CHARS_POR_TOKEN)
+
+def _terminos_significativos(texto):
+    return {t for t in tokenizar(texto) if len(t) > 3 and t not in _PALABRAS_VACIAS}
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def _recortar_a_frases_relevantes(texto, terminos_consulta, umbral_relevancia, max_tokens):
+    """
+    Conserva las frases del fragmento que comparten términos con la consulta (proporción >= umbral_relevancia),
+    en su orden original y marcando con "[...]" lo omitido; si ninguna llega al umbral se conservan todas.
+    Si aun así no cabe en max_tokens, se quitan primero las frases menos relevantes. Un fragmento que cabe entero se
+    conserva aunque sea corto; uno recortado por debajo de MIN_TOKENS_FRAGMENTO se descarta.
+    Devuelve (texto, recortado) o (None, True) si no queda nada útil.
+    """
+    frases = [f.strip() for f in _PATRON_FRASES.split(texto) if f and f.strip()]
+    if not frases:
+        return None, True
+    relevancias = []
+    for frase in frases:
+        terminos = _terminos_significativos(frase)
+        relevancias.append(len(terminos & terminos_consulta) / len(terminos) if terminos else 0.0)
+
+    seleccion = {i for i, r in enumerate(relevancias) if r >= umbral_relevancia}
+    if not seleccion: # Sin coincidencias léxicas se confía en el retriever (p. ej. sinónimos) y se mantiene entero
+        seleccion = set(range(len(frases)))
+    for i in sorted(seleccion, key=relevancias.__getitem__):
+        if len(seleccion) == 1 or sum(estimar_tokens(frases[j]) + 1 for j in seleccion) <= max_tokens:
+            break
+        seleccion.discard(i)
+
+    partes = []
+    for i in range(len(frases)):
+        if i in seleccion:
+            partes.append(frases[i])
+        elif not partes or partes[-1] != "[...]":
+            partes.append("[...]")
+    resultado = " ".join(partes)
+    recortado = len(seleccion) < len(frases)
+    if estimar_tokens(resultado) > max_tokens:
+        resultado = resultado[:max_tokens * CHARS_POR_TOKEN].rsplit(" ", 1)[0] + " [...]"
+        recortado = True
+    if recortado and estimar_tokens(resultado) < min(MIN_TOKENS_FRAGMENTO, max_tokens):
+        return None, True
+    return resultado, recortado
+
+def empaquetar_contexto(consulta, documentos, presupuesto_tokens, umbral_duplicados=0.8, umbral_relevancia=0.15):
+    """
+    Llena `presupuesto_tokens` con los fragmentos en orden de relevancia (el orden en que llegan del retriever):
+    descarta los casi duplicados de uno ya incluido (Jaccard de términos >= umbral_duplicados) y recorta cada
+    fragmento a sus frases relevantes para la consulta. Devuelve la lista de Documents a incluir en el prompt.
+    """
+    inicio = time.perf_counter()
+    terminos_consulta = _terminos_significativos(consulta)
+    incluidos, terminos_incluidos = [], []
+    tokens_usados = duplicados = recortados = 0
+    for documento in documentos:
+        disponibles = presupuesto_tokens - tokens_usados - (TOKENS_SEPARADOR if incluidos else 0)
+        if disponibles <= 0:
+            break
+        terminos = _terminos_significativos(documento.page_content)
+        if any(_jaccard(terminos, previos) >= umbral_duplicados for previos in terminos_incluidos):
+            duplicados += 1
+            continue
+        texto, recortado = _recortar_a_frases_relevantes(documento.page_content, terminos_consulta,
+                                                         umbral_relevancia, disponibles)
+        if texto is None:
+            continue
+        recortados += int(recortado)
+        tokens_usados += estimar_tokens(texto) + (TOKENS_SEPARADOR if incluidos else 0)
+        incluidos.append(Document(page_content=texto, metadata=dict(documento.metadata or {}), id=getattr(documento, "id", None)))
+        terminos_incluidos.append(terminos)
+
+    segundos = time.perf_counter() - inicio
+    metricas.registrar_etapa("empaquetado_contexto", segundos)
+    logger.info(f"Contexto empaquetado: {len(incluidos)} de {len(documentos)} fragmentos, ~{tokens_usados} de "
+                f"{presupuesto_tokens} tokens ({duplicados} casi duplicados descartados, {recortados} recortados) "
+                f"en {segundos * 1000:.1f} ms.")
+    return incluidos
+
+class RetrieverEmpaquetado(BaseRetriever):
+    """
+    Sustituye el k fijo por un presupuesto de tokens para todo el prompt: al presupuesto se le restan la plantilla
+    y la consulta (la descripción del proyecto), y el resto se llena con los candidatos del retriever base.
+    """
+
+    retriever_base: BaseRetriever
+    presupuesto_tokens_prompt: int = 12000
+    tokens_plantilla: int = 0
+    min_tokens_contexto: int = 1000
+    umbral_duplicados: float = 0.8
+    umbral_relevancia: float = 0.15
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        presupuesto_contexto = max(self.min_tokens_contexto,
+                                   self.presupuesto_tokens_prompt - self.tokens_plantilla - estimar_tokens(query))
+        candidatos = self.retriever_base.invoke(query)
+        return empaquetar_contexto(query, candidatos, presupuesto_contexto,
+                                   umbral_duplicados=self.umbral_duplicados, umbral_relevancia=self.umbral_relevancia)
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo empaquetador_contexto.py cargado.")
@@ -0,0 +1,122 @@
+# scripts/fragmentador.py
+# Fragmentador equivalente a RecursiveCharacterTextSplitter (separadores "\n\n", "\n", " ", "" conservados al inicio de
+# cada pieza, length_function=len, strip_whitespace y add_start_index), escrito para ser rápido sobre bases grandes:
+# las piezas son posiciones (inicio, fin) sobre el texto de la página en lugar de subcadenas, se buscan los separadores
+# con str.find y str.split en vez de expresiones regulares, y la posición de cada fragmento se conoce al formarlo, así que
+# start_index no necesita buscar el fragmento en todo el texto. Produce los mismos fragmentos, start_index y metadatos.
+import copy
+import itertools
+from langchain_text_splitters import TextSplitter
+from langchain_core.documents import Document
+
+SEPARADORES_POR_DEFECTO = ["\n\n", "\n", " ", ""]
+_TIPOS_INMUTABLES = (str, int, float, bool, type(None))
+
+class FragmentadorRecursivo(TextSplitter):
+    """
+    Sustituto de RecursiveCharacterTextSplitter(chunk_size, chunk_overlap, length_function=len, add_start_index=...)
+    con los separadores por defecto (o una lista de separadores literales) y keep_separator=True.
+    """
+
+    def __init__(self, chunk_size=4000, chunk_overlap=200, separators=None, add_start_index=False):
+        super().__init__(chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=len,
+                         keep_separator=True, add_start_index=add_start_index, strip_whitespace=True)
+        self._separators = list(separators or SEPARADORES_POR_DEFECTO)
+
+    def _piezas(self, texto, inicio, fin, separador):
+        # Como re.split con el separador al inicio de cada pieza (keep_separator=True), sin piezas vacías
+        if not separador:
+            return [(i, i + 1) for i in range(inicio, fin)]
+        partes = texto[inicio:fin].split(separador)
+        largo_separador = len(separador)
+        limites = list(itertools.accumulate([len(p) + largo_separador for p in partes], initial=inicio - largo_separador))
+        limites[0] = inicio # La primera pieza no empieza con el separador
+        return [(a, b) for a, b in zip(limites, limites[1:]) if b > a]
+
+    def _fragmentar(self, texto, inicio, fin, separadores, fragmentos):
+        separador = separadores[-1]
+        siguientes = []
+        for i, candidato in enumerate(separadores):
+            if candidato == "":
+                separador = candidato
+                break
+            if texto.find(candidato, inicio, fin) != -1:
+                separador = candidato
+                siguientes = separadores[i + 1:]
+                break
+
+        buenas = []
+        for pieza in self._piezas(texto, inicio, fin, separador):
+            if pieza[1] - pieza[0] < self._chunk_size:
+                buenas.append(pieza)
+                continue
+            if buenas:
+                self._fusionar(texto, buenas, fragmentos)
+                buenas = []
+            if not siguientes:
+                self._agregar(texto, pieza[0], pieza[1], fragmentos, recortar=False)
+            else:
+                self._fragmentar(texto, pieza[0], pieza[1], siguientes, fragmentos)
+        if buenas:
+            self._fusionar(texto, buenas, fragmentos)
+
+    def _fusionar(self, texto, piezas, fragmentos):
+        # TextSplitter._merge_splits con separador vacío: las piezas son consecutivas, así que cada fragmento es un
+        # único corte del texto desde la primera pieza retenida hasta la última.
+        actuales = []
+        primera = 0 # Índice en `actuales` de la primera pieza retenida
+        total = 0
+        for pieza in piezas:
+            largo = pieza[1] - pieza[0]
+            if total + largo > self._chunk_size and primera < len(actuales):
+                self._agregar(texto, actuales[primera][0], actuales[-1][1], fragmentos)
+                while total > self._chunk_overlap or (total + largo > self._chunk_size and total > 0):
+                    total -= actuales[primera][1] - actuales[primera][0]
+                    primera += 1
+            actuales.append(pieza)
+            total += largo
+        if primera < len(actuales):
+            self._agregar(texto, actuales[primera][0], actuales[-1][1], fragmentos)
+
+    @staticmethod
+    def _agregar(texto, inicio, fin, fragmentos, recortar=True):
+        # Las piezas que ni el último separador puede partir se entregan sin strip (como en LangChain)
+        fragmento = texto[inicio:fin]
+        if recortar:
+            sin_espacios_iniciales = fragmento.lstrip()
+            inicio += len(fragmento) - len(sin_espacios_iniciales)
+            fragmento = sin_espacios_iniciales.rstrip()
+            if not fragmento:
+                return
+        fragmentos.append((fragmento, inicio))
+
+    def _fragmentos_con_posicion(self, texto):
+        fragmentos = []
+        self._fragmentar(texto, 0, len(texto), self._separators, fragmentos)
+        return fragmentos
+
+    def split_text(self, text):
+        return [fragmento for fragmento, _ in self._fragmentos_con_posicion(text)]
+
+    def create_documents(self, texts, metadatas=None):
+        _metadatas = metadatas or [{}] * len(texts)
+        documentos = []
+        for texto, metadata_base in zip(texts, _metadatas):
+            # Metadatos planos (los de PyMuPDF): una copia superficial equivale a la deepcopy de LangChain
+            plana = all(isinstance(valor, _TIPOS_INMUTABLES) for valor in metadata_base.values())
+            indice = 0
+            largo_anterior = 0
+            for fragmento, posicion in self._fragmentos_con_posicion(texto):
+                metadata = dict(metadata_base) if plana else copy.deepcopy(metadata_base)
+                if self._add_start_index:
+                    # LangChain busca el fragmento desde el final del anterior menos el solape y se queda con la primera
+                    # aparición; esta existe en `posicion`, así que basta buscar hasta ahí (el resultado es el mismo).
+                    desde = max(0, indice + largo_anterior - self._chunk_overlap)
+                    if posicion >= desde:
+                        indice = texto.find(fragmento, desde, posicion + len(fragmento))
+                    else:
+                        indice = texto.find(fragmento, desde)
+                    metadata["start_index"] = indice
+                    largo_anterior = len(fragmento)
+                documentos.append(Document(page_content=fragmento, metadata=metadata))
+        return documentos
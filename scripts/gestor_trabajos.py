@@ -0,0 +1,220 @@
+# scripts/gestor_trabajos.py
+import time
+import uuid
+import threading
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+ESTADO_EN_COLA = "en_cola"
+ESTADO_EN_EJECUCION = "en_ejecucion"
+ESTADO_COMPLETADO = "completado"
+ESTADO_ERROR = "error"
+ESTADOS_FINALES = (ESTADO_COMPLETADO, ESTADO_ERROR)
+MAX_EVENTOS_TRABAJO = 2000 # Por encima, se descartan del historial los tokens del LLM más antiguos
+INTERVALO_PURGA_SEGUNDOS = 60
+
+class ColaLlenaError(Exception):
+    pass
+
+class Trabajo:
+    def __init__(self, descripcion="", limpieza=None):
+        self.id = uuid.uuid4().hex
+        self.descripcion = descripcion
+        self.limpieza = limpieza # Se llama al purgar el trabajo (p. ej. para borrar su espacio de trabajo)
+        self.estado = ESTADO_EN_COLA
+        self.etapa = "En cola"
+        self.progreso = 0
+        self.mensajes = []
+        self.error = None
+        self.resultado = {}
+        self.creado = time.time()
+        self.iniciado = None
+        self.finalizado = None
+        # Historial de eventos (progreso, tokens del LLM, riesgos, fin) para el endpoint SSE; cada evento tiene un id
+        # creciente para que un cliente que se reconecta (Last-Event-ID) reciba solo lo que le falta. Los eventos ya
+        # publicados no se modifican: al superar MAX_EVENTOS_TRABAJO se descartan los tokens más antiguos y su texto se
+        # acumula aparte, para entregar un evento "respuesta_completa" a quien llegue tarde (ver esperar_eventos).
+        self.eventos = []
+        self._ultimo_id_evento = 0
+        self._texto_descartado = ""
+        self._ultimo_id_descartado = 0
+        self._lock = threading.Lock()
+        self._nuevos_eventos = threading.Condition(self._lock)
+
+    def _publicar_evento(self, tipo, datos):
+        # Requiere tener self._lock
+        self._ultimo_id_evento += 1
+        self.eventos.append({"id": self._ultimo_id_evento, "tipo": tipo, "datos": datos})
+        if len(self.eventos) > MAX_EVENTOS_TRABAJO:
+            self._descartar_tokens_antiguos(len(self.eventos) - MAX_EVENTOS_TRABAJO // 2)
+        self._nuevos_eventos.notify_all()
+
+    def _descartar_tokens_antiguos(self, cantidad):
+        # Requiere tener self._lock. Solo tokens: los eventos de progreso y de riesgos son pocos y la página los necesita.
+        conservados = []
+        for evento in self.eventos:
+            if cantidad > 0 and evento["tipo"] == "token":
+                self._texto_descartado += evento["datos"].get("texto", "")
+                self._ultimo_id_descartado = evento["id"]
+                cantidad -= 1
+            else:
+                conservados.append(evento)
+        self.eventos = conservados
+
+    def publicar_evento(self, tipo, datos):
+        with self._lock:
+            self._publicar_evento(tipo, datos)
+
+    def esperar_eventos(self, desde_id, timeout):
+        """
+        Devuelve los eventos con id > desde_id, esperando hasta `timeout` segundos si no hay ninguno. El último es "fin".
+        Si alguno de los tokens que le faltan a ese cliente ya se descartó, en lugar de los tokens recibe un único evento
+        "respuesta_completa" con todo el texto emitido hasta ahora, que sustituye (no se añade a) lo que ya mostraba.
+        """
+        with self._lock:
+            if self._ultimo_id_evento <= desde_id:
+                self._nuevos_eventos.wait(timeout)
+            pendientes = [evento for evento in self.eventos if evento["id"] > desde_id]
+            if desde_id >= self._ultimo_id_descartado:
+                return pendientes
+            tokens = [evento for evento in self.eventos if evento["tipo"] == "token"]
+            respuesta = {"id": tokens[-1]["id"] if tokens else self._ultimo_id_descartado, "tipo": "respuesta_completa",
+                         "datos": {"texto": self._texto_descartado + "".join(e["datos"].get("texto", "") for e in tokens)}}
+            otros = [evento for evento in pendientes if evento["tipo"] != "token"]
+            anteriores = [evento for evento in otros if evento["id"] < respuesta["id"]]
+            return anteriores + [respuesta] + [evento for evento in otros if evento["id"] > respuesta["id"]]
+
+    def actualizar_progreso(self, etapa, progreso=None, mensaje=None):
+        with self._lock:
+            self.etapa = etapa
+            if progreso is not None:
+                self.progreso = max(self.progreso, min(100, int(progreso)))
+            if mensaje:
+                self.mensajes.append(mensaje)
+            self._publicar_evento("progreso", {"etapa": self.etapa, "progreso": self.progreso, "mensaje": mensaje})
+
+    def a_dict(self):
+        with self._lock:
+            return {
+                "id": self.id,
+                "descripcion": self.descripcion,
+                "estado": self.estado,
+                "etapa": self.etapa,
+                "progreso": self.progreso,
+                "mensajes": list(self.mensajes),
+                "error": self.error,
+                "creado": self.creado,
+                "iniciado": self.iniciado,
+                "finalizado": self.finalizado,
+                "duracion_segundos": round((self.finalizado or time.time()) - self.iniciado, 2) if self.iniciado else None
+            }
+
+class GestorTrabajos:
+    """
+    Ejecuta análisis en segundo plano con un número acotado de hilos.
+    Como máximo `max_concurrentes` trabajos corren a la vez y `max_en_cola` esperan; por encima se rechazan
+    (ColaLlenaError) para que la latencia se mantenga predecible bajo carga.
+    Los trabajos finalizados se conservan `ttl_segundos` para poder consultar su estado y descargar resultados; después
+    se purgan (con su `limpieza`) al encolar o consultar trabajos y, aunque no llegue ninguno, cada
+    INTERVALO_PURGA_SEGUNDOS desde un hilo en segundo plano.
+    """
+
+    def __init__(self, max_concurrentes=1, max_en_cola=10, ttl_segundos=3600):
+        self.max_concurrentes = max(1, int(max_concurrentes))
+        self.max_en_cola = max(0, int(max_en_cola))
+        self.ttl_segundos = ttl_segundos
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrentes, thread_name_prefix="analisis")
+        self._trabajos = {}
+        self._lock = threading.Lock()
+        self._detener_purga = threading.Event()
+        self._hilo_purga = threading.Thread(target=self._purgar_periodicamente, name="purga-trabajos", daemon=True)
+        self._hilo_purga.start()
+
+    def _extraer_caducados(self):
+        # Requiere tener self._lock; la limpieza (borrar espacios de trabajo) se hace después, fuera del lock
+        limite = time.time() - self.ttl_segundos
+        return [self._trabajos.pop(t.id) for t in list(self._trabajos.values())
+                if t.estado in ESTADOS_FINALES and t.finalizado < limite]
+
+    @staticmethod
+    def _limpiar(trabajos):
+        for trabajo in trabajos:
+            if trabajo.limpieza:
+                try:
+                    trabajo.limpieza()
+                except Exception as e:
+                    logger.warning(f"Error al limpiar el trabajo {trabajo.id}: {e}")
+
+    def purgar_finalizados(self):
+        with self._lock:
+            caducados = self._extraer_caducados()
+        self._limpiar(caducados)
+        return len(caducados)
+
+    def _purgar_periodicamente(self):
+        while not self._detener_purga.wait(min(INTERVALO_PURGA_SEGUNDOS, max(1, self.ttl_segundos))):
+            try:
+                purgados = self.purgar_finalizados()
+                if purgados:
+                    logger.info(f"{purgados} trabajos finalizados purgados por antigüedad.")
+            except Exception as e:
+                logger.warning(f"Error al purgar trabajos finalizados: {e}")
+
+    def enviar(self, funcion, descripcion="", limpieza=None, **kwargs):
+        """
+        Encola `funcion(trabajo, **kwargs)`; su valor de retorno (dict) queda en trabajo.resultado.
+        `limpieza` (opcional) se llama sin argumentos cuando el trabajo finalizado se purga.
+        """
+        with self._lock:
+            caducados = self._extraer_caducados()
+            pendientes = sum(1 for t in self._trabajos.values() if t.estado not in ESTADOS_FINALES)
+            if pendientes < self.max_concurrentes + self.max_en_cola:
+                trabajo = Trabajo(descripcion, limpieza)
+                self._trabajos[trabajo.id] = trabajo
+        self._limpiar(caducados)
+        if pendientes >= self.max_concurrentes + self.max_en_cola:
+            raise ColaLlenaError(f"Hay {pendientes} análisis en curso o en cola. Intente nuevamente en unos minutos.")
+        self._executor.submit(self._ejecutar, trabajo, funcion, kwargs)
+        logger.info(f"Trabajo {trabajo.id} encolado ({descripcion}). Pendientes: {pendientes + 1}.")
+        return trabajo
+
+    def _ejecutar(self, trabajo, funcion, kwargs):
+        with trabajo._lock:
+            trabajo.estado = ESTADO_EN_EJECUCION
+            trabajo.iniciado = time.time()
+        trabajo.actualizar_progreso("Iniciando análisis", 0)
+        try:
+            resultado = funcion(trabajo, **kwargs) or {}
+            with trabajo._lock:
+                trabajo.resultado = resultado
+                trabajo.estado = ESTADO_COMPLETADO if not resultado.get("error") else ESTADO_ERROR
+                trabajo.error = resultado.get("error")
+        except Exception as e:
+            logger.error(f"Error inesperado en el trabajo {trabajo.id}: {e}")
+            logger.error(traceback.format_exc())
+            with trabajo._lock:
+                trabajo.estado = ESTADO_ERROR
+                trabajo.error = f"Error interno inesperado: {e}"
+        finally:
+            with trabajo._lock:
+                trabajo.finalizado = time.time()
+                if trabajo.estado == ESTADO_COMPLETADO:
+                    trabajo.progreso = 100
+                    trabajo.etapa = "Completado"
+                trabajo._publicar_evento("fin", {"estado": trabajo.estado, "error": trabajo.error})
+            logger.info(f"Trabajo {trabajo.id} finalizado con estado '{trabajo.estado}' en {trabajo.finalizado - trabajo.iniciado:.2f} segundos.")
+
+    def obtener(self, id_trabajo):
+        with self._lock:
+            caducados = self._extraer_caducados()
+            trabajo = self._trabajos.get(id_trabajo)
+        self._limpiar(caducados)
+        return trabajo
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo gestor_trabajos.py cargado.")
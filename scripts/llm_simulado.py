@@ -0,0 +1,208 @@
+# scripts/llm_simulado.py
+# LLM simulado para medir el pipeline sin GEMINI_API_KEY: respuestas deterministas (mismo prompt -> mismo JSON de
+# "riesgos_identificados"), con latencia, streaming y tasa de errores configurables. Funciona en el mismo proceso
+# (LLM_PROVEEDOR=simulado) o como servidor HTTP local al que se conecta ChatSimulado con LLM_SIMULADO_URL.
+# Servidor: python -m scripts.llm_simulado [--puerto 8765] [--latencia 1.0] [--tasa-errores 0.1]
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import logging
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from pydantic import PrivateAttr
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+logger = logging.getLogger(__name__)
+
+RUTA_CHAT = "/v1/chat"
+CARACTERES_POR_FRAGMENTO = 16 # Tamaño aproximado de cada fragmento en streaming
+
+_CATALOGO_RIESGOS = [
+    ("Retraso en la entrega de la maquinaria por parte del proveedor", "Alto", "Media"),
+    ("Cimentación insuficiente para el peso y las vibraciones del equipo", "Alto", "Baja"),
+    ("Incompatibilidad del sistema de control con la red eléctrica existente", "Medio", "Media"),
+    ("Falta de personal capacitado para la puesta en marcha", "Medio", "Alta"),
+    ("Accidentes durante el izaje y posicionamiento del equipo", "Alto", "Baja"),
+    ("Desviación del presupuesto por costes de adecuación no previstos", "Medio", "Media"),
+    ("Documentación técnica incompleta o en otro idioma", "Bajo", "Alta"),
+    ("Interrupción de la producción durante la instalación", "Alto", "Media"),
+    ("Incumplimiento de normativa de seguridad de máquinas", "Alto", "Baja"),
+    ("Retrasos en la validación y aceptación final del equipo", "Medio", "Media"),
+]
+
+class ErrorLLMSimulado(Exception):
+    """Error inyectado; `code` imita el estado HTTP de la API (429 o 503) para que se trate como transitorio."""
+
+    def __init__(self, mensaje, code=503):
+        super().__init__(mensaje)
+        self.code = code
+
+def generar_respuesta_simulada(prompt, num_riesgos=4):
+    """JSON válido para report_utils con riesgos elegidos a partir del hash del prompt (determinista)."""
+    generador = random.Random(hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+    riesgos = []
+    for descripcion, impacto, probabilidad in generador.sample(_CATALOGO_RIESGOS, min(num_riesgos, len(_CATALOGO_RIESGOS))):
+        riesgos.append({
+            "descripcion_riesgo": descripcion,
+            "explicacion_riesgo": "Respuesta generada por el LLM simulado a partir del contexto proporcionado.",
+            "impacto_estimado": impacto,
+            "probabilidad_estimada": probabilidad
+        })
+    return "```json\n" + json.dumps({"riesgos_identificados": riesgos}, ensure_ascii=False, indent=2) + "\n```"
+
+def dividir_en_fragmentos(texto):
+    return [texto[i:i + CARACTERES_POR_FRAGMENTO] for i in range(0, len(texto), CARACTERES_POR_FRAGMENTO)]
+
+class SimuladorRespuestas:
+    """Latencia y errores compartidos por ChatSimulado (en proceso) y el servidor HTTP."""
+
+    def __init__(self, latencia_segundos=1.0, segundos_por_fragmento=0.02, tasa_errores=0.0, semilla=0, num_riesgos=4):
+        self.latencia_segundos = latencia_segundos
+        self.segundos_por_fragmento = segundos_por_fragmento
+        self.tasa_errores = tasa_errores
+        self.num_riesgos = num_riesgos
+        self._aleatorio = random.Random(semilla)
+        self._lock = threading.Lock()
+
+    def comprobar_error(self):
+        with self._lock:
+            falla = self._aleatorio.random() < self.tasa_errores
+            codigo = self._aleatorio.choice((429, 503))
+        if falla:
+            raise ErrorLLMSimulado(f"Error simulado del LLM (HTTP {codigo}).", code=codigo)
+
+    def fragmentos(self, prompt):
+        """Inyecta el error (si toca), espera la latencia inicial y entrega la respuesta por fragmentos."""
+        self.comprobar_error()
+        time.sleep(self.latencia_segundos)
+        for fragmento in dividir_en_fragmentos(generar_respuesta_simulada(prompt, self.num_riesgos)):
+            time.sleep(self.segundos_por_fragmento)
+            yield fragmento
+
+def _texto_prompt(messages):
+    return "\n".join(str(m.content) for m in messages)
+
+class ChatSimulado(BaseChatModel):
+    """
+    Chat model de LangChain que sustituye a Gemini. Sin `url_servidor` simula la respuesta en el mismo proceso;
+    con `url_servidor` la pide al servidor HTTP de este módulo (incluye la red y los errores HTTP reales).
+    """
+
+    latencia_segundos: float = 1.0
+    segundos_por_fragmento: float = 0.02
+    tasa_errores: float = 0.0
+    semilla: int = 0
+    num_riesgos: int = 4
+    url_servidor: Optional[str] = None
+    timeout: Optional[float] = None
+    _simulador: SimuladorRespuestas = PrivateAttr()
+
+    def model_post_init(self, __context):
+        self._simulador = SimuladorRespuestas(self.latencia_segundos, self.segundos_por_fragmento,
+                                              self.tasa_errores, self.semilla, self.num_riesgos)
+
+    @property
+    def _llm_type(self):
+        return "llm-simulado"
+
+    @property
+    def _identifying_params(self):
+        return {"model": "llm-simulado", "num_riesgos": self.num_riesgos}
+
+    def _fragmentos(self, messages):
+        prompt = _texto_prompt(messages)
+        if not self.url_servidor:
+            yield from self._simulador.fragmentos(prompt)
+            return
+        peticion = urllib.request.Request(self.url_servidor.rstrip("/") + RUTA_CHAT,
+                                          data=json.dumps({"prompt": prompt}).encode("utf-8"),
+                                          headers={"Content-Type": "application/json"})
+        # urllib lanza HTTPError (con `code`) para 429/503 y URLError (OSError) si el servidor no responde
+        with urllib.request.urlopen(peticion, timeout=self.timeout) as respuesta:
+            for linea in respuesta:
+                if linea.strip():
+                    yield json.loads(linea)["fragmento"]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        texto = "".join(self._fragmentos(messages))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=texto))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for fragmento in self._fragmentos(messages):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=fragmento))
+            if run_manager:
+                run_manager.on_llm_new_token(fragmento, chunk=chunk)
+            yield chunk
+
+def crear_servidor_llm_simulado(host="127.0.0.1", puerto=8765, **opciones_simulador):
+    """Servidor HTTP (un hilo por petición) que responde en streaming, una línea JSON {"fragmento": ...} por fragmento."""
+    simulador = SimuladorRespuestas(**opciones_simulador)
+
+    class ManejadorLLMSimulado(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            if self.path != RUTA_CHAT:
+                self.send_error(404)
+                return
+            cuerpo = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            fragmentos = simulador.fragmentos(cuerpo.get("prompt", ""))
+            try:
+                primero = next(fragmentos, None)
+            except ErrorLLMSimulado as e:
+                datos = json.dumps({"error": str(e)}).encode("utf-8")
+                self.send_response(e.code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(datos)))
+                self.end_headers()
+                self.wfile.write(datos)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for fragmento in self._iterar(primero, fragmentos):
+                linea = (json.dumps({"fragmento": fragmento}, ensure_ascii=False) + "\n").encode("utf-8")
+                self.wfile.write(f"{len(linea):X}\r\n".encode("ascii") + linea + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+
+        @staticmethod
+        def _iterar(primero, resto):
+            if primero is not None:
+                yield primero
+            yield from resto
+
+        def log_message(self, formato, *args):
+            logger.debug(f"{self.address_string()} - {formato % args}")
+
+    return ThreadingHTTPServer((host, puerto), ManejadorLLMSimulado)
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Servidor HTTP local que simula el LLM para pruebas de carga y latencia.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--puerto", type=int, default=8765)
+    parser.add_argument("--latencia", type=float, default=1.0, help="Segundos hasta el primer fragmento.")
+    parser.add_argument("--segundos-por-fragmento", type=float, default=0.02)
+    parser.add_argument("--tasa-errores", type=float, default=0.0, help="Fracción de peticiones que fallan con 429/503.")
+    parser.add_argument("--semilla", type=int, default=0)
+    args = parser.parse_args()
+
+    servidor = crear_servidor_llm_simulado(args.host, args.puerto, latencia_segundos=args.latencia,
+                                           segundos_por_fragmento=args.segundos_por_fragmento,
+                                           tasa_errores=args.tasa_errores, semilla=args.semilla)
+    logger.info(f"LLM simulado escuchando en http://{args.host}:{args.puerto}{RUTA_CHAT} (Ctrl+C para detener).")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
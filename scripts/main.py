@@ -1,9 +1,13 @@
 # scripts/main.py
 import os
 import sys
+import json
+import shutil
+import contextvars
 import time 
 import traceback
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- Importación de Módulos del Paquete 'scripts' usando Imports Relativos ---
 from . import config
@@ -12,6 +16,11 @@ from . import vector_db_manager
 from . import rag_components
 from . import report_utils
 from . import dashboard_generator
+from . import pipeline_rag
+from . import cache_resultados
+from . import cache_llm
+from . import cache_texto_pdf
+from . import metricas
 
 # --- Configuración del Logging ---
 logger = logging.getLogger(__name__) # Obtener logger específico para este módulo
@@ -36,7 +45,178 @@ if not logging.getLogger().handlers: # Solo si el root logger no tiene handlers
     )
 # --- Fin Configuración del Logging ---
 
-def run_analysis(force_recreate_db=None): # Aceptar el parámetro aquí
+def _notificar_progreso(callback_progreso, etapa, progreso):
+    # El callback lo aporta quien ejecuta el análisis en segundo plano (app.py) para exponer el avance por etapa.
+    if callback_progreso:
+        try:
+            callback_progreso(etapa, progreso)
+        except Exception as e_callback:
+            logger.warning(f"Error en el callback de progreso: {e_callback}")
+
+def _emitir_evento(callback_evento, tipo, datos):
+    # Eventos en vivo (tokens del LLM y riesgos ya completos) para el endpoint SSE de app.py.
+    if callback_evento:
+        try:
+            callback_evento(tipo, datos)
+        except Exception as e_callback:
+            logger.warning(f"Error en el callback de eventos: {e_callback}")
+
+def _crear_receptor_tokens(callback_evento):
+    extractor = report_utils.ExtractorRiesgosIncremental()
+    def receptor(texto):
+        _emitir_evento(callback_evento, "token", {"texto": texto})
+        for riesgo in extractor.agregar(texto):
+            _emitir_evento(callback_evento, "riesgo", report_utils.estructurar_riesgo(riesgo))
+    return receptor
+
+_cache_resultados = None
+
+def _obtener_cache_resultados():
+    global _cache_resultados
+    if _cache_resultados is None:
+        _cache_resultados = cache_resultados.CacheResultados(config.DIRECTORIO_CACHE_RESULTADOS, config.CACHE_RESULTADOS_MAX_ENTRADAS)
+    return _cache_resultados
+
+def _nombre_modelo_llm():
+    # Los análisis con el LLM simulado quedan registrados (y cacheados) con su propio nombre de modelo
+    return "llm-simulado" if config.LLM_PROVEEDOR == 'simulado' else config.GEMINI_MODEL_NAME
+
+def _calcular_clave_cache_resultados(pdf_path, chroma_db_path):
+    # La huella de la KB sale del manifest de ChromaDB (de la versión publicada, o de la indicada si chroma_db_path es la
+    # carpeta de una versión); sin manifest (DB antigua) no se puede usar la cache.
+    huella_kb = vector_db_manager.obtener_huella_kb(chroma_db_path)
+    if not huella_kb:
+        logger.info("La base vectorial no tiene manifest; no se usará la cache de resultados en este análisis.")
+        return None
+    parametros = {
+        "recuperacion_hibrida": config.K_CANDIDATOS_HIBRIDOS if config.RECUPERACION_HIBRIDA else None,
+        "reranker": [config.RERANKER_MODELO, config.K_CANDIDATOS_RERANKING] if config.RERANKING_HABILITADO else None,
+        "modo_analisis": config.MODO_ANALISIS,
+        "max_chars_seccion": config.MAX_CHARS_SECCION,
+        "max_secciones_proyecto": config.MAX_SECCIONES_PROYECTO,
+        "k_retrieved_docs": config.K_RETRIEVED_DOCS,
+        "empaquetado_contexto": [config.PRESUPUESTO_TOKENS_PROMPT, config.MIN_TOKENS_CONTEXTO,
+                                 config.K_CANDIDATOS_CONTEXTO] if config.EMPAQUETADO_CONTEXTO else None,
+        "max_chars_proyecto": config.MAX_CHARS_PROYECTO,
+        "chunk_size": config.CHUNK_SIZE,
+        "chunk_overlap": config.CHUNK_OVERLAP
+    }
+    return cache_resultados.calcular_clave_resultado(cache_resultados.calcular_hash_pdf(pdf_path), huella_kb,
+                                                     _nombre_modelo_llm(), rag_components.PROMPT_TEMPLATE_VERSION, parametros)
+
+def _restaurar_resultado_cacheado(entrada, nombre_pdf_proyecto, output_dir, ruta_dashboard_html, lista_pdfs_base_conocimiento):
+    """Copia el reporte y el dashboard guardados al directorio de resultados. Devuelve True si el dashboard quedó disponible."""
+    ruta_json = os.path.join(output_dir, report_utils.nombre_archivo_reporte(nombre_pdf_proyecto))
+    try:
+        if entrada.get("nombre_pdf_proyecto") == nombre_pdf_proyecto:
+            shutil.copy2(entrada["ruta_reporte"], ruta_json)
+            shutil.copy2(entrada["ruta_dashboard"], ruta_dashboard_html)
+        else:
+            # Mismo contenido con otro nombre de archivo: el dashboard se vuelve a generar (sin LLM) con el nombre actual.
+            with open(entrada["ruta_reporte"], 'r', encoding='utf-8') as f:
+                reporte = json.load(f)
+            reporte["nombre_proyecto_analizado"] = nombre_pdf_proyecto
+            with open(ruta_json, 'w', encoding='utf-8') as f:
+                json.dump(reporte, f, ensure_ascii=False, indent=4)
+            dashboard_generator.generar_dashboard_html(
+                ruta_json_resultados=ruta_json,
+                ruta_output_dashboard_html=ruta_dashboard_html,
+                lista_pdfs_base_conocimiento=lista_pdfs_base_conocimiento,
+                info_tesis_config=config.INFO_TESIS
+            )
+        return os.path.exists(ruta_dashboard_html)
+    except Exception as e:
+        logger.error(f"No se pudo restaurar el resultado desde la cache de resultados: {e}")
+        logger.debug(traceback.format_exc())
+        return False
+
+def _buscar_resultado_cacheado(pdf_path, forzar_reanalisis, nombre_pdf_proyecto, output_dir, ruta_dashboard_html,
+                               lista_pdfs_base_conocimiento, chroma_db_path):
+    """Devuelve (clave, restaurado). La clave se devuelve aunque no haya acierto, para guardar el resultado al terminar."""
+    clave_resultado = _calcular_clave_cache_resultados(pdf_path, chroma_db_path)
+    if not clave_resultado:
+        return None, False
+    if forzar_reanalisis:
+        logger.info("Reanálisis forzado: se ignora la cache de resultados.")
+        return clave_resultado, False
+    entrada = _obtener_cache_resultados().buscar(clave_resultado)
+    if not entrada:
+        logger.info("Resultado no encontrado en la cache de resultados; se ejecutará el análisis completo.")
+        return clave_resultado, False
+    restaurado = _restaurar_resultado_cacheado(entrada, nombre_pdf_proyecto, output_dir, ruta_dashboard_html,
+                                               lista_pdfs_base_conocimiento)
+    return clave_resultado, restaurado
+
+def _analizar_por_secciones(qa_chain, secciones, callback_progreso, callback_evento=None):
+    """
+    Modo "secciones" (map-reduce): cada sección del proyecto se envía en paralelo a la cadena RAG, que recupera
+    su propio contexto, y las respuestas se combinan en una sola. Devuelve (respuesta_combinada, documentos_fuente, num_errores).
+    """
+    respuestas = [None] * len(secciones)
+    fuentes_por_seccion = [[] for _ in secciones]
+    errores = []
+    num_hilos = max(1, min(config.NUM_HILOS_SECCIONES, len(secciones)))
+    logger.info(f"Analizando {len(secciones)} secciones del proyecto con {num_hilos} llamadas simultáneas al LLM...")
+    with ThreadPoolExecutor(max_workers=num_hilos, thread_name_prefix="seccion") as executor:
+        # Cada sección corre con una copia del contexto para conservar cache_llm.omitir_lectura() en los hilos
+        futuros = {executor.submit(contextvars.copy_context().run, qa_chain.invoke, {"query": seccion}): i
+                   for i, seccion in enumerate(secciones)}
+        for completadas, futuro in enumerate(as_completed(futuros), start=1):
+            i = futuros[futuro]
+            try:
+                respuesta_rag = futuro.result()
+                respuestas[i] = respuesta_rag.get("result") if isinstance(respuesta_rag, dict) else str(respuesta_rag)
+                fuentes_por_seccion[i] = respuesta_rag.get("source_documents", []) if isinstance(respuesta_rag, dict) else []
+                if callback_evento: # Las secciones corren en paralelo: se emiten sus riesgos al terminar cada una (sin tokens)
+                    json_seccion = report_utils.intentar_parsear_json_riesgos(respuestas[i]) or {}
+                    for riesgo in json_seccion.get("riesgos_identificados") or []:
+                        if isinstance(riesgo, dict):
+                            _emitir_evento(callback_evento, "riesgo", dict(report_utils.estructurar_riesgo(riesgo), seccion=i + 1))
+            except Exception as e_seccion:
+                logger.error(f"Error al analizar la sección {i + 1}/{len(secciones)} del proyecto: {e_seccion}")
+                logger.debug(traceback.format_exc())
+                errores.append(e_seccion)
+            _notificar_progreso(callback_progreso, f"ETAPA 6: Sección {completadas}/{len(secciones)} analizada",
+                                50 + 35 * completadas // len(secciones))
+    if len(errores) == len(secciones):
+        raise errores[0]
+
+    documentos_fuente = []
+    vistos = set()
+    for fuentes in fuentes_por_seccion: # Mismo fragmento recuperado por varias secciones: se lista una sola vez
+        for doc_fuente in fuentes:
+            clave = (doc_fuente.metadata.get('source_document'), doc_fuente.metadata.get('page_number'), doc_fuente.page_content)
+            if clave not in vistos:
+                vistos.add(clave)
+                documentos_fuente.append(doc_fuente)
+    return report_utils.combinar_respuestas_secciones(respuestas), documentos_fuente, len(errores)
+
+def run_analysis(force_recreate_db=None, callback_progreso=None, ruta_pdf_proyecto=None, directorio_resultados=None,
+                 forzar_reanalisis=False, callback_evento=None, directorio_base_conocimiento=None, chroma_db_path=None,
+                 id_coleccion_kb=None): # Aceptar el parámetro aquí
+    # Cada ejecución deja un registro de métricas (duración por etapa, fragmentos, tokens, caches, memoria) que
+    # se expone en GET /metrics (app.py) y se añade a config.RUTA_METRICAS_JSONL.
+    registro = metricas.RegistroAnalisis(modo_analisis=config.MODO_ANALISIS, modelo_llm=_nombre_modelo_llm(),
+                                         coleccion_kb=id_coleccion_kb, cache_resultados=False)
+    with metricas.registro_activo(registro):
+        ruta_dashboard = _ejecutar_analisis(force_recreate_db, callback_progreso, ruta_pdf_proyecto, directorio_resultados,
+                                            forzar_reanalisis, callback_evento,
+                                            directorio_base_conocimiento or config.DIRECTORIO_BASE_CONOCIMIENTO,
+                                            chroma_db_path or config.CHROMA_DB_PATH)
+    if not ruta_dashboard:
+        estado = metricas.ESTADO_ERROR
+    else:
+        estado = metricas.ESTADO_CACHE_RESULTADOS if registro.datos.get("cache_resultados") else metricas.ESTADO_COMPLETADO
+    metricas.obtener_agregador().publicar(registro.finalizar(estado))
+    return ruta_dashboard
+
+def _ejecutar_analisis(force_recreate_db, callback_progreso, ruta_pdf_proyecto, directorio_resultados,
+                       forzar_reanalisis, callback_evento, directorio_base_conocimiento, chroma_db_path):
+    # ruta_pdf_proyecto y directorio_resultados permiten que cada análisis use su propio espacio de trabajo
+    # (app.py); si se omiten se usan las carpetas compartidas de config.py, como en la ejecución por línea de comandos.
+    # directorio_base_conocimiento y chroma_db_path son los de la colección de KB elegida (por defecto, la de config.py).
+    # forzar_reanalisis ignora la cache de resultados (el nuevo resultado reemplaza al guardado).
+    # callback_evento(tipo, datos), si se indica, recibe la respuesta del LLM en streaming ("token") y cada riesgo ya completo ("riesgo").
     start_time_total = time.time()
     ruta_output_dashboard_html_relativa = None
     
@@ -45,6 +225,7 @@ def run_analysis(force_recreate_db=None): # Aceptar el parámetro aquí
     # config.PROJECT_ROOT ya debería estar definido correctamente respecto a la raíz del proyecto.
     # Usaremos config.PROJECT_ROOT para consistencia.
     PROJECT_ROOT_FROM_CONFIG = config.PROJECT_ROOT 
+    vector_db = None
     
     logger.info("######################################################################")
     logger.info("# INICIANDO PROCESO DE ANÁLISIS DE RIESGOS RAG (desde run_analysis)  #")
@@ -52,16 +233,23 @@ def run_analysis(force_recreate_db=None): # Aceptar el parámetro aquí
 
     try:
         logger.info("--- ETAPA 0: Cargando Configuración e Inicializando Directorios ---")
+        _notificar_progreso(callback_progreso, "ETAPA 0: Cargando Configuración e Inicializando Directorios", 0)
         if not config.inicializar_directorios_datos():
             logger.error("Error fatal: No se pudieron inicializar los directorios de datos.")
             return None # Devolver None si hay error para que app.py lo maneje
-        if not config.configure_google_api():
+        if config.LLM_PROVEEDOR == 'gemini' and not config.configure_google_api():
             logger.warning("Advertencia: API de Google no configurada. El LLM podría no funcionar.")
             # Continuar de todas formas, podría ser un análisis solo con retriever o para probar otras partes
 
         logger.info("--- ETAPA 1: Detectando PDF del Proyecto a Analizar ---")
+        _notificar_progreso(callback_progreso, "ETAPA 1: Detectando PDF del Proyecto a Analizar", 5)
         # document_utils.obtener_ruta_pdf_proyecto ya loguea errores si no encuentra el PDF
-        pdf_path_analizar_abs = document_utils.obtener_ruta_pdf_proyecto(config.DIRECTORIO_PROYECTO_ANALIZAR)
+        if ruta_pdf_proyecto:
+            pdf_path_analizar_abs = ruta_pdf_proyecto if os.path.isfile(ruta_pdf_proyecto) else None
+            if not pdf_path_analizar_abs:
+                logger.error(f"El PDF del proyecto indicado no existe: {ruta_pdf_proyecto}")
+        else:
+            pdf_path_analizar_abs = document_utils.obtener_ruta_pdf_proyecto(config.DIRECTORIO_PROYECTO_ANALIZAR)
         if not pdf_path_analizar_abs:
             logger.error("Error fatal: No se encontró un PDF válido en la carpeta del proyecto a analizar.")
             return None 
@@ -69,9 +257,10 @@ def run_analysis(force_recreate_db=None): # Aceptar el parámetro aquí
         nombre_pdf_proyecto_detectado = os.path.basename(pdf_path_analizar_abs)
         nombre_base_proyecto_analizado = os.path.splitext(nombre_pdf_proyecto_detectado)[0]
         logger.info(f"PDF detectado para análisis: {nombre_pdf_proyecto_detectado}")
+        metricas.anotar("proyecto", nombre_pdf_proyecto_detectado)
 
         # Crear directorio de salida específico para este proyecto
-        output_dir_especifico_proyecto = os.path.join(config.DIRECTORIO_RESULTADOS, nombre_base_proyecto_analizado)
+        output_dir_especifico_proyecto = directorio_resultados or os.path.join(config.DIRECTORIO_RESULTADOS, nombre_base_proyecto_analizado)
         try:
             os.makedirs(output_dir_especifico_proyecto, exist_ok=True)
             logger.info(f"Directorio de resultados para este proyecto: {output_dir_especifico_proyecto}")
@@ -79,97 +268,162 @@ def run_analysis(force_recreate_db=None): # Aceptar el parámetro aquí
             logger.error(f"Error fatal al crear directorio de salida '{output_dir_especifico_proyecto}': {e}")
             return None
 
-        lista_pdfs_base_conocimiento = document_utils.listar_documentos_kb(config.DIRECTORIO_BASE_CONOCIMIENTO)
+        lista_pdfs_base_conocimiento = document_utils.listar_documentos_kb(directorio_base_conocimiento)
         if not lista_pdfs_base_conocimiento:
-             logger.warning(f"No se encontraron PDFs en la carpeta de base de conocimiento: {config.DIRECTORIO_BASE_CONOCIMIENTO}. La base vectorial podría estar vacía si se recrea.")
+             logger.warning(f"No se encontraron PDFs en la carpeta de base de conocimiento: {directorio_base_conocimiento}. La base vectorial podría estar vacía si se recrea.")
+
+
+        # Decidir si se recrea la DB basado en el parámetro o en config.py
+        recrear_db_final_decision = config.RECREAR_DB # Valor por defecto desde config.py
+        if force_recreate_db is not None:
+            logger.info(f"Opción de recrear DB desde Flask: {force_recreate_db}. Anulando valor de config.py ({config.RECREAR_DB}) para esta ejecución.")
+            recrear_db_final_decision = force_recreate_db
+        else:
+            logger.info(f"Usando valor de RECREAR_DB de config.py: {config.RECREAR_DB}")
+
+        dashboard_html_filename = f"dashboard_{nombre_base_proyecto_analizado}.html" # Nombre consistente
+        ruta_output_dashboard_html_absoluta = os.path.join(output_dir_especifico_proyecto, dashboard_html_filename)
 
+        # Cache de resultados: si la DB no se va a sincronizar, la huella de la KB ya es la definitiva y se consulta
+        # antes de cargar embeddings/LLM; si se sincroniza, se consulta después de la ETAPA 3.
+        clave_resultado = None
+        if config.CACHE_RESULTADOS_HABILITADA and not recrear_db_final_decision:
+            clave_resultado, restaurado = _buscar_resultado_cacheado(
+                pdf_path_analizar_abs, forzar_reanalisis, nombre_pdf_proyecto_detectado, output_dir_especifico_proyecto,
+                ruta_output_dashboard_html_absoluta, lista_pdfs_base_conocimiento, chroma_db_path)
+            if restaurado:
+                _notificar_progreso(callback_progreso, "Resultado recuperado de la cache de resultados", 100)
+                metricas.anotar("cache_resultados", True)
+                logger.info(f"Análisis resuelto desde la cache de resultados en {time.time() - start_time_total:.2f} segundos.")
+                return os.path.normpath(os.path.relpath(ruta_output_dashboard_html_absoluta, PROJECT_ROOT_FROM_CONFIG)).replace("\\", "/")
 
+        metricas.registrar_etapa("preparacion", time.time() - start_time_total)
         logger.info("--- ETAPA 2: Inicializando Modelo de Embeddings ---")
+        _notificar_progreso(callback_progreso, "ETAPA 2: Inicializando Modelo de Embeddings", 10)
         start_time_embed = time.time()
-        embedding_function = vector_db_manager.get_embedding_function(config.EMBEDDING_MODEL_NAME_OR_PATH)
+        # El pipeline conserva embeddings, DB, LLM y cadena entre análisis; solo se recargan si cambia su configuración.
+        pipeline = pipeline_rag.obtener_pipeline()
+        embedding_function = pipeline.obtener_embeddings()
         if not embedding_function:
             logger.error("Error fatal: No se pudo inicializar el modelo de embeddings (main.py).")
             return None
+        metricas.registrar_etapa("embeddings", time.time() - start_time_embed)
+        estadisticas_cache_embeddings = embedding_function.estadisticas() if hasattr(embedding_function, 'estadisticas') else None
         logger.info(f"Tiempo para inicializar embeddings: {time.time() - start_time_embed:.2f} segundos.")
 
         logger.info("--- ETAPA 3: Gestionando Base de Datos Vectorial (ChromaDB) ---")
+        _notificar_progreso(callback_progreso, "ETAPA 3: Gestionando Base de Datos Vectorial (ChromaDB)", 20)
         start_time_db = time.time()
         
-        # Decidir si se recrea la DB basado en el parámetro o en config.py
-        recrear_db_final_decision = config.RECREAR_DB # Valor por defecto desde config.py
-        if force_recreate_db is not None:
-            logger.info(f"Opción de recrear DB desde Flask: {force_recreate_db}. Anulando valor de config.py ({config.RECREAR_DB}) para esta ejecución.")
-            recrear_db_final_decision = force_recreate_db
-        else:
-            logger.info(f"Usando valor de RECREAR_DB de config.py: {config.RECREAR_DB}")
-
-        vector_db = vector_db_manager.crear_o_cargar_chroma_db(
-            chroma_db_path=config.CHROMA_DB_PATH,
-            docs_base_conocimiento_path=config.DIRECTORIO_BASE_CONOCIMIENTO,
-            embedding_function=embedding_function,
-            chunk_size=config.CHUNK_SIZE,
-            chunk_overlap=config.CHUNK_OVERLAP,
-            recrear_db_flag=recrear_db_final_decision # Usar la decisión final
-        )
+        vector_db = pipeline.obtener_vector_db(embedding_function, recrear_db_final_decision, # Usar la decisión final
+                                               chroma_db_path=chroma_db_path, directorio_kb=directorio_base_conocimiento)
         if not vector_db:
             logger.error("Error fatal: No se pudo crear o cargar la base de datos vectorial (main.py).")
             return None
+        metricas.registrar_etapa("base_vectorial", time.time() - start_time_db)
+        metricas.anotar("fragmentos_coleccion", vector_db._collection.count())
         logger.info(f"Tiempo para gestión de DB: {time.time() - start_time_db:.2f} segundos.")
+        if hasattr(embedding_function, 'registrar_estadisticas'):
+            embedding_function.registrar_estadisticas()
+        # La clave con la que se guarda el resultado es la de la versión de la KB que este análisis adquirió: otra
+        # versión pudo publicarse (blue/green) entre la consulta anticipada y la carga de la DB.
+        if config.CACHE_RESULTADOS_HABILITADA and not recrear_db_final_decision:
+            clave_resultado = _calcular_clave_cache_resultados(pdf_path_analizar_abs, vector_db._persist_directory)
+        if config.CACHE_RESULTADOS_HABILITADA and recrear_db_final_decision:
+            clave_resultado, restaurado = _buscar_resultado_cacheado(
+                pdf_path_analizar_abs, forzar_reanalisis, nombre_pdf_proyecto_detectado, output_dir_especifico_proyecto,
+                ruta_output_dashboard_html_absoluta, lista_pdfs_base_conocimiento, vector_db._persist_directory)
+            if restaurado:
+                _notificar_progreso(callback_progreso, "Resultado recuperado de la cache de resultados", 100)
+                metricas.anotar("cache_resultados", True)
+                logger.info(f"Análisis resuelto desde la cache de resultados en {time.time() - start_time_total:.2f} segundos.")
+                return os.path.normpath(os.path.relpath(ruta_output_dashboard_html_absoluta, PROJECT_ROOT_FROM_CONFIG)).replace("\\", "/")
 
         logger.info("--- ETAPA 4: Configurando LLM y Cadena RAG ---")
+        _notificar_progreso(callback_progreso, "ETAPA 4: Configurando LLM y Cadena RAG", 40)
         start_time_rag_setup = time.time()
-        if not config.GEMINI_API_KEY: 
+        if config.LLM_PROVEEDOR == 'gemini' and not config.GEMINI_API_KEY: 
             logger.error("Error fatal: GEMINI_API_KEY no está disponible. El análisis RAG no funcionará.")
             # Podríamos optar por no devolver None aquí si queremos que el sistema genere un reporte "vacío"
             # o un dashboard indicando el problema, pero por ahora, es un error que impide el análisis.
             return None 
-        llm = rag_components.get_llm_instance(config.GEMINI_MODEL_NAME, config.GEMINI_API_KEY)
+        llm = pipeline.obtener_llm()
         if not llm:
             logger.error("Error fatal: No se pudo inicializar el LLM (main.py).")
             return None
             
-        qa_chain = rag_components.crear_cadena_rag(llm, vector_db, config.K_RETRIEVED_DOCS)
+        qa_chain = pipeline.obtener_cadena_rag(llm, vector_db)
         if not qa_chain:
             logger.error("Error fatal: No se pudo crear la cadena RAG (main.py).")
             return None
+        metricas.registrar_etapa("configuracion_rag", time.time() - start_time_rag_setup)
         logger.info(f"Tiempo para configurar LLM y cadena RAG: {time.time() - start_time_rag_setup:.2f} segundos.")
 
         logger.info("--- ETAPA 5: Procesando Documento del Proyecto a Analizar ---")
+        _notificar_progreso(callback_progreso, "ETAPA 5: Procesando Documento del Proyecto a Analizar", 45)
         start_time_proc_pdf = time.time()
         # pdf_path_analizar_abs ya está definido y validado
-        descripcion_nuevo_proyecto = document_utils.procesar_pdf_proyecto_para_analisis(
-            pdf_path_analizar_abs,
-            config.CHUNK_SIZE,
-            config.CHUNK_OVERLAP,
-            config.MAX_CHARS_PROYECTO
-        )
-        if not descripcion_nuevo_proyecto: 
-            logger.error("Error fatal: No se pudo procesar el PDF del proyecto a analizar (main.py).")
-            return None
-        logger.info(f"Texto extraído y preparado del proyecto '{nombre_base_proyecto_analizado}'. Longitud: {len(descripcion_nuevo_proyecto)} caracteres.")
+        if config.MODO_ANALISIS == 'secciones':
+            secciones_proyecto = document_utils.dividir_pdf_proyecto_en_secciones(
+                pdf_path_analizar_abs,
+                config.MAX_CHARS_SECCION,
+                config.CHUNK_OVERLAP * 2,
+                config.MAX_SECCIONES_PROYECTO
+            )
+            if not secciones_proyecto:
+                logger.error("Error fatal: No se pudo dividir en secciones el PDF del proyecto a analizar (main.py).")
+                return None
+        else:
+            descripcion_nuevo_proyecto = document_utils.procesar_pdf_proyecto_para_analisis(
+                pdf_path_analizar_abs,
+                config.CHUNK_SIZE,
+                config.CHUNK_OVERLAP,
+                config.MAX_CHARS_PROYECTO
+            )
+            if not descripcion_nuevo_proyecto: 
+                logger.error("Error fatal: No se pudo procesar el PDF del proyecto a analizar (main.py).")
+                return None
+            logger.info(f"Texto extraído y preparado del proyecto '{nombre_base_proyecto_analizado}'. Longitud: {len(descripcion_nuevo_proyecto)} caracteres.")
+        metricas.registrar_etapa("proyecto", time.time() - start_time_proc_pdf)
         logger.info(f"Tiempo para procesar PDF del proyecto: {time.time() - start_time_proc_pdf:.2f} segundos.")
 
         logger.info(f"--- ETAPA 6: Ejecutando Análisis de Riesgos para el proyecto: {nombre_base_proyecto_analizado} ---")
+        _notificar_progreso(callback_progreso, "ETAPA 6: Ejecutando Análisis de Riesgos para el proyecto", 50)
         start_time_query = time.time()
+        cache_llm_analisis = pipeline.obtener_cache_llm()
+        estadisticas_cache_llm = cache_llm_analisis.estadisticas() if cache_llm_analisis else None
         resultado_analisis_llm_str = "Error: Análisis no ejecutado o LLM no devolvió respuesta."
         fuentes_recuperadas_serializables = []
+        respuesta_llm_valida = False # Solo los análisis sin errores se guardan en la cache de resultados
         
         try:
             logger.info("Enviando consulta a la cadena RAG (esto puede tardar)...")
-            # La plantilla de prompt espera la descripción del proyecto en la variable "query" o "question"
-            # En rag_components.py, el PromptTemplate usa "question"
-            respuesta_rag = qa_chain.invoke({"query": descripcion_nuevo_proyecto}) 
+            num_secciones_fallidas = 0
+            if config.MODO_ANALISIS == 'secciones': # Las respuestas por sección ya vuelven combinadas en el formato del análisis completo
+                with cache_llm.omitir_lectura(forzar_reanalisis):
+                    resultado_analisis_llm_str, fuentes_recuperadas_docs, num_secciones_fallidas = _analizar_por_secciones(
+                        qa_chain, secciones_proyecto, callback_progreso, callback_evento)
+            else:
+                # La plantilla de prompt espera la descripción del proyecto en la variable "query" o "question"
+                # En rag_components.py, el PromptTemplate usa "question"
+                with cache_llm.omitir_lectura(forzar_reanalisis): # Forzar reanálisis también ignora la cache del LLM
+                    if callback_evento: # Misma recuperación y prompt que qa_chain.invoke, pero con la respuesta en streaming
+                        respuesta_rag = rag_components.invocar_cadena_rag_streaming(
+                            qa_chain, descripcion_nuevo_proyecto, _crear_receptor_tokens(callback_evento))
+                    else:
+                        respuesta_rag = qa_chain.invoke({"query": descripcion_nuevo_proyecto})
             
-            if isinstance(respuesta_rag, dict):
-                resultado_analisis_llm_str = respuesta_rag.get("result", "No se encontró 'result' en la respuesta del LLM.")
-                fuentes_recuperadas_docs = respuesta_rag.get("source_documents", [])
-            else: # Si la cadena no devuelve un dict (inesperado para RetrievalQA con return_source_documents=True)
-                resultado_analisis_llm_str = str(respuesta_rag) # Intentar convertir a string
-                fuentes_recuperadas_docs = []
-                logger.warning(f"La respuesta de la cadena RAG no fue un diccionario como se esperaba. Tipo recibido: {type(respuesta_rag)}")
+                if isinstance(respuesta_rag, dict):
+                    resultado_analisis_llm_str = respuesta_rag.get("result", "No se encontró 'result' en la respuesta del LLM.")
+                    fuentes_recuperadas_docs = respuesta_rag.get("source_documents", [])
+                else: # Si la cadena no devuelve un dict (inesperado para RetrievalQA con return_source_documents=True)
+                    resultado_analisis_llm_str = str(respuesta_rag) # Intentar convertir a string
+                    fuentes_recuperadas_docs = []
+                    logger.warning(f"La respuesta de la cadena RAG no fue un diccionario como se esperaba. Tipo recibido: {type(respuesta_rag)}")
 
             if resultado_analisis_llm_str and isinstance(resultado_analisis_llm_str, str) and resultado_analisis_llm_str.strip():
                 logger.info("Respuesta del LLM recibida.")
+                respuesta_llm_valida = num_secciones_fallidas == 0
                 logger.debug(f"Respuesta LLM (raw - primeros 500 chars): {resultado_analisis_llm_str[:500]}...")
             else:
                 logger.warning("Advertencia: El LLM no devolvió un resultado ('result' es None, vacío, o no es string).")
@@ -195,31 +449,44 @@ def run_analysis(force_recreate_db=None): # Aceptar el parámetro aquí
             resultado_analisis_llm_str = f"Error en análisis durante la invocación de la cadena RAG: {str(e_invoke)}"
             # No devolvemos None aquí todavía, para que se intente generar un reporte con el error.
         
-        logger.info(f"Tiempo para ejecutar consulta RAG: {time.time() - start_time_query:.2f} segundos.")
+        resumen_cache_llm = ""
+        caches_analisis = {}
+        if estadisticas_cache_llm is not None:
+            resumen_cache_llm = f" ({cache_llm.resumir_estadisticas(estadisticas_cache_llm, cache_llm_analisis.estadisticas())})"
+            caches_analisis["llm"] = metricas.tasa_aciertos(estadisticas_cache_llm, cache_llm_analisis.estadisticas())
+        if estadisticas_cache_embeddings is not None:
+            caches_analisis["embeddings"] = metricas.tasa_aciertos(estadisticas_cache_embeddings, embedding_function.estadisticas())
+        # PDFs de la KB (si se reconstruye) y del proyecto, contados en el registro de este análisis
+        caches_analisis["texto_pdf"] = metricas.tasa_aciertos({}, {
+            "aciertos": metricas.contador(cache_texto_pdf.CONTADOR_ACIERTOS),
+            "fallos": metricas.contador(cache_texto_pdf.CONTADOR_FALLOS)})
+        metricas.anotar("cache", caches_analisis)
+        metricas.registrar_etapa("consulta_rag", time.time() - start_time_query)
+        logger.info(f"Tiempo para ejecutar consulta RAG: {time.time() - start_time_query:.2f} segundos{resumen_cache_llm}.")
 
         logger.info("--- ETAPA 7: Formateando y Guardando Reporte JSON ---")
+        _notificar_progreso(callback_progreso, "ETAPA 7: Formateando y Guardando Reporte JSON", 85)
         start_time_report = time.time()
         ruta_json_guardado = report_utils.formatear_y_guardar_reporte(
             resultado_analisis_llm=resultado_analisis_llm_str, # Siempre pasar el string
             fuentes_recuperadas=fuentes_recuperadas_serializables,
             nombre_pdf_proyecto=nombre_pdf_proyecto_detectado, 
-            modelo_llm_usado=config.GEMINI_MODEL_NAME, # Usar el nombre del modelo de config.py
+            modelo_llm_usado=_nombre_modelo_llm(), # Nombre del modelo de config.py (o del LLM simulado)
             output_path_dir=output_dir_especifico_proyecto
         )
         if not ruta_json_guardado:
             logger.error("No se pudo guardar el reporte JSON (formatear_y_guardar_reporte devolvió None).")
         else:
             logger.info(f"Reporte JSON guardado en: {ruta_json_guardado}")
+        metricas.registrar_etapa("reporte_json", time.time() - start_time_report)
         logger.info(f"Tiempo para formatear y guardar reporte JSON: {time.time() - start_time_report:.2f} segundos.")
 
         # Generar dashboard solo si el JSON se guardó exitosamente
         if ruta_json_guardado and os.path.exists(ruta_json_guardado):
             logger.info("--- ETAPA 8: Generando Dashboard de Visualización ---")
+            _notificar_progreso(callback_progreso, "ETAPA 8: Generando Dashboard de Visualización", 90)
             start_time_dashboard = time.time()
             
-            dashboard_html_filename = f"dashboard_{nombre_base_proyecto_analizado}.html" # Nombre consistente
-            ruta_output_dashboard_html_absoluta = os.path.join(output_dir_especifico_proyecto, dashboard_html_filename)
-
             dashboard_generator.generar_dashboard_html(
                 ruta_json_resultados=ruta_json_guardado,
                 ruta_output_dashboard_html=ruta_output_dashboard_html_absoluta,
@@ -231,8 +498,13 @@ def run_analysis(force_recreate_db=None): # Aceptar el parámetro aquí
                 logger.info(f"Dashboard HTML generado exitosamente en: {ruta_output_dashboard_html_absoluta}")
                 # Calcular ruta relativa desde PROJECT_ROOT_FROM_CONFIG para Flask
                 ruta_output_dashboard_html_relativa = os.path.normpath(os.path.relpath(ruta_output_dashboard_html_absoluta, PROJECT_ROOT_FROM_CONFIG)).replace("\\", "/")
+                if clave_resultado and respuesta_llm_valida:
+                    _obtener_cache_resultados().guardar(clave_resultado, ruta_json_guardado, ruta_output_dashboard_html_absoluta,
+                                                        {"nombre_pdf_proyecto": nombre_pdf_proyecto_detectado,
+                                                         "modelo_llm": _nombre_modelo_llm()})
             else:
                 logger.error(f"El dashboard HTML no se encontró en {ruta_output_dashboard_html_absoluta} después de intentar generarlo.")
+            metricas.registrar_etapa("dashboard", time.time() - start_time_dashboard)
             logger.info(f"Tiempo para generar dashboard HTML: {time.time() - start_time_dashboard:.2f} segundos.")
         else:
             logger.warning("El archivo JSON de resultados no se generó o no se encontró. No se puede crear el dashboard.")
@@ -243,7 +515,7 @@ def run_analysis(force_recreate_db=None): # Aceptar el parámetro aquí
         logger.info("######################################################################")
         
         if ruta_output_dashboard_html_relativa:
-            logger.info(f"Resultados generados en la subcarpeta '{nombre_base_proyecto_analizado}' dentro de: {os.path.relpath(config.DIRECTORIO_RESULTADOS, PROJECT_ROOT_FROM_CONFIG)}")
+            logger.info(f"Resultados generados en: {os.path.relpath(output_dir_especifico_proyecto, PROJECT_ROOT_FROM_CONFIG)}")
             logger.info(f"Dashboard relativo para Flask: {ruta_output_dashboard_html_relativa}")
         else:
             logger.error("El dashboard no pudo ser generado o su ruta no pudo ser determinada.")
@@ -254,6 +526,9 @@ def run_analysis(force_recreate_db=None): # Aceptar el parámetro aquí
         logger.error(f"Error catastrófico e inesperado en el flujo principal de run_analysis: {e_main_flow}")
         logger.error(traceback.format_exc())
         return None # Asegurar que se devuelve None en caso de error mayor
+    finally:
+        if vector_db is not None: # Si mientras tanto se publicó otra versión de ChromaDB, la que usó este análisis ya puede borrarse
+            vector_db_manager.liberar_version(vector_db._persist_directory)
 
 if __name__ == '__main__':
     logger.info("Ejecutando main.py como script independiente...")
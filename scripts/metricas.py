@@ -0,0 +1,255 @@
+# scripts/metricas.py
+import os
+import sys
+import json
+import uuid
+import time
+import datetime
+import threading
+import contextvars
+from contextlib import contextmanager
+import logging
+import traceback
+from langchain_core.callbacks import BaseCallbackHandler
+
+from . import config
+from . import empaquetador_contexto
+
+logger = logging.getLogger(__name__)
+
+ESTADO_COMPLETADO = "completado"
+ESTADO_ERROR = "error"
+ESTADO_CACHE_RESULTADOS = "cache_resultados"
+
+# Límites (segundos) de los histogramas de Prometheus; p50/p95 se calculan con histogram_quantile()
+LIMITES_HISTOGRAMA_SEGUNDOS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Registro del análisis en curso. Es una ContextVar porque app.py ejecuta varios análisis a la vez en hilos distintos;
+# los hilos de las secciones (ETAPA 6) la heredan con contextvars.copy_context().
+_registro_actual = contextvars.ContextVar("registro_metricas_analisis", default=None)
+
+def pico_memoria_mb():
+    """Pico de memoria residente del proceso (ru_maxrss) en MB, o None si la plataforma no lo ofrece."""
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(pico / (1024 * 1024 if sys.platform == "darwin" else 1024), 1) # bytes en macOS, KB en Linux
+
+class RegistroAnalisis:
+    """
+    Métricas de una ejecución de run_analysis: duración de cada etapa, contadores y cache. No incluye el pico de
+    memoria: ru_maxrss es del proceso entero (el de cualquier análisis anterior o concurrente), así que solo se
+    publica como gauge del proceso en /metrics.
+    """
+
+    def __init__(self, **datos):
+        self.id = uuid.uuid4().hex[:12]
+        self.inicio = time.time()
+        self.datos = dict(datos)
+        self.etapas = {}
+        self.contadores = {}
+        self._lock = threading.Lock()
+
+    def registrar_etapa(self, nombre, segundos):
+        with self._lock:
+            self.etapas[nombre] = round(self.etapas.get(nombre, 0.0) + segundos, 4)
+
+    def sumar(self, clave, valor):
+        with self._lock:
+            self.contadores[clave] = self.contadores.get(clave, 0) + valor
+
+    def contador(self, clave):
+        with self._lock:
+            return self.contadores.get(clave, 0)
+
+    def anotar(self, clave, valor):
+        with self._lock:
+            self.datos[clave] = valor
+
+    def finalizar(self, estado):
+        with self._lock:
+            contadores = {k: round(v, 4) if isinstance(v, float) else v for k, v in self.contadores.items()}
+            if contadores.get("segundos_indexacion"):
+                contadores["fragmentos_por_segundo_indexacion"] = round(
+                    contadores.get("fragmentos_indexados", 0) / contadores["segundos_indexacion"], 2)
+            if contadores.get("segundos_embeddings"):
+                contadores["fragmentos_por_segundo_embeddings"] = round(
+                    contadores.get("fragmentos_embebidos", 0) / contadores["segundos_embeddings"], 2)
+            return {
+                "id": self.id,
+                "inicio": datetime.datetime.fromtimestamp(self.inicio).isoformat(timespec="seconds"),
+                "estado": estado,
+                "duracion_segundos": round(time.time() - self.inicio, 4),
+                **self.datos,
+                "etapas": dict(self.etapas),
+                "contadores": contadores
+            }
+
+@contextmanager
+def registro_activo(registro):
+    token = _registro_actual.set(registro)
+    try:
+        yield registro
+    finally:
+        _registro_actual.reset(token)
+
+# Funciones para los módulos del pipeline: no hacen nada si no hay un análisis en curso (scripts sueltos, benchmarks).
+def registrar_etapa(nombre, segundos):
+    registro = _registro_actual.get()
+    if registro is not None:
+        registro.registrar_etapa(nombre, segundos)
+
+def sumar(clave, valor):
+    registro = _registro_actual.get()
+    if registro is not None:
+        registro.sumar(clave, valor)
+
+def anotar(clave, valor):
+    registro = _registro_actual.get()
+    if registro is not None:
+        registro.anotar(clave, valor)
+
+def contador(clave):
+    """Valor de un contador del análisis en curso (0 si no hay análisis o aún no se ha sumado nada)."""
+    registro = _registro_actual.get()
+    if registro is None:
+        return 0
+    return registro.contador(clave)
+
+def tasa_aciertos(antes, despues):
+    """Diferencia de aciertos/fallos entre dos lecturas de estadisticas() de una cache, con su tasa de aciertos."""
+    aciertos = despues.get("aciertos", 0) - antes.get("aciertos", 0)
+    fallos = despues.get("fallos", 0) - antes.get("fallos", 0)
+    return {"aciertos": aciertos, "fallos": fallos,
+            "tasa_aciertos": round(aciertos / (aciertos + fallos), 4) if aciertos + fallos else None}
+
+class ManejadorMetricasLLM(BaseCallbackHandler):
+    """
+    Cuenta llamadas y tokens del LLM en el análisis en curso. Usa usage_metadata si el proveedor lo informa (Gemini)
+    y, si no, la estimación de tokens del empaquetador de contexto. Las respuestas servidas por la cache no cuentan.
+    """
+
+    def __init__(self):
+        self._tokens_prompt = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._tokens_prompt[run_id] = sum(empaquetador_contexto.estimar_tokens(str(m.content)) for lista in messages for m in lista)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        tokens_prompt = self._tokens_prompt.pop(run_id, 0)
+        for generaciones in response.generations:
+            for generacion in generaciones:
+                uso = getattr(getattr(generacion, "message", None), "usage_metadata", None)
+                if uso is not None and "input_tokens" not in uso:
+                    return # LangChain marca así (total_cost=0) las respuestas recuperadas de la cache
+                sumar("llamadas_llm", 1)
+                sumar("tokens_entrada", uso["input_tokens"] if uso else tokens_prompt)
+                sumar("tokens_salida", uso["output_tokens"] if uso else empaquetador_contexto.estimar_tokens(generacion.text))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._tokens_prompt.pop(run_id, None)
+        sumar("errores_llm", 1)
+
+class _Histograma:
+    def __init__(self):
+        self.cubetas = [0] * len(LIMITES_HISTOGRAMA_SEGUNDOS)
+        self.suma = 0.0
+        self.cuenta = 0
+
+    def observar(self, valor):
+        for i, limite in enumerate(LIMITES_HISTOGRAMA_SEGUNDOS):
+            if valor <= limite:
+                self.cubetas[i] += 1
+        self.suma += valor
+        self.cuenta += 1
+
+def _etiquetas(**etiquetas):
+    return "{" + ",".join(f'{k}="{v}"' for k, v in etiquetas.items()) + "}" if etiquetas else ""
+
+class AgregadorMetricas:
+    """Acumula los registros de los análisis del proceso y los expone en el formato de texto de Prometheus."""
+
+    def __init__(self, ruta_jsonl=None):
+        self.ruta_jsonl = ruta_jsonl
+        self._lock = threading.Lock()
+        self._analisis = {}
+        self._duracion_total = _Histograma()
+        self._etapas = {}
+        self._contadores = {}
+        self._caches = {}
+
+    def publicar(self, registro):
+        with self._lock:
+            self._analisis[registro["estado"]] = self._analisis.get(registro["estado"], 0) + 1
+            self._duracion_total.observar(registro["duracion_segundos"])
+            for nombre, segundos in registro["etapas"].items():
+                self._etapas.setdefault(nombre, _Histograma()).observar(segundos)
+            for clave, valor in registro["contadores"].items():
+                if not clave.startswith("fragmentos_por_segundo_"): # Tasas derivadas: no se acumulan
+                    self._contadores[clave] = self._contadores.get(clave, 0) + valor
+            for nombre_cache, datos in registro.get("cache", {}).items():
+                acumulado = self._caches.setdefault(nombre_cache, {"aciertos": 0, "fallos": 0})
+                acumulado["aciertos"] += datos.get("aciertos", 0)
+                acumulado["fallos"] += datos.get("fallos", 0)
+            if self.ruta_jsonl:
+                self._escribir_jsonl(registro)
+
+    def _escribir_jsonl(self, registro):
+        try:
+            os.makedirs(os.path.dirname(self.ruta_jsonl), exist_ok=True)
+            with open(self.ruta_jsonl, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(registro, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.error(f"No se pudo añadir el registro de métricas a '{self.ruta_jsonl}': {e}")
+            logger.debug(traceback.format_exc())
+
+    def exportar_prometheus(self):
+        lineas = []
+        def metrica(nombre, tipo, ayuda):
+            lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+        def histograma(nombre, h, **etiquetas):
+            for limite, cuenta in zip(LIMITES_HISTOGRAMA_SEGUNDOS, h.cubetas):
+                lineas.append(f"{nombre}_bucket{_etiquetas(**etiquetas, le=limite)} {cuenta}")
+            lineas.append(f"{nombre}_bucket{_etiquetas(**etiquetas, le='+Inf')} {h.cuenta}")
+            lineas.append(f"{nombre}_sum{_etiquetas(**etiquetas)} {h.suma:.4f}")
+            lineas.append(f"{nombre}_count{_etiquetas(**etiquetas)} {h.cuenta}")
+
+        with self._lock:
+            metrica("analisis_total", "counter", "Análisis ejecutados por estado final.")
+            for estado, cuenta in sorted(self._analisis.items()):
+                lineas.append(f"analisis_total{_etiquetas(estado=estado)} {cuenta}")
+            metrica("analisis_duracion_segundos", "histogram", "Duración total de run_analysis.")
+            histograma("analisis_duracion_segundos", self._duracion_total)
+            metrica("analisis_etapa_duracion_segundos", "histogram", "Duración de cada etapa de run_analysis.")
+            for nombre, h in sorted(self._etapas.items()):
+                histograma("analisis_etapa_duracion_segundos", h, etapa=nombre)
+            metrica("analisis_eventos_total", "counter", "Contadores acumulados (fragmentos indexados, tokens y llamadas del LLM...).")
+            for clave, valor in sorted(self._contadores.items()):
+                lineas.append(f"analisis_eventos_total{_etiquetas(tipo=clave)} {valor:g}")
+            metrica("analisis_cache_consultas_total", "counter", "Consultas a las caches durante los análisis, por resultado.")
+            for nombre_cache, datos in sorted(self._caches.items()):
+                for resultado in ("aciertos", "fallos"):
+                    lineas.append(f"analisis_cache_consultas_total{_etiquetas(cache=nombre_cache, resultado=resultado)} {datos[resultado]}")
+            pico_actual = pico_memoria_mb()
+            if pico_actual is not None:
+                metrica("proceso_pico_memoria_bytes", "gauge", "Pico de memoria residente del proceso desde que arrancó (no de un análisis concreto).")
+                lineas.append(f"proceso_pico_memoria_bytes {int(pico_actual * 1024 * 1024)}")
+        return "\n".join(lineas) + "\n"
+
+_agregador = None
+_lock_agregador = threading.Lock()
+
+def obtener_agregador():
+    global _agregador
+    with _lock_agregador:
+        if _agregador is None:
+            _agregador = AgregadorMetricas(config.RUTA_METRICAS_JSONL if config.METRICAS_JSONL_HABILITADAS else None)
+        return _agregador
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo metricas.py cargado.")
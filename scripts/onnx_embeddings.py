@@ -0,0 +1,149 @@
+# scripts/onnx_embeddings.py
+import os
+import json
+import shutil
+import logging
+import traceback
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+ONNX_FP32_FILENAME = "model.onnx"
+ONNX_INT8_FILENAME = "model_int8.onnx"
+MAX_SEQ_LENGTH_POR_DEFECTO = 256 # Valor de sentence_bert_config.json para all-MiniLM-L6-v2
+
+def _directorio_onnx_modelo(directorio_onnx_base, model_name_or_path):
+    return os.path.join(directorio_onnx_base, os.path.basename(str(model_name_or_path).rstrip("/\\")))
+
+def _leer_max_seq_length(ruta_config):
+    try:
+        with open(ruta_config, 'r', encoding='utf-8') as f:
+            return int(json.load(f).get("max_seq_length", MAX_SEQ_LENGTH_POR_DEFECTO))
+    except Exception:
+        return MAX_SEQ_LENGTH_POR_DEFECTO
+
+def _obtener_max_seq_length(model_name_or_path, cache_folder):
+    # Debe coincidir con el truncado que aplica SentenceTransformer para que ambos backends sean comparables.
+    if os.path.isdir(str(model_name_or_path)):
+        return _leer_max_seq_length(os.path.join(model_name_or_path, "sentence_bert_config.json"))
+    try:
+        from huggingface_hub import hf_hub_download
+        return _leer_max_seq_length(hf_hub_download(model_name_or_path, "sentence_bert_config.json", cache_dir=cache_folder))
+    except Exception as e:
+        logger.warning(f"No se pudo leer max_seq_length de '{model_name_or_path}', se usará {MAX_SEQ_LENGTH_POR_DEFECTO}: {e}")
+        return MAX_SEQ_LENGTH_POR_DEFECTO
+
+def exportar_modelo_onnx(model_name_or_path, directorio_onnx_base, cache_folder=None, cuantizar=True):
+    """
+    Exporta el Transformer de un modelo sentence-transformers a ONNX (y opcionalmente una versión int8
+    con cuantización dinámica). El pooling (media) y la normalización L2 se hacen en numpy al inferir.
+    Devuelve el directorio con los archivos exportados, o None si falla.
+    """
+    directorio_salida = _directorio_onnx_modelo(directorio_onnx_base, model_name_or_path)
+    ruta_fp32 = os.path.join(directorio_salida, ONNX_FP32_FILENAME)
+    ruta_int8 = os.path.join(directorio_salida, ONNX_INT8_FILENAME)
+    # Se escribe en un temporal del mismo directorio y se publica con os.replace: una exportación interrumpida no deja
+    # un modelo truncado que las siguientes ejecuciones darían por bueno.
+    directorio_tmp = os.path.join(directorio_salida, f".exportando-{os.getpid()}")
+    ruta_tmp_fp32 = os.path.join(directorio_tmp, ONNX_FP32_FILENAME) # Puede ir con datos externos (model.onnx.data)
+    ruta_tmp_int8 = os.path.join(directorio_salida, f"{os.getpid()}.tmp.{ONNX_INT8_FILENAME}")
+    try:
+        os.makedirs(directorio_salida, exist_ok=True)
+        if not os.path.exists(ruta_fp32):
+            os.makedirs(directorio_tmp, exist_ok=True)
+            import torch
+            from transformers import AutoModel, AutoTokenizer
+            logger.info(f"Exportando '{model_name_or_path}' a ONNX en: {ruta_fp32}")
+            tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, cache_dir=cache_folder)
+            modelo = AutoModel.from_pretrained(model_name_or_path, cache_dir=cache_folder)
+            modelo.eval()
+            ejemplo = tokenizer(["texto de ejemplo para exportar"], return_tensors="pt")
+            nombres_entrada = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in ejemplo]
+            ejes_dinamicos = {n: {0: "batch", 1: "secuencia"} for n in nombres_entrada}
+            ejes_dinamicos["last_hidden_state"] = {0: "batch", 1: "secuencia"}
+            argumentos_export = dict(
+                input_names=nombres_entrada, output_names=["last_hidden_state"],
+                dynamic_axes=ejes_dinamicos, opset_version=14, do_constant_folding=True
+            )
+            with torch.no_grad():
+                try: # Exportador clásico (TorchScript); en torch>=2.5 el de dynamo requiere además 'onnxscript'
+                    torch.onnx.export(modelo, tuple(ejemplo[n] for n in nombres_entrada), ruta_tmp_fp32, dynamo=False, **argumentos_export)
+                except TypeError: # Versiones de torch sin el parámetro 'dynamo'
+                    torch.onnx.export(modelo, tuple(ejemplo[n] for n in nombres_entrada), ruta_tmp_fp32, **argumentos_export)
+            tokenizer.save_pretrained(directorio_salida)
+            with open(os.path.join(directorio_salida, "sentence_bert_config.json"), 'w', encoding='utf-8') as f:
+                json.dump({"max_seq_length": _obtener_max_seq_length(model_name_or_path, cache_folder)}, f)
+            for nombre in os.listdir(directorio_tmp): # El modelo (lo que se comprueba en cada ejecución) se publica el último
+                if nombre != ONNX_FP32_FILENAME:
+                    os.replace(os.path.join(directorio_tmp, nombre), os.path.join(directorio_salida, nombre))
+            os.replace(ruta_tmp_fp32, ruta_fp32)
+        if cuantizar and not os.path.exists(ruta_int8):
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            logger.info(f"Cuantizando modelo ONNX a int8 en: {ruta_int8}")
+            quantize_dynamic(ruta_fp32, ruta_tmp_int8, weight_type=QuantType.QInt8)
+            os.replace(ruta_tmp_int8, ruta_int8)
+        return directorio_salida
+    except Exception as e:
+        logger.error(f"Error al exportar/cuantizar el modelo '{model_name_or_path}' a ONNX: {e}")
+        logger.debug(traceback.format_exc())
+        return None
+    finally:
+        shutil.rmtree(directorio_tmp, ignore_errors=True) # Exportación fallida: no dejar un modelo a medias
+        if os.path.exists(ruta_tmp_int8):
+            os.remove(ruta_tmp_int8)
+
+class OnnxSentenceEmbeddings(Embeddings):
+    """
+    Embeddings de sentence-transformers (Transformer + mean pooling + Normalize) ejecutados con onnxruntime en CPU.
+    """
+
+    def __init__(self, model_name_or_path, directorio_onnx_base, cache_folder=None, cuantizado=True,
+                 batch_size=32, num_hilos=None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        directorio_modelo = exportar_modelo_onnx(model_name_or_path, directorio_onnx_base,
+                                                 cache_folder=cache_folder, cuantizar=cuantizado)
+        if not directorio_modelo:
+            raise RuntimeError(f"No hay un modelo ONNX disponible para '{model_name_or_path}'.")
+
+        self.cuantizado = cuantizado
+        self.batch_size = batch_size
+        self.model_name = f"onnx{'-int8' if cuantizado else ''}:{model_name_or_path}"
+        self.tokenizer = AutoTokenizer.from_pretrained(directorio_modelo)
+        self.max_seq_length = _leer_max_seq_length(os.path.join(directorio_modelo, "sentence_bert_config.json"))
+
+        opciones = ort.SessionOptions()
+        if num_hilos:
+            opciones.intra_op_num_threads = int(num_hilos)
+        ruta_onnx = os.path.join(directorio_modelo, ONNX_INT8_FILENAME if cuantizado else ONNX_FP32_FILENAME)
+        self.sesion = ort.InferenceSession(ruta_onnx, sess_options=opciones, providers=["CPUExecutionProvider"])
+        self._nombres_entrada = [i.name for i in self.sesion.get_inputs()]
+        logger.info(f"Modelo ONNX cargado desde '{ruta_onnx}' (max_seq_length={self.max_seq_length}).")
+
+    def _codificar(self, textos):
+        tokens = self.tokenizer(textos, padding=True, truncation=True, max_length=self.max_seq_length, return_tensors="np")
+        entradas = {n: tokens[n].astype(np.int64) for n in self._nombres_entrada if n in tokens}
+        if "token_type_ids" in self._nombres_entrada and "token_type_ids" not in entradas:
+            entradas["token_type_ids"] = np.zeros_like(entradas["input_ids"])
+        ultimo_estado = self.sesion.run(None, entradas)[0]
+        mascara = tokens["attention_mask"][..., None].astype(np.float32)
+        media = (ultimo_estado * mascara).sum(axis=1) / np.clip(mascara.sum(axis=1), 1e-9, None)
+        normas = np.linalg.norm(media, axis=1, keepdims=True)
+        return (media / np.clip(normas, 1e-12, None)).astype(np.float32)
+
+    def embed_documents(self, texts):
+        textos = [t.replace("\n", " ") for t in texts] # Igual que SentenceTransformerEmbeddings
+        vectores = []
+        for i in range(0, len(textos), self.batch_size):
+            vectores.extend(self._codificar(textos[i:i + self.batch_size]).tolist())
+        return vectores
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo onnx_embeddings.py cargado.")
@@ -0,0 +1,267 @@
+# scripts/pipeline_rag.py
+import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+from . import config
+from . import vector_db_manager
+from . import rag_components
+from . import bm25_index
+from . import reranker
+from . import cache_llm
+from . import resiliencia_llm
+from . import metricas
+
+logger = logging.getLogger(__name__)
+
+class PipelineRAG:
+    """
+    Mantiene vivos durante todo el proceso el modelo de embeddings, la base vectorial, el LLM y la cadena RAG,
+    para que cada análisis no repita su inicialización (ETAPAS 2 a 4 de run_analysis).
+    Cada componente se guarda junto a la clave de configuración con la que se creó y solo se reconstruye
+    cuando esa clave cambia (o, para la base vectorial, cuando cambian los PDFs de la base de conocimiento).
+    La base vectorial, su índice BM25 y la cadena RAG se guardan por colección de base de conocimiento (ruta de su
+    ChromaDB), con las COLECCIONES_KB_MAX_ABIERTAS usadas más recientemente abiertas a la vez.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._embedding_function = None
+        self._clave_embeddings = None
+        self._vector_dbs = OrderedDict() # chroma_db_path -> (vector_db, clave), de la menos a la más usada recientemente
+        self._indices_bm25 = {} # chroma_db_path -> (indice, clave)
+        self._reranker = None
+        self._clave_reranker = None
+        self._cache_llm = None
+        self._clave_cache_llm = None
+        self._control_llm = None
+        self._clave_control_llm = None
+        self._llm = None
+        self._clave_llm = None
+        self._cadenas = {} # chroma_db_path -> (qa_chain, clave)
+
+    @staticmethod
+    def _clave_config_embeddings():
+        return (str(config.EMBEDDING_MODEL_NAME_OR_PATH), config.EMBEDDING_BACKEND, config.EMBEDDING_ONNX_CUANTIZADO,
+                config.EMBEDDING_CACHE_HABILITADA, config.EMBEDDING_CACHE_MAX_ENTRADAS, config.EMBEDDING_BATCH_SIZE,
+                config.EMBEDDING_AGRUPAR_POR_LONGITUD)
+
+    def obtener_embeddings(self):
+        with self._lock:
+            clave = self._clave_config_embeddings()
+            if self._embedding_function is not None and self._clave_embeddings == clave:
+                logger.info("Reutilizando modelo de embeddings ya cargado en este proceso.")
+                return self._embedding_function
+            embedding_function = vector_db_manager.get_embedding_function(config.EMBEDDING_MODEL_NAME_OR_PATH)
+            if embedding_function is not None:
+                self._embedding_function, self._clave_embeddings = embedding_function, clave
+                self._soltar_vector_db() # La base vectorial depende del modelo
+            return embedding_function
+
+    def _soltar_vector_db(self, chroma_db_path=None):
+        """Suelta la referencia a la base vectorial de una colección (o de todas) junto con su BM25 y su cadena RAG."""
+        for ruta in [chroma_db_path] if chroma_db_path is not None else list(self._vector_dbs):
+            vector_db, _ = self._vector_dbs.pop(ruta, (None, None))
+            if vector_db is not None:
+                vector_db_manager.liberar_version(vector_db._persist_directory)
+            self._indices_bm25.pop(ruta, None)
+            self._cadenas.pop(ruta, None)
+
+    @staticmethod
+    def _clave_config_vector_db(embedding_function, ruta_version, directorio_kb):
+        return (id(embedding_function), ruta_version, directorio_kb, config.CHUNK_SIZE, config.CHUNK_OVERLAP)
+
+    def obtener_vector_db(self, embedding_function, recrear_db, chroma_db_path=None, directorio_kb=None):
+        """
+        Devuelve la base vectorial de la colección (por defecto la de config) con una referencia adquirida para el
+        análisis que la pide, que debe liberarla con vector_db_manager.liberar_version(vector_db._persist_directory).
+        La pipeline conserva su propia referencia.
+        """
+        chroma_db_path = os.path.normpath(chroma_db_path or config.CHROMA_DB_PATH)
+        directorio_kb = directorio_kb or config.DIRECTORIO_BASE_CONOCIMIENTO
+        with self._lock:
+            clave = self._clave_config_vector_db(embedding_function, vector_db_manager.ruta_version_actual(chroma_db_path), directorio_kb)
+            vector_db, clave_abierta = self._vector_dbs.get(chroma_db_path, (None, None))
+            if vector_db is not None and clave_abierta == clave:
+                reutilizar = not recrear_db
+                if reutilizar:
+                    logger.info("Reutilizando base vectorial ya abierta en este proceso.")
+                elif not vector_db_manager.kb_tiene_cambios(chroma_db_path, directorio_kb,
+                                                            embedding_function, config.CHUNK_SIZE, config.CHUNK_OVERLAP):
+                    logger.info("Se pidió recrear la DB, pero la base de conocimiento no cambió. Se reutiliza la base vectorial abierta.")
+                    reutilizar = True
+                if reutilizar:
+                    self._vector_dbs.move_to_end(chroma_db_path)
+                    vector_db_manager.adquirir_version(vector_db._persist_directory)
+                    return vector_db
+
+        # Sin self._lock: mientras se construye la versión nueva, los demás análisis siguen usando la publicada.
+        vector_db = vector_db_manager.crear_o_cargar_chroma_db(
+            chroma_db_path=chroma_db_path,
+            docs_base_conocimiento_path=directorio_kb,
+            embedding_function=embedding_function,
+            chunk_size=config.CHUNK_SIZE,
+            chunk_overlap=config.CHUNK_OVERLAP,
+            recrear_db_flag=recrear_db,
+            num_procesos_ingesta=config.NUM_PROCESOS_INGESTA,
+            indexacion_incremental=config.INDEXACION_INCREMENTAL
+        )
+        if vector_db is None:
+            return None
+        with self._lock:
+            self._soltar_vector_db(chroma_db_path) # Los análisis que aún usan la versión anterior conservan su propia referencia
+            self._vector_dbs[chroma_db_path] = (vector_db, self._clave_config_vector_db(
+                embedding_function, os.path.normpath(vector_db._persist_directory), directorio_kb))
+            vector_db_manager.adquirir_version(vector_db._persist_directory)
+            while len(self._vector_dbs) > max(1, config.COLECCIONES_KB_MAX_ABIERTAS):
+                self._soltar_vector_db(next(iter(self._vector_dbs)))
+            return vector_db
+
+    def descartar_coleccion(self, chroma_db_path):
+        """Cierra la base vectorial (y su BM25 y cadena RAG) de una colección, p. ej. antes de borrarla del disco."""
+        with self._lock:
+            self._soltar_vector_db(os.path.normpath(chroma_db_path))
+
+    def obtener_indice_bm25(self, vector_db):
+        """Índice BM25 de la base vectorial (el que se guardó al indexarla); se recarga cuando cambia la base de conocimiento."""
+        with self._lock:
+            ruta_coleccion = vector_db_manager.raiz_de_version(vector_db._persist_directory)
+            huella_kb = vector_db_manager.obtener_huella_kb(vector_db._persist_directory) # La versión que usa este análisis
+            clave = (id(vector_db), huella_kb)
+            indice, clave_indice = self._indices_bm25.get(ruta_coleccion, (None, None))
+            if indice is not None and clave_indice == clave:
+                return indice
+            indice = bm25_index.cargar_o_construir_indice_bm25(vector_db, vector_db._persist_directory, huella_kb)
+            if indice is not None:
+                self._indices_bm25[ruta_coleccion] = (indice, clave)
+            return indice
+
+    def obtener_reranker(self):
+        with self._lock:
+            clave = (config.RERANKER_MODELO, config.RERANKER_BATCH_SIZE)
+            if self._reranker is not None and self._clave_reranker == clave:
+                return self._reranker
+            modelo = reranker.crear_reranker(config.RERANKER_MODELO, cache_folder=config.CACHE_DIR_HF,
+                                             batch_size=config.RERANKER_BATCH_SIZE)
+            self._reranker = modelo
+            self._clave_reranker = clave if modelo is not None else None
+            return modelo
+
+    def obtener_cache_llm(self):
+        """Cache de respuestas del LLM, o None si está deshabilitada o no se pudo abrir."""
+        with self._lock:
+            if not config.CACHE_LLM_HABILITADA:
+                return None
+            clave = (config.DIRECTORIO_CACHE_LLM, config.CACHE_LLM_TTL_SEGUNDOS, config.CACHE_LLM_MAX_MB)
+            if self._cache_llm is not None and self._clave_cache_llm == clave:
+                return self._cache_llm
+            cache = cache_llm.crear_cache_llm(config.DIRECTORIO_CACHE_LLM, config.CACHE_LLM_TTL_SEGUNDOS,
+                                              config.CACHE_LLM_MAX_MB * 1024 * 1024)
+            self._cache_llm = cache
+            self._clave_cache_llm = clave if cache is not None else None
+            return cache
+
+    def obtener_control_llm(self):
+        """
+        Reintentos, limitador de tasa e interruptor de las llamadas al LLM. Se comparte entre todos los análisis
+        (y sobrevive a la recreación del LLM) para que el límite de tasa y el estado del circuito sean globales.
+        """
+        with self._lock:
+            clave = (config.LLM_MAX_REINTENTOS, config.LLM_BACKOFF_BASE_SEGUNDOS, config.LLM_BACKOFF_MAX_SEGUNDOS,
+                     config.LLM_PLAZO_SEGUNDOS, config.LLM_PETICIONES_POR_MINUTO, config.LLM_RAFAGA_MAX,
+                     config.LLM_CIRCUITO_UMBRAL_FALLOS, config.LLM_CIRCUITO_SEGUNDOS_ABIERTO)
+            if self._control_llm is None or self._clave_control_llm != clave:
+                limitador = None
+                if config.LLM_PETICIONES_POR_MINUTO > 0:
+                    limitador = resiliencia_llm.LimitadorTasa(config.LLM_PETICIONES_POR_MINUTO, config.LLM_RAFAGA_MAX)
+                self._control_llm = resiliencia_llm.ControlLlamadasLLM(
+                    max_reintentos=config.LLM_MAX_REINTENTOS,
+                    backoff_base=config.LLM_BACKOFF_BASE_SEGUNDOS,
+                    backoff_max=config.LLM_BACKOFF_MAX_SEGUNDOS,
+                    plazo_segundos=config.LLM_PLAZO_SEGUNDOS,
+                    limitador=limitador,
+                    interruptor=resiliencia_llm.InterruptorCircuito(config.LLM_CIRCUITO_UMBRAL_FALLOS,
+                                                                    config.LLM_CIRCUITO_SEGUNDOS_ABIERTO)
+                )
+                self._clave_control_llm = clave
+            return self._control_llm
+
+    def obtener_llm(self):
+        with self._lock:
+            huella_api_key = hashlib.sha256((config.GEMINI_API_KEY or '').encode('utf-8')).hexdigest()
+            cache = self.obtener_cache_llm()
+            control = self.obtener_control_llm()
+            opciones_simulado = {
+                "url_servidor": config.LLM_SIMULADO_URL,
+                "latencia_segundos": config.LLM_SIMULADO_LATENCIA_SEGUNDOS,
+                "segundos_por_fragmento": config.LLM_SIMULADO_SEGUNDOS_POR_FRAGMENTO,
+                "tasa_errores": config.LLM_SIMULADO_TASA_ERRORES,
+                "semilla": config.LLM_SIMULADO_SEMILLA
+            }
+            clave = (config.LLM_PROVEEDOR, config.GEMINI_MODEL_NAME, huella_api_key, id(cache), id(control),
+                     config.LLM_TIMEOUT_SEGUNDOS, tuple(sorted(opciones_simulado.items())))
+            if self._llm is not None and self._clave_llm == clave:
+                return self._llm
+            llm = rag_components.get_llm_instance(config.GEMINI_MODEL_NAME, config.GEMINI_API_KEY, cache=cache,
+                                                  control_llamadas=control, timeout=config.LLM_TIMEOUT_SEGUNDOS,
+                                                  proveedor=config.LLM_PROVEEDOR, opciones_simulado=opciones_simulado,
+                                                  callbacks=[metricas.ManejadorMetricasLLM()])
+            self._llm = llm
+            self._clave_llm = clave if llm is not None else None
+            return llm
+
+    def obtener_cadena_rag(self, llm, vector_db):
+        with self._lock:
+            ruta_coleccion = vector_db_manager.raiz_de_version(vector_db._persist_directory)
+            indice_bm25 = None
+            if config.RECUPERACION_HIBRIDA:
+                indice_bm25 = self.obtener_indice_bm25(vector_db)
+                if indice_bm25 is None:
+                    logger.warning("No hay índice BM25 disponible; se usará solo la búsqueda densa.")
+            modelo_reranking = None
+            if config.RERANKING_HABILITADO:
+                modelo_reranking = self.obtener_reranker()
+                if modelo_reranking is None:
+                    logger.warning("No hay cross-encoder disponible; se usará la recuperación sin reranking.")
+            clave = (id(llm), id(vector_db), id(indice_bm25), id(modelo_reranking), config.K_RETRIEVED_DOCS,
+                     config.K_CANDIDATOS_HIBRIDOS, config.K_CANDIDATOS_RERANKING, config.EMPAQUETADO_CONTEXTO,
+                     config.PRESUPUESTO_TOKENS_PROMPT, config.MIN_TOKENS_CONTEXTO, config.K_CANDIDATOS_CONTEXTO)
+            qa_chain, clave_cadena = self._cadenas.get(ruta_coleccion, (None, None))
+            if qa_chain is not None and clave_cadena == clave:
+                logger.info("Reutilizando LLM y cadena RAG ya configurados en este proceso.")
+                return qa_chain
+            qa_chain = rag_components.crear_cadena_rag(llm, vector_db, config.K_RETRIEVED_DOCS,
+                                                       indice_bm25=indice_bm25, k_candidatos=config.K_CANDIDATOS_HIBRIDOS,
+                                                       reranker=modelo_reranking, k_candidatos_reranking=config.K_CANDIDATOS_RERANKING,
+                                                       presupuesto_tokens_prompt=config.PRESUPUESTO_TOKENS_PROMPT if config.EMPAQUETADO_CONTEXTO else None,
+                                                       k_candidatos_contexto=config.K_CANDIDATOS_CONTEXTO,
+                                                       min_tokens_contexto=config.MIN_TOKENS_CONTEXTO)
+            if qa_chain is not None:
+                self._cadenas[ruta_coleccion] = (qa_chain, clave)
+            return qa_chain
+
+    def invalidar(self):
+        with self._lock:
+            self._embedding_function = self._clave_embeddings = None
+            self._soltar_vector_db()
+            self._reranker = self._clave_reranker = None
+            self._cache_llm = self._clave_cache_llm = None
+            self._llm = self._clave_llm = None
+        logger.info("Pipeline RAG invalidado; los componentes se recargarán en el próximo análisis.")
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+def obtener_pipeline():
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = PipelineRAG()
+        return _pipeline
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo pipeline_rag.py cargado.")
@@ -0,0 +1,98 @@
+# scripts/pool_embeddings.py
+# Pool opcional de procesos para calcular embeddings al (re)construir la base vectorial: cada proceso carga su propia
+# copia del modelo y usa un número fijo de hilos de torch/onnxruntime, así que con N procesos se aprovechan N grupos de
+# núcleos en lugar de uno solo. Las consultas (embed_query) siguen usando el modelo del proceso principal.
+import os
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import logging
+
+from . import config
+from .onnx_embeddings import OnnxSentenceEmbeddings
+from .embeddings_por_lotes import buscar_embeddings_por_longitud
+
+logger = logging.getLogger(__name__)
+
+_embeddings_proceso = None # Modelo cargado en cada proceso del pool
+
+def _iniciar_proceso(backend, model_name_or_path, cache_folder, batch_size, directorio_onnx, cuantizado, num_hilos):
+    global _embeddings_proceso
+    import torch
+    torch.set_num_threads(num_hilos)
+    if backend == "onnx":
+        _embeddings_proceso = OnnxSentenceEmbeddings(model_name_or_path, directorio_onnx, cache_folder=cache_folder,
+                                                     cuantizado=cuantizado, batch_size=batch_size, num_hilos=num_hilos)
+    else:
+        from langchain_community.embeddings import SentenceTransformerEmbeddings
+        _embeddings_proceso = SentenceTransformerEmbeddings(model_name=model_name_or_path, model_kwargs={'device': 'cpu'},
+                                                            encode_kwargs={'batch_size': batch_size},
+                                                            cache_folder=cache_folder)
+
+def _arrancar():
+    return os.getpid() # El modelo ya se cargó en el initializer
+
+def _embeber_lote(textos):
+    return _embeddings_proceso.embed_documents(textos)
+
+class PoolEmbeddings:
+    """
+    Procesos con una copia del mismo modelo que `embeddings_base` (torch u ONNX). `embeber_lotes` reparte los lotes
+    entre los procesos, los más largos primero para que ninguno se quede el último con un lote grande.
+    """
+
+    def __init__(self, embeddings_base, num_procesos, hilos_por_proceso):
+        self.num_procesos = num_procesos
+        self.hilos_por_proceso = hilos_por_proceso
+        if isinstance(embeddings_base, OnnxSentenceEmbeddings):
+            backend, cuantizado, batch_size = "onnx", embeddings_base.cuantizado, embeddings_base.batch_size
+        else:
+            backend, cuantizado = "torch", False
+            batch_size = (getattr(embeddings_base, "encode_kwargs", None) or {}).get("batch_size", config.EMBEDDING_BATCH_SIZE)
+        # 'spawn' evita heredar los hilos del servidor (gunicorn) y el estado de torch del proceso principal.
+        self._executor = ProcessPoolExecutor(
+            max_workers=num_procesos, mp_context=multiprocessing.get_context("spawn"), initializer=_iniciar_proceso,
+            initargs=(backend, config.EMBEDDING_MODEL_NAME_OR_PATH, config.CACHE_DIR_HF, batch_size,
+                      config.EMBEDDING_ONNX_PATH, cuantizado, hilos_por_proceso))
+        for _ in range(num_procesos):
+            self._executor.submit(_arrancar) # Arranca todos los procesos ya, mientras se leen los primeros PDFs
+        logger.info(f"Pool de embeddings iniciado: {num_procesos} procesos ({backend}) con {hilos_por_proceso} hilos cada uno.")
+
+    def embeber_lotes(self, lotes):
+        futuros = [None] * len(lotes)
+        for i in sorted(range(len(lotes)), key=lambda i: -sum(len(t) for t in lotes[i])):
+            futuros[i] = self._executor.submit(_embeber_lote, lotes[i])
+        return [futuro.result() for futuro in futuros]
+
+    def cerrar(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        logger.info("Pool de embeddings cerrado.")
+
+@contextmanager
+def pool_embeddings(embedding_function, num_procesos, hilos_por_proceso=0):
+    """
+    Mientras dura el bloque, los embed_documents de `embedding_function` (a través de su EmbeddingsPorLongitud) se
+    reparten entre `num_procesos` procesos. Con num_procesos <= 1 no hace nada. Al salir, incluso por una excepción,
+    los procesos se cierran. Devuelve el pool o None.
+    """
+    envoltorio = buscar_embeddings_por_longitud(embedding_function)
+    if num_procesos <= 1:
+        yield None
+        return
+    if envoltorio is None or envoltorio.pool is not None:
+        logger.warning("No se puede usar el pool de embeddings con esta función de embeddings; se calcularán en este proceso.")
+        yield None
+        return
+    hilos = hilos_por_proceso or max(1, (os.cpu_count() or 1) // num_procesos)
+    pool = PoolEmbeddings(envoltorio.embeddings_base, num_procesos, hilos)
+    envoltorio.pool = pool
+    try:
+        yield pool
+    finally:
+        envoltorio.pool = None
+        pool.cerrar()
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo pool_embeddings.py cargado.")
@@ -2,11 +2,22 @@
 from langchain.chains import RetrievalQA
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.prompts import PromptTemplate
+from langchain_core.prompts import format_document
+from .bm25_index import RetrieverHibrido
+from .reranker import RetrieverConReranking
+from .empaquetador_contexto import RetrieverEmpaquetado, estimar_tokens
+from . import cache_llm
+from .resiliencia_llm import ChatResiliente
+from .llm_simulado import ChatSimulado
 import logging
 import traceback
 
 logger = logging.getLogger(__name__)
 
+# Forma parte de la clave de la cache de resultados: incrementarla al modificar PROMPT_TEMPLATE_STR
+# para que no se devuelvan análisis generados con el prompt anterior.
+PROMPT_TEMPLATE_VERSION = "1"
+
 PROMPT_TEMPLATE_STR = """
 Eres un asistente de IA altamente especializado en la identificación y evaluación de riesgos para proyectos de instalación de maquinaria industrial, basándote en el Project Management Body of Knowledge (PMBOK) y documentación técnica.
 Tu tarea es analizar la descripción del "NUEVO PROYECTO" que se proporciona a continuación. Debes utilizar ÚNICAMENTE la información contenida en el "CONTEXTO PROPORCIONADO" (extractos del PMBOK, manuales técnicos, y lecciones de proyectos anteriores) para realizar tu análisis.
@@ -38,16 +49,28 @@ Ejemplo de formato de un riesgo dentro de la lista:
 Comienza tu respuesta JSON:
 """
 
-def get_llm_instance(model_name, gemini_api_key):
-    if not gemini_api_key:
+def get_llm_instance(model_name, gemini_api_key, cache=None, control_llamadas=None, timeout=None,
+                     proveedor="gemini", opciones_simulado=None, callbacks=None):
+    if proveedor == "simulado":
+        model_name = "llm-simulado"
+    elif not gemini_api_key:
         logger.error("GEMINI_API_KEY no proporcionada para inicializar el LLM.")
         return None
     try:
-        llm = ChatGoogleGenerativeAI(
-            model=model_name,
-            google_api_key=gemini_api_key,
-            temperature=0.3,
-        )
+        if proveedor == "simulado":
+            llm = ChatSimulado(timeout=timeout, cache=None if control_llamadas else cache,
+                               callbacks=None if control_llamadas else callbacks, **(opciones_simulado or {}))
+        else:
+            llm = ChatGoogleGenerativeAI(
+                model=model_name,
+                google_api_key=gemini_api_key,
+                temperature=0.3,
+                timeout=timeout,
+                cache=None if control_llamadas else cache,
+                callbacks=None if control_llamadas else callbacks
+            )
+        if control_llamadas: # La cache va en el envoltorio: una respuesta cacheada no pasa por reintentos ni limitador
+            llm = ChatResiliente(modelo=llm, control=control_llamadas, cache=cache, callbacks=callbacks)
         logger.info(f"--- LLM ({model_name}) configurado exitosamente ---")
         return llm
     except Exception as e:
@@ -55,7 +78,9 @@ def get_llm_instance(model_name, gemini_api_key):
         logger.debug(traceback.format_exc())
         return None
 
-def crear_cadena_rag(llm, vector_db_instance, k_retrieved_docs):
+def crear_cadena_rag(llm, vector_db_instance, k_retrieved_docs, indice_bm25=None, k_candidatos=20,
+                     reranker=None, k_candidatos_reranking=50, presupuesto_tokens_prompt=None,
+                     k_candidatos_contexto=15, min_tokens_contexto=1000):
     if not llm:
         logger.error("Instancia LLM no proporcionada para crear la cadena RAG.")
         return None
@@ -64,8 +89,26 @@ def crear_cadena_rag(llm, vector_db_instance, k_retrieved_docs):
         return None
     
     try:
-        retriever = vector_db_instance.as_retriever(search_kwargs={"k": k_retrieved_docs})
-        logger.info(f"--- Retriever configurado para obtener {k_retrieved_docs} fragmentos ---")
+        # Con presupuesto de tokens, el empaquetador decide cuántos de los k_candidatos_contexto fragmentos caben.
+        if presupuesto_tokens_prompt:
+            k_retrieved_docs = max(k_candidatos_contexto, k_retrieved_docs)
+        # Con reranking, el retriever base entrega un grupo amplio de candidatos y el cross-encoder elige los k finales.
+        k_base = max(k_candidatos_reranking, k_retrieved_docs) if reranker is not None else k_retrieved_docs
+        if indice_bm25 is not None:
+            retriever = RetrieverHibrido(vector_db=vector_db_instance, indice_bm25=indice_bm25,
+                                         k=k_base, k_candidatos=max(k_candidatos, k_base))
+            logger.info(f"--- Retriever híbrido (denso + BM25, RRF sobre {max(k_candidatos, k_base)} candidatos) configurado para obtener {k_base} fragmentos ---")
+        else:
+            retriever = vector_db_instance.as_retriever(search_kwargs={"k": k_base})
+            logger.info(f"--- Retriever configurado para obtener {k_base} fragmentos ---")
+        if reranker is not None:
+            retriever = RetrieverConReranking(retriever_base=retriever, reranker=reranker, k=k_retrieved_docs)
+            logger.info(f"--- Reranking con cross-encoder: {k_base} candidatos -> {k_retrieved_docs} fragmentos ---")
+        if presupuesto_tokens_prompt:
+            retriever = RetrieverEmpaquetado(retriever_base=retriever, presupuesto_tokens_prompt=presupuesto_tokens_prompt,
+                                             tokens_plantilla=estimar_tokens(PROMPT_TEMPLATE_STR),
+                                             min_tokens_contexto=min_tokens_contexto)
+            logger.info(f"--- Contexto empaquetado con presupuesto de {presupuesto_tokens_prompt} tokens por prompt ---")
 
         prompt = PromptTemplate(
             template=PROMPT_TEMPLATE_STR,
@@ -86,6 +129,34 @@ def crear_cadena_rag(llm, vector_db_instance, k_retrieved_docs):
         logger.debug(traceback.format_exc())
         return None
 
+def invocar_cadena_rag_streaming(qa_chain, query, callback_token):
+    """
+    Equivalente a qa_chain.invoke({"query": query}) pero recibiendo la respuesta del LLM por partes: cada fragmento
+    de texto se pasa a `callback_token` a medida que llega. Recupera los documentos con el mismo retriever y arma el
+    prompt igual que la cadena "stuff" (mismo formato de documentos y separador), así que la respuesta final es la misma.
+    Devuelve {"query", "result", "source_documents"} como la cadena RetrievalQA.
+    """
+    cadena_documentos = qa_chain.combine_documents_chain
+    documentos = qa_chain.retriever.invoke(query)
+    contexto = cadena_documentos.document_separator.join(
+        format_document(doc, cadena_documentos.document_prompt) for doc in documentos)
+    prompt = cadena_documentos.llm_chain.prompt.format(**{cadena_documentos.document_variable_name: contexto, "question": query})
+
+    llm = cadena_documentos.llm_chain.llm
+    respuesta_cacheada = cache_llm.buscar_respuesta_llm(llm, prompt)
+    if respuesta_cacheada is not None: # Se entrega completa como un único fragmento
+        callback_token(respuesta_cacheada)
+        return {"query": query, "result": respuesta_cacheada, "source_documents": documentos}
+
+    partes = []
+    for fragmento in llm.stream(prompt):
+        texto = fragmento.content if hasattr(fragmento, "content") else str(fragmento)
+        if texto:
+            partes.append(texto)
+            callback_token(texto)
+    cache_llm.guardar_respuesta_llm(llm, prompt, "".join(partes))
+    return {"query": query, "result": "".join(partes), "source_documents": documentos}
+
 if __name__ == '__main__':
     if not logging.getLogger().handlers:
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
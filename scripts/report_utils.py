@@ -1,6 +1,8 @@
 # scripts/report_utils.py
 import json
 import os
+import re
+import unicodedata
 from datetime import datetime
 import logging
 import traceback
@@ -57,6 +59,124 @@ def asignar_estado_rag(impacto_str, probabilidad_str):
         else: return "Verde"
     return "Gris (Indeterminado)"
 
+def estructurar_riesgo(riesgo_item_llm):
+    descripcion = riesgo_item_llm.get("descripcion_riesgo", "Descripción no proporcionada")
+    explicacion = riesgo_item_llm.get("explicacion_riesgo", "Explicación no proporcionada")
+    impacto = riesgo_item_llm.get("impacto_estimado", "Desconocido")
+    probabilidad = riesgo_item_llm.get("probabilidad_estimada", "Desconocido")
+    estado_rag = asignar_estado_rag(impacto, probabilidad)
+    return {
+        "descripcion_riesgo": descripcion,
+        "explicacion_riesgo_llm": explicacion,
+        "impacto_estimado_llm": impacto,
+        "probabilidad_estimada_llm": probabilidad,
+        "estado_RAG_sugerido": estado_rag
+    }
+
+class ExtractorRiesgosIncremental:
+    """
+    Recibe la respuesta del LLM por partes (streaming) y devuelve cada objeto de la lista "riesgos_identificados"
+    en cuanto se cierra su llave, sin esperar al JSON completo. El texto ya recorrido no se vuelve a analizar.
+    El resultado final se sigue obteniendo con intentar_parsear_json_riesgos sobre el texto completo.
+    """
+
+    def __init__(self):
+        self.texto = ""
+        self._posicion = 0
+        self._en_lista = False
+        self._profundidad = 0
+        self._inicio_objeto = None
+        self._en_string = False
+        self._escapado = False
+
+    def agregar(self, fragmento):
+        self.texto += fragmento
+        riesgos = []
+        if not self._en_lista:
+            inicio_clave = self.texto.find('"riesgos_identificados"')
+            inicio_lista = self.texto.find('[', inicio_clave) if inicio_clave != -1 else -1
+            if inicio_lista == -1:
+                return riesgos
+            self._en_lista = True
+            self._posicion = inicio_lista + 1
+        while self._posicion < len(self.texto):
+            caracter = self.texto[self._posicion]
+            if self._en_string:
+                if self._escapado:
+                    self._escapado = False
+                elif caracter == '\\':
+                    self._escapado = True
+                elif caracter == '"':
+                    self._en_string = False
+            elif caracter == '"':
+                self._en_string = True
+            elif caracter == '{':
+                if self._profundidad == 0:
+                    self._inicio_objeto = self._posicion
+                self._profundidad += 1
+            elif caracter == '}' and self._profundidad > 0:
+                self._profundidad -= 1
+                if self._profundidad == 0:
+                    try:
+                        riesgo = json.loads(self.texto[self._inicio_objeto:self._posicion + 1])
+                        if isinstance(riesgo, dict):
+                            riesgos.append(riesgo)
+                    except json.JSONDecodeError:
+                        logger.debug("Objeto de riesgo incompleto o inválido durante el streaming; se ignora.")
+            self._posicion += 1
+        return riesgos
+
+_NIVELES_RIESGO = {"bajo": 1, "baja": 1, "medio": 2, "media": 2, "alto": 3, "alta": 3}
+UMBRAL_SIMILITUD_RIESGOS = 0.6 # Jaccard de palabras de la descripción a partir del cual dos riesgos se consideran el mismo
+
+def _palabras_normalizadas(texto):
+    sin_acentos = unicodedata.normalize("NFKD", str(texto).lower()).encode("ascii", "ignore").decode("ascii")
+    return {p for p in re.findall(r"[a-z0-9]+", sin_acentos) if len(p) > 2}
+
+def _nivel_mas_alto(valor_a, valor_b):
+    nivel_a = _NIVELES_RIESGO.get(str(valor_a).lower().strip(), 0)
+    nivel_b = _NIVELES_RIESGO.get(str(valor_b).lower().strip(), 0)
+    return valor_b if nivel_b > nivel_a else valor_a
+
+def combinar_respuestas_secciones(respuestas_llm):
+    """
+    Combina las respuestas JSON del LLM de cada sección del proyecto (modo "secciones") en una sola respuesta
+    con el mismo formato que el análisis completo ({"riesgos_identificados": [...]}), de modo que
+    formatear_y_guardar_reporte y el dashboard no cambian. Los riesgos con descripciones casi iguales se fusionan
+    conservando el impacto y la probabilidad más altos.
+    """
+    riesgos_combinados = []
+    palabras_combinados = []
+    for indice_seccion, respuesta in enumerate(respuestas_llm, start=1):
+        json_seccion = intentar_parsear_json_riesgos(respuesta) if respuesta else None
+        if not json_seccion or not isinstance(json_seccion.get("riesgos_identificados"), list):
+            logger.warning(f"La respuesta de la sección {indice_seccion} no contiene una lista de riesgos interpretable; se omite.")
+            continue
+        for riesgo in json_seccion["riesgos_identificados"]:
+            if not isinstance(riesgo, dict):
+                continue
+            palabras = _palabras_normalizadas(riesgo.get("descripcion_riesgo", ""))
+            duplicado = None
+            for i, palabras_existente in enumerate(palabras_combinados):
+                union = palabras | palabras_existente
+                if union and len(palabras & palabras_existente) / len(union) >= UMBRAL_SIMILITUD_RIESGOS:
+                    duplicado = i
+                    break
+            if duplicado is None:
+                riesgos_combinados.append(dict(riesgo))
+                palabras_combinados.append(palabras)
+            else:
+                existente = riesgos_combinados[duplicado]
+                existente["impacto_estimado"] = _nivel_mas_alto(existente.get("impacto_estimado"), riesgo.get("impacto_estimado"))
+                existente["probabilidad_estimada"] = _nivel_mas_alto(existente.get("probabilidad_estimada"), riesgo.get("probabilidad_estimada"))
+    logger.info(f"Riesgos combinados de {len(respuestas_llm)} secciones: {len(riesgos_combinados)} riesgos únicos.")
+    return json.dumps({"riesgos_identificados": riesgos_combinados}, ensure_ascii=False, indent=2)
+
+def nombre_archivo_reporte(nombre_pdf_proyecto):
+    clean_project_name = "".join(c if c.isalnum() else "_" for c in nombre_pdf_proyecto.replace('.pdf',''))
+    # Usar el nombre base del proyecto para el JSON, consistente con dashboard
+    return f"analisis_riesgos_{clean_project_name}.json" # Quitamos timestamp para sobreescribir si se re-analiza
+
 def formatear_y_guardar_reporte(resultado_analisis_llm, fuentes_recuperadas, 
                                 nombre_pdf_proyecto, modelo_llm_usado, output_path_dir):
     logger.info("Procesando salida del LLM para formato estructurado (JSON)...")
@@ -77,18 +197,7 @@ def formatear_y_guardar_reporte(resultado_analisis_llm, fuentes_recuperadas,
             logger.info("JSON de riesgos parseado exitosamente desde la respuesta del LLM.")
             for riesgo_item_llm in json_output_llm["riesgos_identificados"]:
                 if isinstance(riesgo_item_llm, dict):
-                    descripcion = riesgo_item_llm.get("descripcion_riesgo", "Descripción no proporcionada")
-                    explicacion = riesgo_item_llm.get("explicacion_riesgo", "Explicación no proporcionada")
-                    impacto = riesgo_item_llm.get("impacto_estimado", "Desconocido")
-                    probabilidad = riesgo_item_llm.get("probabilidad_estimada", "Desconocido")
-                    estado_rag = asignar_estado_rag(impacto, probabilidad)
-                    reporte_final["riesgos_identificados_estructurados"].append({
-                        "descripcion_riesgo": descripcion,
-                        "explicacion_riesgo_llm": explicacion,
-                        "impacto_estimado_llm": impacto,
-                        "probabilidad_estimada_llm": probabilidad,
-                        "estado_RAG_sugerido": estado_rag
-                    })
+                    reporte_final["riesgos_identificados_estructurados"].append(estructurar_riesgo(riesgo_item_llm))
                 else:
                     logger.warning(f"Item de riesgo no es un diccionario: {riesgo_item_llm}")
                     reporte_final["riesgos_identificados_estructurados"].append(
@@ -104,9 +213,7 @@ def formatear_y_guardar_reporte(resultado_analisis_llm, fuentes_recuperadas,
         logger.warning("El resultado del análisis no es un string, no se intentará parseo JSON.")
 
     timestamp_file = datetime.now().strftime("%Y%m%d_%H%M%S")
-    clean_project_name = "".join(c if c.isalnum() else "_" for c in nombre_pdf_proyecto.replace('.pdf',''))
-    # Usar el nombre base del proyecto para el JSON, consistente con dashboard
-    output_filename_json = f"analisis_riesgos_{clean_project_name}.json" # Quitamos timestamp para sobreescribir si se re-analiza
+    output_filename_json = nombre_archivo_reporte(nombre_pdf_proyecto)
     output_file_path_json = os.path.join(output_path_dir, output_filename_json)
 
     try:
@@ -0,0 +1,95 @@
+# scripts/reranker.py
+import time
+import hashlib
+import threading
+import logging
+import traceback
+from collections import OrderedDict
+from langchain_core.retrievers import BaseRetriever
+
+from . import metricas
+
+logger = logging.getLogger(__name__)
+
+def _id_fragmento(documento):
+    # Los retrievers de Chroma no siempre devuelven el id del fragmento; en ese caso se identifica por origen y contenido.
+    if getattr(documento, "id", None):
+        return documento.id
+    metadata = documento.metadata or {}
+    firma = f"{metadata.get('source_document')}\x00{metadata.get('page_number')}\x00{metadata.get('start_index')}\x00{documento.page_content}"
+    return hashlib.sha1(firma.encode("utf-8")).hexdigest()
+
+class ReRankerCrossEncoder:
+    """
+    Reordena candidatos con un cross-encoder pequeño en CPU, que puntúa cada par (consulta, fragmento) en conjunto.
+    Los pares se evalúan por lotes y las puntuaciones se memorizan por (hash de la consulta, id del fragmento),
+    así que re-analizar el mismo proyecto o secciones que recuperan los mismos fragmentos no repite inferencias.
+    """
+
+    def __init__(self, model_name_or_path, cache_folder=None, batch_size=16, max_length=512, max_memo=50000):
+        from sentence_transformers import CrossEncoder
+
+        self.model_name = str(model_name_or_path)
+        self.batch_size = batch_size
+        self.max_memo = max_memo
+        self.modelo = CrossEncoder(model_name_or_path, device="cpu", max_length=max_length, cache_folder=cache_folder)
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+        logger.info(f"Cross-encoder de reranking cargado: {self.model_name} (lotes de {batch_size} pares).")
+
+    def puntuar(self, consulta, documentos):
+        hash_consulta = hashlib.sha256(consulta.encode("utf-8")).hexdigest()
+        claves = [(hash_consulta, _id_fragmento(d)) for d in documentos]
+        with self._lock:
+            puntuaciones = [self._memo.get(c) for c in claves]
+            for c, p in zip(claves, puntuaciones):
+                if p is not None:
+                    self._memo.move_to_end(c)
+        pendientes = [i for i, p in enumerate(puntuaciones) if p is None]
+        if pendientes:
+            nuevas = self.modelo.predict([(consulta, documentos[i].page_content) for i in pendientes],
+                                         batch_size=self.batch_size, show_progress_bar=False)
+            with self._lock:
+                for i, puntuacion in zip(pendientes, nuevas):
+                    puntuaciones[i] = float(puntuacion)
+                    self._memo[claves[i]] = puntuaciones[i]
+                while len(self._memo) > self.max_memo:
+                    self._memo.popitem(last=False)
+        return puntuaciones, len(documentos) - len(pendientes)
+
+    def reordenar(self, consulta, documentos, k):
+        if not documentos:
+            return []
+        inicio = time.perf_counter()
+        puntuaciones, memorizados = self.puntuar(consulta, documentos)
+        orden = sorted(range(len(documentos)), key=lambda i: puntuaciones[i], reverse=True)[:k]
+        # El reranker se comparte entre análisis: la latencia va al registro de métricas del análisis que lo llama
+        segundos = time.perf_counter() - inicio
+        metricas.registrar_etapa("reranking", segundos)
+        logger.info(f"Reranking de {len(documentos)} candidatos a {len(orden)} en {segundos * 1000:.1f} ms "
+                    f"({memorizados} puntuaciones memorizadas, {len(documentos) - memorizados} calculadas).")
+        return [documentos[i] for i in orden]
+
+class RetrieverConReranking(BaseRetriever):
+    """Recupera `k_candidatos` fragmentos con el retriever base y deja los `k` mejores según el cross-encoder."""
+
+    retriever_base: BaseRetriever
+    reranker: object
+    k: int = 3
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        candidatos = self.retriever_base.invoke(query)
+        return self.reranker.reordenar(query, candidatos, self.k)
+
+def crear_reranker(model_name_or_path, cache_folder=None, batch_size=16):
+    try:
+        return ReRankerCrossEncoder(model_name_or_path, cache_folder=cache_folder, batch_size=batch_size)
+    except Exception as e:
+        logger.error(f"No se pudo cargar el cross-encoder de reranking '{model_name_or_path}': {e}")
+        logger.debug(traceback.format_exc())
+        return None
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo reranker.py cargado.")
@@ -0,0 +1,227 @@
+# scripts/resiliencia_llm.py
+import time
+import socket
+import random
+import threading
+import logging
+from typing import Any
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+logger = logging.getLogger(__name__)
+
+CODIGOS_HTTP_TRANSITORIOS = {408, 429, 500, 502, 503, 504}
+
+ESTADO_CIRCUITO_CERRADO = "cerrado"
+ESTADO_CIRCUITO_ABIERTO = "abierto"
+ESTADO_CIRCUITO_SEMIABIERTO = "semiabierto"
+
+def _errores_de_red():
+    # Solo fallos de conexión y timeouts: otros OSError (FileNotFoundError, PermissionError...) no se arreglan reintentando
+    errores = [ConnectionError, TimeoutError, socket.timeout]
+    try:
+        import requests
+        errores += [requests.exceptions.ConnectionError, requests.exceptions.Timeout]
+    except ImportError:
+        pass
+    try:
+        import urllib3
+        errores += [urllib3.exceptions.ProtocolError, urllib3.exceptions.NewConnectionError,
+                    urllib3.exceptions.TimeoutError]
+    except ImportError:
+        pass
+    return tuple(errores)
+
+ERRORES_DE_RED = _errores_de_red()
+
+class LLMNoDisponibleError(Exception):
+    pass
+
+class CircuitoAbiertoError(LLMNoDisponibleError):
+    pass
+
+class PlazoAgotadoError(LLMNoDisponibleError):
+    pass
+
+def es_error_transitorio(error):
+    """429/5xx/timeouts (google.api_core expone `code`, requests `response.status_code`) y errores de red."""
+    codigo = getattr(error, "code", None)
+    if not isinstance(codigo, int):
+        codigo = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(codigo, int):
+        return codigo in CODIGOS_HTTP_TRANSITORIOS
+    return isinstance(error, ERRORES_DE_RED)
+
+class LimitadorTasa:
+    """Token bucket compartido entre hilos: `peticiones_por_minuto` de media con ráfagas de hasta `rafaga_max`."""
+
+    def __init__(self, peticiones_por_minuto, rafaga_max=1):
+        self.tasa_por_segundo = peticiones_por_minuto / 60.0
+        self.capacidad = max(1, rafaga_max)
+        self._fichas = float(self.capacidad)
+        self._ultima_recarga = time.monotonic()
+        self._lock = threading.Lock()
+
+    def adquirir(self, plazo_segundos=None):
+        """Espera una ficha; devuelve False si no llega antes de `plazo_segundos`."""
+        limite = None if plazo_segundos is None else time.monotonic() + plazo_segundos
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._fichas = min(self.capacidad, self._fichas + (ahora - self._ultima_recarga) * self.tasa_por_segundo)
+                self._ultima_recarga = ahora
+                if self._fichas >= 1:
+                    self._fichas -= 1
+                    return True
+                espera = (1 - self._fichas) / self.tasa_por_segundo
+            if limite is not None and ahora + espera > limite:
+                return False
+            time.sleep(espera)
+
+class InterruptorCircuito:
+    """
+    Tras `umbral_fallos` fallos transitorios seguidos se abre y rechaza las llamadas durante `segundos_abierto`;
+    después deja pasar una llamada de prueba (semiabierto) que lo cierra si funciona o lo vuelve a abrir si falla.
+    """
+
+    def __init__(self, umbral_fallos=5, segundos_abierto=60):
+        self.umbral_fallos = umbral_fallos
+        self.segundos_abierto = segundos_abierto
+        self.estado = ESTADO_CIRCUITO_CERRADO
+        self._fallos_seguidos = 0
+        self._abierto_desde = 0.0
+        self._prueba_en_curso = False
+        self._lock = threading.Lock()
+
+    def comprobar(self):
+        with self._lock:
+            if self.estado == ESTADO_CIRCUITO_ABIERTO:
+                restante = self.segundos_abierto - (time.monotonic() - self._abierto_desde)
+                if restante > 0:
+                    raise CircuitoAbiertoError(f"El LLM no está respondiendo; se reintentará en {restante:.0f} segundos.")
+                self.estado = ESTADO_CIRCUITO_SEMIABIERTO
+                self._prueba_en_curso = False
+            if self.estado == ESTADO_CIRCUITO_SEMIABIERTO:
+                if self._prueba_en_curso:
+                    raise CircuitoAbiertoError("El LLM no está respondiendo; hay una llamada de prueba en curso.")
+                self._prueba_en_curso = True
+
+    def registrar_exito(self):
+        with self._lock:
+            if self.estado != ESTADO_CIRCUITO_CERRADO:
+                logger.info("Circuito del LLM cerrado: el servicio vuelve a responder.")
+            self.estado = ESTADO_CIRCUITO_CERRADO
+            self._fallos_seguidos = 0
+            self._prueba_en_curso = False
+
+    def liberar_prueba(self):
+        with self._lock:
+            self._prueba_en_curso = False
+
+    def registrar_fallo(self):
+        with self._lock:
+            self._fallos_seguidos += 1
+            self._prueba_en_curso = False
+            if self.estado == ESTADO_CIRCUITO_SEMIABIERTO or self._fallos_seguidos >= self.umbral_fallos:
+                if self.estado != ESTADO_CIRCUITO_ABIERTO:
+                    logger.warning(f"Circuito del LLM abierto tras {self._fallos_seguidos} fallos seguidos; "
+                                   f"las llamadas fallarán de inmediato durante {self.segundos_abierto} segundos.")
+                self.estado = ESTADO_CIRCUITO_ABIERTO
+                self._abierto_desde = time.monotonic()
+
+class ControlLlamadasLLM:
+    """
+    Política común a todas las llamadas al LLM del proceso: limitador de tasa e interruptor compartidos,
+    reintentos con backoff exponencial con jitter (completo) y un plazo total por llamada que incluye las esperas.
+    """
+
+    def __init__(self, max_reintentos=4, backoff_base=1.0, backoff_max=30.0, plazo_segundos=300.0,
+                 limitador=None, interruptor=None):
+        self.max_reintentos = max_reintentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.plazo_segundos = plazo_segundos
+        self.limitador = limitador
+        self.interruptor = interruptor or InterruptorCircuito()
+
+    def ejecutar(self, funcion):
+        inicio = time.monotonic()
+        intento = 0
+        while True:
+            self.interruptor.comprobar()
+            restante = self.plazo_segundos - (time.monotonic() - inicio)
+            if self.limitador is not None and not self.limitador.adquirir(restante):
+                self.interruptor.liberar_prueba() # El servicio no falló; solo se agotó el plazo esperando turno
+                raise PlazoAgotadoError(f"Plazo de {self.plazo_segundos:g} s agotado esperando turno en el limitador de tasa del LLM.")
+            try:
+                resultado = funcion()
+            except Exception as e:
+                if not es_error_transitorio(e):
+                    self.interruptor.registrar_exito() # El servicio respondió (p. ej. argumento inválido): no cuenta como caída
+                    raise
+                self.interruptor.registrar_fallo()
+                if intento >= self.max_reintentos:
+                    raise
+                if self.interruptor.estado == ESTADO_CIRCUITO_ABIERTO:
+                    raise CircuitoAbiertoError(f"Circuito del LLM abierto tras el intento {intento + 1}: {e}") from e
+                espera = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** intento))
+                if time.monotonic() - inicio + espera > self.plazo_segundos:
+                    raise PlazoAgotadoError(f"Plazo de {self.plazo_segundos:g} s agotado tras {intento + 1} intentos: {e}") from e
+                intento += 1
+                logger.warning(f"Error transitorio del LLM ({e}); reintento {intento}/{self.max_reintentos} en {espera:.2f} s.")
+                time.sleep(espera)
+                continue
+            self.interruptor.registrar_exito()
+            return resultado
+
+class ChatResiliente(BaseChatModel):
+    """
+    Envuelve un chat model de LangChain y hace pasar cada llamada por un ControlLlamadasLLM. En streaming solo
+    se reintenta si el error llega antes del primer fragmento; con la respuesta ya a medias el error se propaga.
+    """
+
+    modelo: BaseChatModel
+    control: Any
+
+    @property
+    def _llm_type(self):
+        return f"resiliente-{self.modelo._llm_type}"
+
+    @property
+    def _identifying_params(self):
+        # Mismos parámetros que el modelo envuelto: forman parte de la clave de la cache de respuestas del LLM
+        return dict(self.modelo._identifying_params)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        mensaje = self.control.ejecutar(lambda: self.modelo.invoke(messages, stop=stop, **kwargs))
+        return ChatResult(generations=[ChatGeneration(message=mensaje)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        def iniciar():
+            iterador = iter(self.modelo.stream(messages, stop=stop, **kwargs))
+            return next(iterador, None), iterador
+
+        primero, iterador = self.control.ejecutar(iniciar)
+        if primero is None:
+            return
+        yield self._a_chunk(primero, run_manager)
+        try:
+            for fragmento in iterador:
+                yield self._a_chunk(fragmento, run_manager)
+        except Exception as e:
+            if es_error_transitorio(e):
+                self.control.interruptor.registrar_fallo()
+            raise
+
+    @staticmethod
+    def _a_chunk(fragmento, run_manager):
+        chunk = ChatGenerationChunk(message=AIMessageChunk(content=fragmento.content))
+        if run_manager:
+            run_manager.on_llm_new_token(fragmento.content, chunk=chunk)
+        return chunk
+
+if __name__ == '__main__':
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    logger.info("Módulo resiliencia_llm.py cargado.")
@@ -1,16 +1,40 @@
 # scripts/vector_db_manager.py
 import os
+import json
+import time
+import uuid
+import queue
 import shutil
+import hashlib
+import threading
+import contextvars
 import torch
 from langchain_community.vectorstores import Chroma
 from langchain_community.embeddings import SentenceTransformerEmbeddings
 from . import document_utils 
 from . import config # Para acceder a CACHE_DIR_HF
+from . import metricas
+from .embedding_cache import CacheEmbeddings
+from .onnx_embeddings import OnnxSentenceEmbeddings
+from .embeddings_por_lotes import crear_embeddings_por_longitud, buscar_embeddings_por_longitud
+from .pool_embeddings import pool_embeddings
+from .cache_texto_pdf import calcular_hash_archivo
+from .bm25_index import ConstructorIndiceBM25, BM25_INDEX_FILENAME
 import traceback
 import logging
 
 logger = logging.getLogger(__name__)
 
+MANIFEST_KB_FILENAME = "kb_manifest.json"
+MANIFEST_KB_VERSION = 1
+PUNTERO_VERSION_FILENAME = "VERSION_ACTUAL"
+DIRECTORIO_VERSIONES = "versiones"
+LOTE_COPIA_FRAGMENTOS = 5000
+
+_lock_construccion = threading.Lock()
+_lock_versiones = threading.Lock()
+_referencias_versiones = {} # Carpeta de versión -> referencias (la pipeline y cada análisis en curso)
+
 def get_embedding_function(model_name_or_path):
     device = 'cpu' 
     cache_folder_path = config.CACHE_DIR_HF # Usar la ruta de caché de config.py
@@ -28,16 +52,47 @@ def get_embedding_function(model_name_or_path):
                 logger.error(f"No se pudo crear el directorio de caché {cache_folder_path}: {e_mkdir}")
                 # No es un error fatal para el intento de carga, SentenceTransformer lo manejará.
 
-        embedding_function = SentenceTransformerEmbeddings(
-            model_name=model_name_or_path,
-            model_kwargs={'device': device},
-            cache_folder=cache_folder_path # Pasar el directorio de caché
-        )
+        embedding_function = None
+        if config.EMBEDDING_BACKEND == 'onnx':
+            try:
+                embedding_function = OnnxSentenceEmbeddings(
+                    model_name_or_path,
+                    directorio_onnx_base=config.EMBEDDING_ONNX_PATH,
+                    cache_folder=cache_folder_path,
+                    cuantizado=config.EMBEDDING_ONNX_CUANTIZADO,
+                    batch_size=config.EMBEDDING_BATCH_SIZE
+                )
+                device = 'cpu (onnxruntime' + (', int8)' if config.EMBEDDING_ONNX_CUANTIZADO else ')')
+            except Exception as e_onnx:
+                logger.warning(f"No se pudo inicializar el backend ONNX ({e_onnx}). Se usará el backend torch.")
+                logger.debug(traceback.format_exc())
+        if embedding_function is None:
+            embedding_function = SentenceTransformerEmbeddings(
+                model_name=model_name_or_path,
+                model_kwargs={'device': device},
+                encode_kwargs={'batch_size': config.EMBEDDING_BATCH_SIZE},
+                cache_folder=cache_folder_path # Pasar el directorio de caché
+            )
         try:
             model_display_name = os.path.basename(str(model_name_or_path))
         except:
             model_display_name = str(model_name_or_path)
         logger.info(f"Modelo de embeddings '{model_display_name}' inicializado exitosamente en '{device}'.")
+        # Lotes de EMBEDDING_BATCH_SIZE textos de longitud parecida (menos relleno); la cache va por fuera
+        embedding_function = crear_embeddings_por_longitud(embedding_function, config.EMBEDDING_BATCH_SIZE,
+                                                           agrupar=config.EMBEDDING_AGRUPAR_POR_LONGITUD)
+        if config.EMBEDDING_CACHE_HABILITADA:
+            try:
+                embedding_function = CacheEmbeddings(
+                    embedding_function,
+                    modelo_id=getattr(embedding_function, 'model_name', model_name_or_path), # Distingue backend torch/onnx
+                    directorio_cache=config.EMBEDDING_CACHE_DIR,
+                    max_entradas=config.EMBEDDING_CACHE_MAX_ENTRADAS
+                )
+                logger.info(f"Cache de embeddings activada en '{embedding_function.directorio}' (máx. {config.EMBEDDING_CACHE_MAX_ENTRADAS} entradas).")
+            except Exception as e_cache:
+                logger.warning(f"No se pudo abrir la cache de embeddings, se continuará sin ella: {e_cache}")
+                logger.debug(traceback.format_exc())
         return embedding_function
     except Exception as e:
         logger.error(f"ERROR CRÍTICO al inicializar SentenceTransformerEmbeddings:")
@@ -47,73 +102,492 @@ def get_embedding_function(model_name_or_path):
         logger.debug(traceback.format_exc())
         return None
 
-def crear_o_cargar_chroma_db(chroma_db_path, docs_base_conocimiento_path, embedding_function, 
-                               chunk_size, chunk_overlap, recrear_db_flag):
-    if not embedding_function:
-        logger.error("Función de embeddings no proporcionada a crear_o_cargar_chroma_db.")
+def calcular_hashes_kb(docs_base_conocimiento_path):
+    hashes = {}
+    for nombre in document_utils.listar_documentos_kb(docs_base_conocimiento_path):
+        try:
+            hashes[nombre] = calcular_hash_archivo(os.path.join(docs_base_conocimiento_path, nombre))
+        except OSError as e:
+            logger.error(f"No se pudo calcular el hash de '{nombre}': {e}")
+    return hashes
+
+def _id_modelo_embeddings(embedding_function):
+    return str(getattr(embedding_function, 'model_name', type(embedding_function).__name__))
+
+def _leer_manifest(chroma_db_path):
+    ruta_manifest = os.path.join(chroma_db_path, MANIFEST_KB_FILENAME)
+    if not os.path.exists(ruta_manifest):
+        return None
+    try:
+        with open(ruta_manifest, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"No se pudo leer el manifest de la base de conocimiento '{ruta_manifest}': {e}")
+        return None
+
+def _guardar_manifest(chroma_db_path, modelo_embeddings, chunk_size, chunk_overlap, archivos):
+    manifest = {
+        "version": MANIFEST_KB_VERSION,
+        "modelo_embeddings": modelo_embeddings,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "archivos": archivos
+    }
+    ruta_manifest = os.path.join(chroma_db_path, MANIFEST_KB_FILENAME)
+    ruta_tmp = ruta_manifest + ".tmp"
+    try:
+        with open(ruta_tmp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(ruta_tmp, ruta_manifest) # Escritura atómica: nunca queda un manifest a medias
+        return True
+    except Exception as e:
+        logger.error(f"No se pudo guardar el manifest de la base de conocimiento en '{ruta_manifest}': {e}")
+        logger.debug(traceback.format_exc())
+        return False
+
+def _manifest_compatible(manifest, modelo_embeddings, chunk_size, chunk_overlap):
+    return bool(manifest) and \
+        manifest.get("version") == MANIFEST_KB_VERSION and \
+        manifest.get("modelo_embeddings") == modelo_embeddings and \
+        manifest.get("chunk_size") == chunk_size and \
+        manifest.get("chunk_overlap") == chunk_overlap
+
+def obtener_huella_kb(chroma_db_path):
+    """Hash del manifest actual: cambia si cambia cualquier PDF, el modelo o los parámetros de fragmentación."""
+    return _huella_manifest(_leer_manifest(ruta_version_actual(chroma_db_path) or chroma_db_path))
+
+def _huella_manifest(manifest):
+    if not manifest:
         return None
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _nuevo_constructor_bm25():
+    # Las listas de apariciones se acumulan mientras se indexa, sin volver a leer la colección entera después
+    return ConstructorIndiceBM25() if config.RECUPERACION_HIBRIDA else None
+
+def _guardar_indice_bm25(ruta_version, constructor_bm25):
+    """Guarda en la versión nueva, antes de publicarla, el índice BM25 de sus fragmentos con la huella de su manifest."""
+    if constructor_bm25 is None:
+        return
+    ruta_indice = os.path.join(ruta_version, BM25_INDEX_FILENAME)
+    try:
+        inicio = time.time()
+        indice = constructor_bm25.construir(_huella_manifest(_leer_manifest(ruta_version)))
+        indice.guardar(ruta_indice)
+        metricas.registrar_etapa("indice_bm25", time.time() - inicio)
+        logger.info(f"Índice BM25 guardado con {len(indice.ids)} fragmentos y {len(indice.vocabulario)} términos "
+                    f"en {time.time() - inicio:.2f} segundos.")
+    except Exception as e:
+        # No impide publicar la versión: al cargarla se construirá desde la colección
+        logger.error(f"No se pudo guardar el índice BM25 en '{ruta_indice}': {e}")
+        logger.debug(traceback.format_exc())
+
+def kb_tiene_cambios(chroma_db_path, docs_base_conocimiento_path, embedding_function, chunk_size, chunk_overlap):
+    manifest = _leer_manifest(ruta_version_actual(chroma_db_path) or chroma_db_path)
+    if not _manifest_compatible(manifest, _id_modelo_embeddings(embedding_function), chunk_size, chunk_overlap):
+        return True
+    hashes_indexados = {n: v.get("sha256") for n, v in manifest.get("archivos", {}).items()}
+    return hashes_indexados != calcular_hashes_kb(docs_base_conocimiento_path)
 
-    chroma_db_file_check = os.path.join(chroma_db_path, "chroma.sqlite3")
+def _registrar_indexacion(num_fragmentos, segundos):
+    """Throughput de embeddings + inserción en ChromaDB, para el log y las métricas del análisis."""
+    logger.info(f"Indexados {num_fragmentos} fragmentos en {segundos:.2f} s "
+                f"({num_fragmentos / segundos if segundos > 0 else 0:.1f} fragmentos/s).")
+    metricas.sumar("fragmentos_indexados", num_fragmentos)
+    metricas.sumar("segundos_indexacion", segundos)
 
-    if recrear_db_flag and os.path.exists(chroma_db_path):
-        logger.info(f"Borrando base de datos ChromaDB existente en: {chroma_db_path} porque RECREAR_DB es True.")
+_FIN_INGESTA = object()
+
+def _indexar_en_streaming(vector_db, pdfs_fragmentados, tam_lote, max_lotes_en_cola, constructor_bm25=None):
+    """
+    Inserta en `vector_db` los fragmentos de `pdfs_fragmentados` (generador de document_utils.iterar_pdfs_fragmentados)
+    en lotes de `tam_lote`: un hilo lee y fragmenta los PDFs mientras este calcula los embeddings de cada lote y lo
+    inserta. La cola entre ambos admite `max_lotes_en_cola` lotes, así que la memoria no crece con el tamaño de la base
+    de conocimiento. Con EMBEDDING_PROCESOS > 1 los embeddings de cada lote se reparten entre un pool de procesos que
+    se cierra al terminar. Cada lote insertado se añade también a `constructor_bm25`, si se indica. Devuelve
+    {nombre_pdf: num_fragmentos} de los PDFs indexados; si algo falla, lanza la excepción.
+    """
+    embeddings_por_longitud = buscar_embeddings_por_longitud(vector_db.embeddings)
+    if config.EMBEDDING_PROCESOS > 1 and embeddings_por_longitud is not None:
+        # Varios lotes de embeddings por proceso en cada lote de ingesta, para que ningún proceso quede ocioso
+        tam_lote = max(tam_lote, 4 * config.EMBEDDING_PROCESOS * embeddings_por_longitud.batch_size)
+    cola = queue.Queue(maxsize=max(1, max_lotes_en_cola))
+    detener = threading.Event()
+    conteo = {}
+
+    def encolar(elemento):
+        while not detener.is_set(): # Si el consumidor falla, el productor no se queda bloqueado con la cola llena
+            try:
+                cola.put(elemento, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producir():
+        lote = []
         try:
-            shutil.rmtree(chroma_db_path)
-            os.makedirs(chroma_db_path, exist_ok=True) 
-            logger.info(f"Carpeta {chroma_db_path} limpiada y recreada.")
-        except Exception as e_shutil:
-            logger.error(f"Error al intentar borrar la carpeta de ChromaDB: {e_shutil}")
+            for nombre_pdf, _, fragmentos in pdfs_fragmentados:
+                for fragmento in fragmentos:
+                    lote.append(fragmento)
+                    if len(lote) >= tam_lote:
+                        if not encolar(lote):
+                            return
+                        lote = []
+                conteo[nombre_pdf] = len(fragmentos)
+            if not lote or encolar(lote):
+                encolar(_FIN_INGESTA)
+        except Exception as e:
+            encolar(e)
+        finally:
+            pdfs_fragmentados.close() # Cierra el pool de procesos de ingesta si se abandona a medias
+
+    rendimiento_previo = embeddings_por_longitud.estadisticas() if embeddings_por_longitud else None
+    # El hilo productor hereda el registro de métricas del análisis (p. ej. los aciertos de la cache de texto de PDFs)
+    productor = threading.Thread(target=contextvars.copy_context().run, args=(producir,), name="ingesta-kb", daemon=True)
+    productor.start()
+    indexados = 0
+    segundos = 0.0
+    try:
+        with pool_embeddings(vector_db.embeddings, config.EMBEDDING_PROCESOS, config.EMBEDDING_HILOS_POR_PROCESO):
+            while True:
+                lote = cola.get()
+                if lote is _FIN_INGESTA:
+                    break
+                if isinstance(lote, Exception):
+                    raise lote
+                inicio_lote = time.time()
+                ids = vector_db.add_documents(lote)
+                segundos += time.time() - inicio_lote
+                if constructor_bm25 is not None:
+                    constructor_bm25.agregar(ids, [fragmento.page_content for fragmento in lote])
+                indexados += len(lote)
+                logger.debug(f"  Lote de {len(lote)} fragmentos indexado ({indexados} en total).")
+    finally:
+        detener.set()
+        productor.join()
+    if indexados:
+        _registrar_indexacion(indexados, segundos)
+        if embeddings_por_longitud is not None:
+            _registrar_rendimiento_embeddings(rendimiento_previo, embeddings_por_longitud.estadisticas())
+    return conteo
+
+def _registrar_rendimiento_embeddings(antes, despues):
+    # Solo el cálculo de embeddings (sin la cache ni la inserción), para ajustar EMBEDDING_BATCH_SIZE en cada máquina
+    fragmentos = despues["fragmentos"] - antes["fragmentos"]
+    segundos = despues["segundos"] - antes["segundos"]
+    if fragmentos and segundos > 0:
+        logger.info(f"Embeddings calculados: {fragmentos} fragmentos en {segundos:.2f} s ({fragmentos / segundos:.1f} fragmentos/s, "
+                    f"lotes de {despues['batch_size']}, {despues['fraccion_tokens_utiles']:.0%} de tokens útiles sin relleno).")
+
+# --- Versiones de la base vectorial (blue/green) ---
+# Cada reconstrucción crea una carpeta nueva en <chroma_db_path>/versiones/ mientras los análisis en curso siguen
+# leyendo la versión publicada; al terminar, el puntero VERSION_ACTUAL se cambia con os.replace (atómico). Cada
+# análisis adquiere una referencia a la versión que usa y las versiones antiguas se borran cuando nadie las usa.
+# Las referencias son del proceso: la app corre en un único proceso de gunicorn con varios hilos.
+def _ruta_version(chroma_db_path, version):
+    return os.path.normpath(os.path.join(chroma_db_path, DIRECTORIO_VERSIONES, version))
+
+def ruta_version_actual(chroma_db_path):
+    """
+    Carpeta de la versión publicada. Si no hay puntero pero la carpeta ya contiene una DB (formato anterior a las
+    versiones, o la carpeta de una versión concreta) se devuelve la propia carpeta; None si no hay ninguna DB.
+    """
+    ruta_puntero = os.path.join(chroma_db_path, PUNTERO_VERSION_FILENAME)
+    if os.path.exists(ruta_puntero):
+        try:
+            with open(ruta_puntero, 'r', encoding='utf-8') as f:
+                return _ruta_version(chroma_db_path, json.load(f)["version"])
+        except Exception as e:
+            logger.error(f"No se pudo leer el puntero de versión de ChromaDB '{ruta_puntero}': {e}")
             logger.debug(traceback.format_exc())
-            return None 
-
-    vector_db = None
-    if not os.path.exists(chroma_db_file_check) or recrear_db_flag:
-        logger.info(f"Intentando crear nueva base de datos vectorial en: {chroma_db_path}")
-        # Usar el nombre de función correcto de tu document_utils.py
-        fragmentos_base_conocimiento = document_utils.cargar_y_procesar_pdfs_de_carpeta(
-            docs_base_conocimiento_path,
-            chunk_size,
-            chunk_overlap
-        )
-
-        if fragmentos_base_conocimiento:
-            logger.info(f"Creando colección en ChromaDB con {len(fragmentos_base_conocimiento)} fragmentos...")
-            try:
-                logger.debug("Antes de llamar a Chroma.from_documents()...")
-                vector_db = Chroma.from_documents(
-                    documents=fragmentos_base_conocimiento,
-                    embedding=embedding_function,
-                    persist_directory=chroma_db_path
-                )
-                logger.info("¡ÉXITO! Base de datos vectorial creada y fragmentos añadidos.")
-            except Exception as e_chroma_create:
-                logger.error(f"ERROR FATALMENTE CRÍTICO durante Chroma.from_documents:")
-                logger.error(f"Tipo de error: {type(e_chroma_create)}, Mensaje: {str(e_chroma_create)}")
-                logger.debug(traceback.format_exc())
-                return None
+    if os.path.exists(os.path.join(chroma_db_path, "chroma.sqlite3")):
+        return os.path.normpath(chroma_db_path)
+    return None
+
+def raiz_de_version(ruta_version):
+    padre = os.path.dirname(ruta_version)
+    return os.path.dirname(padre) if os.path.basename(padre) == DIRECTORIO_VERSIONES else ruta_version
+
+def adquirir_version(ruta_version):
+    with _lock_versiones:
+        ruta = os.path.normpath(ruta_version)
+        _referencias_versiones[ruta] = _referencias_versiones.get(ruta, 0) + 1
+
+def _adquirir_version_actual(chroma_db_path):
+    # Resolver y adquirir bajo el mismo lock que la recolección: la versión no puede borrarse entre ambos pasos
+    with _lock_versiones:
+        ruta = ruta_version_actual(chroma_db_path)
+        if ruta is not None:
+            _referencias_versiones[ruta] = _referencias_versiones.get(ruta, 0) + 1
+        return ruta
+
+def liberar_version(ruta_version):
+    """Libera una referencia; si era la última de una versión ya reemplazada, esa versión se borra."""
+    ruta = os.path.normpath(ruta_version)
+    with _lock_versiones:
+        restantes = _referencias_versiones.get(ruta, 0) - 1
+        if restantes > 0:
+            _referencias_versiones[ruta] = restantes
+            return
+        _referencias_versiones.pop(ruta, None)
+    recolectar_versiones_antiguas(raiz_de_version(ruta))
+
+def base_vectorial_en_uso(chroma_db_path):
+    """True si alguna versión de la base vectorial tiene referencias adquiridas (análisis en curso o pipeline)."""
+    raiz = os.path.normpath(chroma_db_path)
+    with _lock_versiones:
+        return any(raiz_de_version(ruta) == raiz for ruta, cuenta in _referencias_versiones.items() if cuenta > 0)
+
+def cerrar_base_vectorial(chroma_db_path):
+    """
+    Cierra los clientes de ChromaDB de todas las versiones de la carpeta, antes de borrarla del disco. Devuelve False si
+    no se pudo comprobar que quedaran cerrados (en ese caso no debe borrarse).
+    """
+    with _lock_versiones:
+        cerrados = True
+        directorio_versiones = os.path.join(chroma_db_path, DIRECTORIO_VERSIONES)
+        if os.path.isdir(directorio_versiones):
+            for nombre in os.listdir(directorio_versiones):
+                cerrados = _cerrar_cliente_chroma(_ruta_version(chroma_db_path, nombre)) and cerrados
+        return _cerrar_cliente_chroma(os.path.normpath(chroma_db_path)) and cerrados
+
+_aviso_sistemas_chroma = False
+
+def _cerrar_cliente_chroma(ruta):
+    # chromadb reutiliza un sistema (con sus índices en memoria) por carpeta persistente; al borrar la carpeta se descarta.
+    # El registro de sistemas es interno de chromadb (probado con la versión fijada en requirements.txt): si no existe,
+    # no se puede saber si la carpeta sigue abierta y se devuelve False para que no se borre.
+    global _aviso_sistemas_chroma
+    try:
+        from chromadb.api.shared_system_client import SharedSystemClient
+    except ImportError:
+        SharedSystemClient = None
+    if SharedSystemClient is None or not hasattr(SharedSystemClient, "_identifier_to_system"):
+        if not _aviso_sistemas_chroma:
+            _aviso_sistemas_chroma = True
+            logger.warning("Esta versión de chromadb no expone SharedSystemClient._identifier_to_system: no se pueden cerrar "
+                           "sus clientes y las versiones antiguas de la base vectorial no se borrarán. Revise la versión "
+                           "de chromadb fijada en requirements.txt.")
+        return False
+    try:
+        sistema = SharedSystemClient._identifier_to_system.pop(ruta, None)
+        if sistema is not None:
+            sistema.stop()
+        return True
+    except Exception as e:
+        logger.warning(f"No se pudo cerrar el cliente de ChromaDB de '{ruta}': {e}")
+        logger.debug(traceback.format_exc())
+        return False
+
+def recolectar_versiones_antiguas(chroma_db_path):
+    """Borra las versiones que no están publicadas ni en uso (incluidas las que dejó a medias un proceso interrumpido)."""
+    with _lock_versiones:
+        actual = ruta_version_actual(chroma_db_path)
+        directorio_versiones = os.path.join(chroma_db_path, DIRECTORIO_VERSIONES)
+        nombres = sorted(os.listdir(directorio_versiones)) if os.path.isdir(directorio_versiones) else []
+        for nombre in nombres:
+            ruta = _ruta_version(chroma_db_path, nombre)
+            if ruta != actual and not _referencias_versiones.get(ruta):
+                if not _cerrar_cliente_chroma(ruta):
+                    continue # Se reintentará en la próxima recolección
+                shutil.rmtree(ruta, ignore_errors=True)
+                logger.info(f"Versión de ChromaDB sin uso eliminada: {nombre}")
+        raiz = os.path.normpath(chroma_db_path)
+        if actual != raiz and not _referencias_versiones.get(raiz) and os.path.exists(os.path.join(raiz, "chroma.sqlite3")):
+            # DB en el formato anterior (directamente en la carpeta raíz) ya reemplazada por una versión
+            if not _cerrar_cliente_chroma(raiz):
+                return
+            for nombre in os.listdir(raiz):
+                if nombre in (DIRECTORIO_VERSIONES, PUNTERO_VERSION_FILENAME):
+                    continue
+                ruta = os.path.join(raiz, nombre)
+                if os.path.isdir(ruta):
+                    shutil.rmtree(ruta, ignore_errors=True)
+                else:
+                    os.remove(ruta)
+            logger.info("Base vectorial en el formato anterior (sin versiones) eliminada.")
+
+def _nueva_version(chroma_db_path):
+    version = time.strftime("%Y%m%dT%H%M%S") + "_" + uuid.uuid4().hex[:6]
+    ruta = _ruta_version(chroma_db_path, version)
+    os.makedirs(ruta)
+    adquirir_version(ruta) # Impide que la recolección la borre mientras se construye; pasa al que recibe la DB
+    return ruta
+
+def _publicar_version(chroma_db_path, ruta_version):
+    ruta_puntero = os.path.join(chroma_db_path, PUNTERO_VERSION_FILENAME)
+    ruta_tmp = ruta_puntero + ".tmp"
+    with open(ruta_tmp, 'w', encoding='utf-8') as f:
+        json.dump({"version": os.path.basename(ruta_version), "publicada": time.strftime("%Y-%m-%dT%H:%M:%S")}, f)
+    os.replace(ruta_tmp, ruta_puntero)
+    logger.info(f"Versión de ChromaDB publicada: {os.path.basename(ruta_version)}")
+    recolectar_versiones_antiguas(chroma_db_path)
+
+def _descartar_version(ruta_version):
+    liberar_version(ruta_version) # No está publicada: la recolección la borra
+
+def _abrir_version(ruta_version, embedding_function):
+    try:
+        vector_db = Chroma(persist_directory=ruta_version, embedding_function=embedding_function)
+        if vector_db._collection.count() > 0:
+            logger.info(f"Base vectorial cargada ({os.path.basename(ruta_version)}). Contiene {vector_db._collection.count()} fragmentos.")
         else:
+            logger.warning("Base vectorial cargada, pero la colección está vacía o su contenido no pudo ser verificado.")
+        return vector_db
+    except Exception as e_chroma_load:
+        logger.error(f"Error crítico al cargar la base de datos Chroma existente: {e_chroma_load}")
+        logger.debug(traceback.format_exc())
+        return None
+
+def _copiar_fragmentos(origen, destino, excluir_documentos, constructor_bm25=None):
+    """Copia los fragmentos (con sus vectores, sin recalcularlos) que no pertenecen a `excluir_documentos`."""
+    copiados = 0
+    total = origen._collection.count()
+    for desplazamiento in range(0, total, LOTE_COPIA_FRAGMENTOS):
+        lote = origen._collection.get(limit=LOTE_COPIA_FRAGMENTOS, offset=desplazamiento,
+                                      include=["embeddings", "documents", "metadatas"])
+        indices = [i for i, m in enumerate(lote["metadatas"]) if (m or {}).get("source_document") not in excluir_documentos]
+        if indices:
+            destino._collection.add(ids=[lote["ids"][i] for i in indices],
+                                    embeddings=[lote["embeddings"][i] for i in indices],
+                                    documents=[lote["documents"][i] for i in indices],
+                                    metadatas=[lote["metadatas"][i] for i in indices])
+            if constructor_bm25 is not None:
+                constructor_bm25.agregar([lote["ids"][i] for i in indices], [lote["documents"][i] for i in indices])
+            copiados += len(indices)
+    return copiados
+
+def _actualizar_chroma_db_incremental(chroma_db_path, ruta_actual, docs_base_conocimiento_path, embedding_function,
+                                       chunk_size, chunk_overlap, manifest, num_procesos_ingesta):
+    hashes_actuales = calcular_hashes_kb(docs_base_conocimiento_path)
+    archivos_previos = manifest.get("archivos", {})
+    anadidos = sorted(n for n in hashes_actuales if n not in archivos_previos)
+    modificados = sorted(n for n in hashes_actuales if n in archivos_previos and archivos_previos[n].get("sha256") != hashes_actuales[n])
+    eliminados = sorted(n for n in archivos_previos if n not in hashes_actuales)
+    logger.info(f"Indexación incremental: {len(anadidos)} añadidos, {len(modificados)} modificados, "
+                f"{len(eliminados)} eliminados, {len(hashes_actuales) - len(anadidos) - len(modificados)} sin cambios.")
+
+    if not (anadidos or modificados or eliminados):
+        logger.info("La base de conocimiento no cambió desde la última indexación. Se reutiliza la base vectorial existente.")
+        adquirir_version(ruta_actual)
+        vector_db = _abrir_version(ruta_actual, embedding_function)
+        if vector_db is None:
+            liberar_version(ruta_actual)
+        return vector_db
+
+    origen = _abrir_version(ruta_actual, embedding_function)
+    if origen is None:
+        return None
+    ruta_nueva = _nueva_version(chroma_db_path)
+    constructor_bm25 = _nuevo_constructor_bm25()
+    try:
+        vector_db = Chroma(persist_directory=ruta_nueva, embedding_function=embedding_function)
+        # La versión nueva parte de los vectores de la actual, sin los PDFs que cambiaron ('añadidos' incluidos,
+        # por si una indexación anterior se interrumpió tras insertar parte de sus fragmentos).
+        copiados = _copiar_fragmentos(origen, vector_db, set(anadidos + modificados + eliminados), constructor_bm25)
+        logger.info(f"  Copiados {copiados} fragmentos sin cambios desde la versión actual.")
+
+        archivos_manifest = {n: v for n, v in archivos_previos.items() if n in hashes_actuales and n not in modificados}
+        por_indexar = anadidos + modificados
+        if por_indexar:
+            logger.info(f"Añadiendo a ChromaDB los fragmentos de {len(por_indexar)} PDF(s) nuevos o modificados...")
+            conteo = _indexar_en_streaming(vector_db, document_utils.iterar_pdfs_fragmentados(
+                docs_base_conocimiento_path, chunk_size, chunk_overlap,
+                num_procesos=num_procesos_ingesta, solo_archivos=set(por_indexar)
+            ), config.INGESTA_TAM_LOTE, config.INGESTA_MAX_LOTES_EN_COLA, constructor_bm25)
+            for nombre in por_indexar:
+                if nombre in conteo: # Los PDFs que no se pudieron cargar se reintentarán en la próxima indexación
+                    archivos_manifest[nombre] = {"sha256": hashes_actuales[nombre], "fragmentos": conteo[nombre]}
+        if not _guardar_manifest(ruta_nueva, _id_modelo_embeddings(embedding_function), chunk_size, chunk_overlap, archivos_manifest):
+            raise RuntimeError("no se pudo guardar el manifest de la versión nueva")
+        _guardar_indice_bm25(ruta_nueva, constructor_bm25)
+        _publicar_version(chroma_db_path, ruta_nueva)
+    except Exception as e_incremental:
+        logger.error(f"Error durante la actualización incremental de ChromaDB (se mantiene la versión actual): {e_incremental}")
+        logger.debug(traceback.format_exc())
+        _descartar_version(ruta_nueva)
+        return None
+
+    logger.info(f"Actualización incremental completada. La colección contiene {vector_db._collection.count()} fragmentos.")
+    return vector_db
+
+def _construir_version_completa(chroma_db_path, docs_base_conocimiento_path, embedding_function,
+                                chunk_size, chunk_overlap, num_procesos_ingesta):
+    hashes_kb = calcular_hashes_kb(docs_base_conocimiento_path)
+    ruta_nueva = _nueva_version(chroma_db_path)
+    logger.info(f"Creando colección en ChromaDB ({os.path.basename(ruta_nueva)}) e indexando la base de conocimiento por lotes...")
+    constructor_bm25 = _nuevo_constructor_bm25()
+    try:
+        vector_db = Chroma(persist_directory=ruta_nueva, embedding_function=embedding_function)
+        # PDF -> fragmentos -> lote de embeddings -> inserción, sin tener nunca toda la base de conocimiento en memoria
+        conteo = _indexar_en_streaming(vector_db, document_utils.iterar_pdfs_fragmentados(
+            docs_base_conocimiento_path, chunk_size, chunk_overlap, num_procesos=num_procesos_ingesta
+        ), config.INGESTA_TAM_LOTE, config.INGESTA_MAX_LOTES_EN_COLA, constructor_bm25)
+        if not sum(conteo.values()):
             logger.error("No se cargaron fragmentos de la base de conocimiento. La base de datos vectorial no se creará.")
+            _descartar_version(ruta_nueva)
             return None
-    else:
-        logger.info(f"Cargando base de datos vectorial existente desde: {chroma_db_path}")
+        logger.info(f"¡ÉXITO! Base de datos vectorial creada con {sum(conteo.values())} fragmentos de {len(conteo)} PDF(s).")
+        if not _guardar_manifest(ruta_nueva, _id_modelo_embeddings(embedding_function), chunk_size, chunk_overlap,
+                                 {n: {"sha256": h, "fragmentos": conteo[n]} for n, h in hashes_kb.items() if n in conteo}):
+            raise RuntimeError("no se pudo guardar el manifest de la versión nueva")
+        _guardar_indice_bm25(ruta_nueva, constructor_bm25)
+        _publicar_version(chroma_db_path, ruta_nueva)
+        return vector_db
+    except Exception as e_chroma_create:
+        logger.error(f"ERROR FATALMENTE CRÍTICO durante la creación de la base vectorial (se mantiene la versión actual):")
+        logger.error(f"Tipo de error: {type(e_chroma_create)}, Mensaje: {str(e_chroma_create)}")
+        logger.debug(traceback.format_exc())
+        _descartar_version(ruta_nueva)
+        return None
+
+def crear_o_cargar_chroma_db(chroma_db_path, docs_base_conocimiento_path, embedding_function, 
+                               chunk_size, chunk_overlap, recrear_db_flag, num_procesos_ingesta=1,
+                               indexacion_incremental=False):
+    """
+    Devuelve la versión publicada de la base vectorial, reconstruyéndola antes si `recrear_db_flag` (o si no existe).
+    La DB devuelta lleva una referencia adquirida a su versión: quien la recibe debe llamar a liberar_version()
+    con su persist_directory cuando deje de usarla. Si la reconstrucción falla, la versión anterior sigue publicada.
+    """
+    if not embedding_function:
+        logger.error("Función de embeddings no proporcionada a crear_o_cargar_chroma_db.")
+        return None
+
+    if not recrear_db_flag:
+        ruta_actual = _adquirir_version_actual(chroma_db_path)
+        if ruta_actual is not None:
+            logger.info(f"Cargando base de datos vectorial existente desde: {ruta_actual}")
+            vector_db = _abrir_version(ruta_actual, embedding_function)
+            if vector_db is None:
+                liberar_version(ruta_actual)
+            return vector_db
+
+    # Una reconstrucción a la vez; los análisis que solo leen no esperan a este lock
+    with _lock_construccion:
+        ruta_actual = _adquirir_version_actual(chroma_db_path)
+        if ruta_actual is not None and not recrear_db_flag:
+            # Otro análisis la construyó mientras este esperaba el lock (p. ej. dos análisis con la misma KB nueva)
+            logger.info(f"Cargando base de datos vectorial construida por otro análisis: {ruta_actual}")
+            vector_db = _abrir_version(ruta_actual, embedding_function)
+            if vector_db is None:
+                liberar_version(ruta_actual)
+            return vector_db
         try:
-            vector_db = Chroma(
-                persist_directory=chroma_db_path,
-                embedding_function=embedding_function
-            )
-            if vector_db and hasattr(vector_db, '_collection') and vector_db._collection and vector_db._collection.count() > 0:
-                 logger.info(f"Base de datos vectorial cargada. Contiene {vector_db._collection.count()} fragmentos.")
-            elif vector_db:
-                 logger.warning("Base de datos vectorial cargada, pero la colección está vacía o su contenido no pudo ser verificado.")
-            else:
-                logger.error(f"No se pudo cargar la base de datos desde {chroma_db_path}.")
-                return None
-        except Exception as e_chroma_load:
-            logger.error(f"Error crítico al cargar la base de datos Chroma existente: {e_chroma_load}")
-            logger.debug(traceback.format_exc())
-            return None
-            
-    return vector_db
+            if ruta_actual is not None and indexacion_incremental:
+                manifest = _leer_manifest(ruta_actual)
+                if _manifest_compatible(manifest, _id_modelo_embeddings(embedding_function), chunk_size, chunk_overlap):
+                    return _actualizar_chroma_db_incremental(
+                        chroma_db_path, ruta_actual, docs_base_conocimiento_path, embedding_function,
+                        chunk_size, chunk_overlap, manifest, num_procesos_ingesta
+                    )
+                logger.info("No hay un manifest compatible (modelo o parámetros de fragmentación distintos). Se hará una reconstrucción completa.")
+            logger.info(f"Construyendo una nueva versión de la base de datos vectorial en: {chroma_db_path}")
+            return _construir_version_completa(chroma_db_path, docs_base_conocimiento_path, embedding_function,
+                                               chunk_size, chunk_overlap, num_procesos_ingesta)
+        finally:
+            if ruta_actual is not None:
+                liberar_version(ruta_actual)
 
 if __name__ == '__main__':
     if not logging.getLogger().handlers: